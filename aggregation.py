@@ -0,0 +1,268 @@
+import os
+import sys
+import argparse
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from alignment import TargetGrid, grid_of
+from terrain import pixel_spacing
+
+# Các phép gộp giống reduceResolution trong skun.py: mean cho lớp liên tục,
+# mode cho lớp phân loại (WorldCover), valid_fraction = tỉ lệ pixel con có dữ liệu
+REDUCERS = ('mean', 'mode', 'valid_fraction')
+
+# Kernel GDAL dùng khi lưới thô không phải bội số nguyên của lưới gốc
+WARP_RESAMPLING = {'mean': Resampling.average, 'mode': Resampling.mode}
+
+# Số pixel (độ phân giải gốc) tối đa của một dải hàng khi xử lý theo dải
+STRIP_PIXELS = 2 ** 24
+
+
+# Lưới thô gồm các khối factor x factor pixel của lưới gốc, cùng góc trên trái
+def coarse_grid(grid, factor):
+    return TargetGrid(grid.crs, grid.transform * Affine.scale(factor),
+                      -(-grid.width // factor), -(-grid.height // factor))
+
+
+# Lưới thô có cạnh pixel res_m mét, cùng CRS và góc trên trái với lưới gốc. Kích thước pixel
+# theo mét được tính ở hàng giữa lưới (với CRS địa lý, dx và dy khác nhau và thay đổi theo vĩ
+# độ). Trả về (lưới thô, hệ số gộp nguyên), hệ số là None nếu res_m không phải bội số nguyên
+# của pixel gốc theo cả hai chiều; khi đó lưới thô có res_m mét theo từng chiều ở hàng giữa
+def coarse_grid_m(grid, res_m):
+    dx, dy = pixel_spacing(grid.transform, grid.crs, grid.height // 2, grid.height // 2 + 1)
+    factor_x, factor_y = res_m / dx[0], res_m / dy[0]
+    if min(factor_x, factor_y) < 1 - 1e-9:
+        raise ValueError(f"Độ phân giải lưới thô {res_m:g} m nhỏ hơn pixel gốc "
+                         f"({dx[0]:.2f} x {dy[0]:.2f} m)")
+    factor = round(factor_x)
+    if abs(factor_x - factor) <= 1e-9 * factor and abs(factor_y - factor) <= 1e-9 * factor:
+        return coarse_grid(grid, factor), factor
+
+    t = grid.transform
+    transform = Affine(t.a * factor_x, 0, t.c, 0, t.e * factor_y, t.f)
+    return TargetGrid(grid.crs, transform, int(np.ceil(grid.width / factor_x - 1e-9)),
+                      int(np.ceil(grid.height / factor_y - 1e-9))), None
+
+
+# Lưới đích có độ phân giải res, phủ cùng phạm vi với lưới gốc
+def grid_at(grid, res, crs=None):
+    if crs is None or rasterio.crs.CRS.from_user_input(crs) == grid.crs:
+        crs = grid.crs
+        left, top = grid.transform.c, grid.transform.f
+        right = left + grid.transform.a * grid.width
+        bottom = top + grid.transform.e * grid.height
+    else:
+        from rasterio.warp import transform_bounds
+        left, bottom, right, top = transform_bounds(
+            grid.crs, crs, *rasterio.transform.array_bounds(grid.height, grid.width, grid.transform))
+        crs = rasterio.crs.CRS.from_user_input(crs)
+    return TargetGrid(crs, Affine(res, 0, left, 0, -res, top),
+                      int(np.ceil((right - left) / res)), int(np.ceil((top - bottom) / res)))
+
+
+# Hệ số gộp nguyên nếu lưới đích là lưới thô của lưới nguồn (cùng CRS, cùng góc,
+# pixel đích gồm đúng factor x factor pixel nguồn); ngược lại trả về None
+def integer_factor(src_grid, grid):
+    if src_grid.crs != grid.crs:
+        return None
+    src, dst = src_grid.transform, grid.transform
+    if src.b or src.d or dst.b or dst.d:
+        return None
+    factor = dst.a / src.a
+    if factor < 1 or abs(factor - round(factor)) > 1e-9 or abs(dst.e / src.e - factor) > 1e-9:
+        return None
+    col, row = ~src * (dst.c, dst.f)
+    if abs(col) > 1e-6 or abs(row) > 1e-6:
+        return None
+    return int(round(factor))
+
+
+# Chia mảng (h, w, ...) thành các khối (h/f, w/f, f*f, ...); phần lẻ ở cạnh được đệm NaN
+def _blocks(data, factor):
+    rows, cols = data.shape[:2]
+    pad_rows, pad_cols = -rows % factor, -cols % factor
+    if pad_rows or pad_cols:
+        pad = [(0, pad_rows), (0, pad_cols)] + [(0, 0)] * (data.ndim - 2)
+        data = np.pad(data, pad, constant_values=np.nan)
+    rows, cols = data.shape[:2]
+    blocks = data.reshape(rows // factor, factor, cols // factor, factor, *data.shape[2:])
+    blocks = blocks.swapaxes(1, 2)
+    return blocks.reshape(rows // factor, cols // factor, factor * factor, *data.shape[2:])
+
+
+# Giá trị xuất hiện nhiều nhất trong từng khối (bỏ qua NaN); hòa thì lấy giá trị nhỏ hơn.
+# Dành cho lớp phân loại có ít lớp nên đếm theo từng lớp
+def _mode(blocks):
+    valid = ~np.isnan(blocks)
+    classes = np.unique(blocks[valid])
+    best = np.full(blocks.shape[:2] + blocks.shape[3:], np.nan, dtype=np.float32)
+    best_count = np.zeros(best.shape, dtype=np.int32)
+    for value in classes:
+        count = np.count_nonzero(blocks == value, axis=2)
+        better = count > best_count
+        best[better] = value
+        best_count[better] = count[better]
+    return best
+
+
+# Gộp mảng (h, w) hoặc (h, w, n_bands) theo khối factor x factor bằng reshape, bỏ qua NaN
+def block_reduce(data, factor, reducer='mean'):
+    if reducer not in REDUCERS:
+        raise ValueError(f"Phép gộp không hỗ trợ: {reducer}")
+    blocks = _blocks(np.asarray(data, dtype=np.float32), factor)
+    if reducer == 'mode':
+        return _mode(blocks)
+
+    valid = ~np.isnan(blocks)
+    count = np.count_nonzero(valid, axis=2)
+    if reducer == 'valid_fraction':
+        return (count / np.float32(factor * factor)).astype(np.float32)
+
+    total = np.where(valid, blocks, 0).sum(axis=2, dtype=np.float64)
+    mean = np.full(count.shape, np.nan, dtype=np.float32)
+    np.divide(total, count, out=mean, where=count > 0, casting='unsafe')
+    return mean
+
+
+# Gộp một mảng lớn (có thể là memmap) theo từng dải hàng; out là mảng kết quả
+# (có thể là memmap) kích thước lưới thô, được tạo mới nếu không truyền vào
+def aggregate_array(data, factor, reducer='mean', out=None, strip_pixels=STRIP_PIXELS):
+    rows, cols = data.shape[:2]
+    out_shape = (-(-rows // factor), -(-cols // factor), *data.shape[2:])
+    if out is None:
+        out = np.empty(out_shape, dtype=np.float32)
+    depth = int(np.prod(data.shape[2:], dtype=np.int64))
+    strip_rows = max(1, strip_pixels // (cols * depth * factor * factor))
+    for row in range(0, out_shape[0], strip_rows):
+        row_end = min(row + strip_rows, out_shape[0])
+        out[row:row_end] = block_reduce(data[row * factor:row_end * factor], factor, reducer)
+    return out
+
+
+# Gộp mảng (h, w) hoặc (h, w, n_bands) trên src_grid (có thể là memmap) lên lưới grid cùng CRS
+# khi không có hệ số gộp nguyên: warp trung bình/mode của GDAL theo từng dải hàng của lưới
+# đích, mỗi dải chỉ đọc các hàng nguồn nó phủ. out: mảng kết quả (có thể là memmap)
+def warp_array(data, src_grid, grid, reducer='mean', out=None, strip_pixels=STRIP_PIXELS):
+    from rasterio.warp import reproject
+
+    if reducer not in WARP_RESAMPLING:
+        raise ValueError(f"Phép gộp không hỗ trợ khi warp: {reducer}")
+    depth = int(np.prod(data.shape[2:], dtype=np.int64))
+    if out is None:
+        out = np.empty((grid.height, grid.width, *data.shape[2:]), dtype=np.float32)
+
+    scale = abs(grid.transform.e / src_grid.transform.e)
+    strip_rows = max(1, int(strip_pixels // (src_grid.width * depth * scale)))
+    for row in range(0, grid.height, strip_rows):
+        row_end = min(row + strip_rows, grid.height)
+        # Các hàng nguồn phủ dải [row, row_end) của lưới đích, thêm một hàng mỗi phía
+        top = grid.transform.f + row * grid.transform.e
+        bottom = grid.transform.f + row_end * grid.transform.e
+        src_rows = sorted((~src_grid.transform * (src_grid.transform.c, y))[1] for y in (top, bottom))
+        src_start = max(int(np.floor(src_rows[0])) - 1, 0)
+        src_end = min(int(np.ceil(src_rows[1])) + 1, src_grid.height)
+
+        source = np.asarray(data[src_start:src_end], dtype=np.float32)
+        source = source.reshape(src_end - src_start, src_grid.width, depth)
+        strip = np.full((depth, row_end - row, grid.width), np.nan, dtype=np.float32)
+        reproject(np.ascontiguousarray(source.transpose(2, 0, 1)), strip,
+                  src_transform=src_grid.transform * Affine.translation(0, src_start), src_crs=src_grid.crs,
+                  dst_transform=grid.transform * Affine.translation(0, row), dst_crs=grid.crs,
+                  src_nodata=np.nan, dst_nodata=np.nan, resampling=WARP_RESAMPLING[reducer])
+        out[row:row_end] = strip.transpose(1, 2, 0).reshape(row_end - row, grid.width, *data.shape[2:])
+    return out
+
+
+# Đọc một dải hàng của raster nguồn dưới dạng float32, nodata = NaN
+def _read_strip(src, row_start, row_end, width):
+    data = src.read(1, window=Window(0, row_start, width, row_end - row_start), masked=True)
+    return data.astype(np.float32).filled(np.nan)
+
+
+# Cắt hoặc đệm mảng 2D về đúng kích thước (rows, cols)
+def _fit(data, rows, cols, fill):
+    data = data[:rows, :cols]
+    if data.shape != (rows, cols):
+        data = np.pad(data, [(0, rows - data.shape[0]), (0, cols - data.shape[1])], constant_values=fill)
+    return data
+
+
+# Số pixel con mỗi cạnh để pixel con của lưới đích không lớn hơn pixel nguồn. Kích thước một
+# pixel đích (ở giữa lưới) được đổi sang CRS nguồn trước khi so sánh, vì hai lưới có thể khác
+# đơn vị (độ và mét)
+def subpixel_factor(src_grid, grid):
+    left, top = grid.transform * (grid.width // 2, grid.height // 2)
+    right, bottom = grid.transform * (grid.width // 2 + 1, grid.height // 2 + 1)
+    if src_grid.crs != grid.crs:
+        from rasterio.warp import transform_bounds
+        left, bottom, right, top = transform_bounds(grid.crs, src_grid.crs, min(left, right), min(bottom, top),
+                                                    max(left, right), max(bottom, top))
+    return max(1, int(np.ceil(max(abs(right - left) / abs(src_grid.transform.a),
+                                  abs(top - bottom) / abs(src_grid.transform.e)))))
+
+
+# Gộp raster nguồn lên lưới đích theo từng dải hàng và ghi GeoTIFF float32 (nodata = NaN).
+# Nếu lưới đích là bội số nguyên của lưới nguồn thì gộp bằng reshape; ngược lại mean/mode
+# dùng warp trung bình/mode của GDAL theo cửa sổ, valid_fraction được tính trên lưới mịn
+# trung gian (nearest) rồi gộp bằng reshape
+def aggregate_raster(path, out_path, grid, reducer='mean', strip_pixels=STRIP_PIXELS):
+    if reducer not in REDUCERS:
+        raise ValueError(f"Phép gộp không hỗ trợ: {reducer}")
+    profile = {
+        'driver': 'GTiff', 'height': grid.height, 'width': grid.width, 'count': 1,
+        'dtype': 'float32', 'nodata': np.nan, 'crs': grid.crs, 'transform': grid.transform,
+        'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate',
+    }
+
+    tmp_path = out_path + '.tmp'
+    with rasterio.open(path) as src, rasterio.open(tmp_path, 'w', **profile) as dst:
+        factor = integer_factor(grid_of(src), grid)
+        if factor is None and reducer == 'valid_fraction':
+            factor = subpixel_factor(grid_of(src), grid)
+            fine = grid._replace(transform=grid.transform * Affine.scale(1 / factor),
+                                 width=grid.width * factor, height=grid.height * factor)
+            source = WarpedVRT(src, crs=fine.crs, transform=fine.transform, width=fine.width,
+                               height=fine.height, resampling=Resampling.nearest)
+        elif factor is None:
+            source = WarpedVRT(src, crs=grid.crs, transform=grid.transform, width=grid.width,
+                               height=grid.height, resampling=WARP_RESAMPLING[reducer])
+        else:
+            source = src
+        scale = factor or 1
+
+        strip_rows = max(1, strip_pixels // (grid.width * scale * scale))
+        for row in range(0, grid.height, strip_rows):
+            row_end = min(row + strip_rows, grid.height)
+            data = _read_strip(source, row * scale, min(row_end * scale, source.height), source.width)
+            if factor is not None:
+                data = _fit(block_reduce(data, factor, reducer), row_end - row, grid.width,
+                            0 if reducer == 'valid_fraction' else np.nan)
+            dst.write(data, 1, window=Window(0, row, grid.width, row_end - row))
+        if source is not src:
+            source.close()
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gộp raster lên lưới thô (mean/mode/valid_fraction)")
+    parser.add_argument('src', help="Raster nguồn")
+    parser.add_argument('dst', help="GeoTIFF kết quả")
+    parser.add_argument('--res', type=float, default=100, help="Độ phân giải lưới thô (đơn vị của CRS)")
+    parser.add_argument('--crs', default=None, help="CRS lưới thô (mặc định giữ CRS nguồn)")
+    parser.add_argument('--reducer', choices=REDUCERS, default='mean')
+    args = parser.parse_args(argv)
+
+    with rasterio.open(args.src) as src:
+        grid = grid_at(grid_of(src), args.res, args.crs)
+    aggregate_raster(args.src, args.dst, grid, args.reducer)
+    print(f"Đã ghi {args.dst} ({grid.width} x {grid.height} pixel, {args.reducer})")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
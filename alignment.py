@@ -0,0 +1,139 @@
+import os
+import json
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from prediction import iter_windows
+from instrumentation import stage
+
+# Lưới đích chung cho mọi lớp dữ liệu: hệ tọa độ, phép biến đổi affine và kích thước
+TargetGrid = namedtuple('TargetGrid', ['crs', 'transform', 'width', 'height'])
+
+# Kernel nội suy mặc định cho từng loại lớp
+LAYER_RESAMPLING = {
+    'sentinel': Resampling.bilinear,  # Độ phản xạ: liên tục, nội suy song tuyến
+    'dem': Resampling.bilinear,
+    'slope': Resampling.bilinear,
+    'gedi': Resampling.average,  # AGBD: lấy trung bình các pixel nguồn
+    'worldcover': Resampling.mode,  # Lớp phủ: lớp chiếm đa số, giống Reducer.mode() trong skun.py
+}
+
+
+# Lưới của một raster có sẵn
+def grid_of(src):
+    return TargetGrid(src.crs, src.transform, src.width, src.height)
+
+
+# Kiểm tra raster đã nằm đúng trên lưới đích chưa
+def on_grid(src, grid):
+    return grid_of(src) == grid
+
+
+# Khóa cache của một file nguồn: đường dẫn, mtime, kích thước + các tham số xử lý
+def source_key(path, **params):
+    stat = os.stat(path)
+    params.update(path=os.path.abspath(path), mtime=stat.st_mtime, size=stat.st_size)
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+# Khóa cache của một lớp đã căn chỉnh: file nguồn + lưới đích + kernel nội suy
+def alignment_key(path, grid, resampling):
+    return source_key(path, crs=grid.crs.to_wkt(), transform=list(grid.transform)[:6],
+                      shape=[grid.height, grid.width], resampling=Resampling(resampling).name)
+
+
+# Chiếu lại và nội suy một raster lên lưới đích theo từng cửa sổ, kết quả float32
+# (nodata = NaN) được lưu trong cache_dir; các lần chạy sau dùng lại file đã có
+def align_raster(path, grid, resampling, cache_dir, block_size=2048):
+    with rasterio.open(path) as src:
+        if on_grid(src, grid):
+            return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    key = alignment_key(path, grid, resampling)
+    out_path = os.path.join(cache_dir, f"{stem}_{key[:16]}.tif")
+    if os.path.exists(out_path):
+        print(f"  Dùng lại lớp đã căn chỉnh: {os.path.basename(out_path)}")
+        return out_path
+
+    print(f"  Đang căn chỉnh {os.path.basename(path)} lên lưới chung "
+          f"({Resampling(resampling).name})...")
+    profile = {
+        'driver': 'GTiff', 'height': grid.height, 'width': grid.width, 'count': 1,
+        'dtype': 'float32', 'nodata': np.nan, 'crs': grid.crs, 'transform': grid.transform,
+        'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate',
+    }
+
+    # Ghi ra file tạm rồi đổi tên để không để lại cache dở dang khi bị ngắt
+    tmp_path = out_path + '.tmp'
+    with stage('align', grid.width * grid.height), rasterio.open(path) as src, \
+            WarpedVRT(src, crs=grid.crs, transform=grid.transform, width=grid.width,
+                      height=grid.height, resampling=resampling) as vrt, \
+            rasterio.open(tmp_path, 'w', **profile) as dst:
+        for row_start, row_end, col_start, col_end in iter_windows(grid.height, grid.width, block_size):
+            window = Window(col_start, row_start, col_end - col_start, row_end - row_start)
+            data = vrt.read(1, window=window, masked=True).astype(np.float32)
+            dst.write(data.filled(np.nan), 1, window=window)
+    os.replace(tmp_path, out_path)
+
+    return out_path
+
+
+# Đọc các lớp đã căn chỉnh lên lưới đích (DEM, độ dốc, GEDI) theo từng cửa sổ thay vì nạp cả
+# lưới vào RAM; pixel nodata hoặc nằm ngoài shapes (nếu có) được gán NaN.
+# files: {tên lớp: đường dẫn raster đã nằm trên lưới đích, xem align_raster}
+class AlignedReader:
+    def __init__(self, files, grid, shapes=None):
+        self.files = dict(files)
+        self.grid = grid
+        self.shapes = None if shapes is None else list(shapes)
+        self.datasets = {name: rasterio.open(path) for name, path in self.files.items()}
+        self.names = list(self.datasets)
+
+        for name, src in self.datasets.items():
+            if not on_grid(src, grid):
+                self.close()
+                raise ValueError(f"Lớp {name} không nằm trên lưới đích")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for src in self.datasets.values():
+            src.close()
+
+    # Đọc một cửa sổ (row_start, row_end, col_start, col_end), trả về {tên: mảng float32}.
+    # out: {tên: mảng (có thể là view của khối đặc trưng)} để ghi kết quả trực tiếp
+    def read(self, window, out=None):
+        out = {} if out is None else out
+        row_start, row_end, col_start, col_end = window
+        src_window = Window(col_start, row_start, col_end - col_start, row_end - row_start)
+        shape = (row_end - row_start, col_end - col_start)
+        pixels = shape[0] * shape[1]
+
+        outside = None
+        if self.shapes is not None:
+            with stage('mask', pixels):
+                outside = geometry_mask(self.shapes, out_shape=shape,
+                                        transform=rasterio.windows.transform(src_window, self.grid.transform))
+
+        for name, src in self.datasets.items():
+            with stage('read', pixels):
+                data = src.read(1, window=src_window, out_dtype='float32', masked=True)
+            with stage('mask', pixels):
+                if name not in out:
+                    out[name] = np.empty(shape, dtype=np.float32)
+                out[name][...] = data.filled(np.nan)
+                if outside is not None:
+                    out[name][outside] = np.nan
+        return {name: out[name] for name in self.names}
@@ -0,0 +1,363 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+from instrumentation import reset_peak_rss, peak_rss_mb, children_peak_rss_mb
+
+# Kích thước lưới 10 m có sẵn (pixel mỗi cạnh); 20k ~ một tỉnh như Gia Lai
+SIZES = {'1k': 1024, '2k': 2048, '5k': 5120, '10k': 10240, '20k': 20480}
+
+# Các band Sentinel-2 được sinh (đủ cho mọi chỉ số phổ mà local.py tính được)
+BANDS = ('B02', 'B03', 'B04', 'B08', 'B11')
+
+# Các bước được đo, theo thứ tự của local.main()
+STAGES = ('sentinel', 'dem', 'gedi', 'features', 'train', 'predict')
+
+# Mức suy giảm cho phép so với baseline trước khi báo hồi quy (tương đối)
+DEFAULT_TOLERANCE = 0.2
+
+# Các bước chạy ngắn hơn (giây) trong baseline chỉ được so sánh bộ nhớ, vì tốc độ quá nhiễu
+MIN_COMPARE_SECONDS = 1.0
+
+# Lưới giả lập: UTM 48N, gốc ở khu vực Gia Lai
+CRS = 'EPSG:32648'
+ORIGIN = (800000.0, 1600000.0)
+PIXEL_SIZE = 10.0
+DEM_PIXEL_SIZE = 30.0
+
+# Số hàng mỗi dải khi sinh dữ liệu, để bộ nhớ không phụ thuộc kích thước lưới
+STRIP_ROWS = 1024
+
+
+# Mật độ thực vật (0..1) theo tọa độ bản đồ: vài sóng không gian dài + nhiễu
+def _vegetation(x, y, rng):
+    v = (0.5 + 0.25 * np.sin(x / 3000) * np.cos(y / 4100) + 0.2 * np.sin((x + y) / 1700)
+         + rng.normal(0, 0.05, np.broadcast(x, y).shape))
+    return np.clip(v, 0, 1)
+
+
+# Độ cao (m) theo tọa độ bản đồ: địa hình cao nguyên 400-1000 m với đồi nhỏ
+def _elevation(x, y):
+    return 400 + 600 * (0.5 + 0.5 * np.sin(x / 20000) * np.cos(y / 26000)) + 80 * np.sin(x / 1500)
+
+
+# Độ phản xạ (x 10000) của từng band theo mật độ thực vật, gần với rừng/đất trống nhiệt đới
+REFLECTANCE = {
+    'B02': (600, -250), 'B03': (800, -200), 'B04': (900, -600),
+    'B08': (1800, 2200), 'B11': (2200, -900),
+}
+
+
+# Sinh một bộ dữ liệu giả lập theo bố cục thư mục Data của local.py:
+#   sentinel/S2_median_<band>_10m.tif (uint16), dem/glo30.tif (30 m, float32),
+#   gedi/gedi_agbd.tif (10 m, NaN trừ các footprint dọc theo quỹ đạo), vector/gialai.shp.
+# AGBD tại footprint phụ thuộc mật độ thực vật và độ cao nên mô hình học được quan hệ thật.
+# Dữ liệu được ghi theo dải hàng; bộ dữ liệu đã sinh được dùng lại (đánh dấu bằng file .complete)
+def make_dataset(root, size, seed=0):
+    import rasterio
+    import geopandas as gpd
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+    from shapely.geometry import Polygon
+
+    if os.path.exists(os.path.join(root, '.complete')):
+        return root
+    shutil.rmtree(root, ignore_errors=True)
+    for name in ('sentinel', 'dem', 'gedi', 'vector'):
+        os.makedirs(os.path.join(root, name))
+
+    x0, y0 = ORIGIN
+    transform = from_origin(x0, y0, PIXEL_SIZE, PIXEL_SIZE)
+    common = {'driver': 'GTiff', 'height': size, 'width': size, 'count': 1, 'crs': CRS,
+              'transform': transform, 'tiled': True, 'blockxsize': 512, 'blockysize': 512,
+              'compress': 'deflate', 'BIGTIFF': 'IF_SAFER'}
+    bands = {band: rasterio.open(os.path.join(root, 'sentinel', f"S2_median_{band}_10m.tif"), 'w',
+                                 dtype='uint16', nodata=0, **common) for band in BANDS}
+    gedi = rasterio.open(os.path.join(root, 'gedi', 'gedi_agbd.tif'), 'w', dtype='float32',
+                         nodata=np.nan, **common)
+    try:
+        cols = np.arange(size)
+        for row_start in range(0, size, STRIP_ROWS):
+            rows = np.arange(row_start, min(row_start + STRIP_ROWS, size))
+            rng = np.random.default_rng([seed, row_start])
+            x = x0 + (cols[None, :] + 0.5) * PIXEL_SIZE
+            y = y0 - (rows[:, None] + 0.5) * PIXEL_SIZE
+            v = _vegetation(x, y, rng)
+            window = Window(0, row_start, size, len(rows))
+
+            for band, (base, gain) in REFLECTANCE.items():
+                value = base + gain * v + rng.normal(0, 40, v.shape)
+                bands[band].write(np.clip(value, 1, 10000).astype('uint16'), 1, window=window)
+
+            # Footprint GEDI: các quỹ đạo gần bắc-nam cách nhau 600 m, footprint cách nhau 60 m
+            track = (cols[None, :] - 0.1 * rows[:, None]) % 60 < 1
+            footprint = track & (rows[:, None] % 6 == 0)
+            agbd = 20 + 250 * v ** 1.5 + 0.05 * (_elevation(x, y) - 400) + rng.normal(0, 15, v.shape)
+            gedi.write(np.where(footprint, np.maximum(agbd, 0), np.nan).astype('float32'), 1, window=window)
+    finally:
+        for dst in (*bands.values(), gedi):
+            dst.close()
+
+    # DEM 30 m phủ cùng vùng (lưới khác, như GLO-30 so với Sentinel-2)
+    dem_size = int(np.ceil(size * PIXEL_SIZE / DEM_PIXEL_SIZE))
+    dem_common = dict(common, height=dem_size, width=dem_size,
+                      transform=from_origin(x0, y0, DEM_PIXEL_SIZE, DEM_PIXEL_SIZE))
+    with rasterio.open(os.path.join(root, 'dem', 'glo30.tif'), 'w', dtype='float32', **dem_common) as dst:
+        cols = np.arange(dem_size)
+        for row_start in range(0, dem_size, STRIP_ROWS):
+            rows = np.arange(row_start, min(row_start + STRIP_ROWS, dem_size))
+            x = x0 + (cols[None, :] + 0.5) * DEM_PIXEL_SIZE
+            y = y0 - (rows[:, None] + 0.5) * DEM_PIXEL_SIZE
+            dst.write(_elevation(x, y).astype('float32'), 1,
+                      window=Window(0, row_start, dem_size, len(rows)))
+
+    # Ranh giới: đa giác lõm vào 2% so với biên, cắt một góc
+    extent = size * PIXEL_SIZE
+    inset = 0.02 * extent
+    boundary = Polygon([(x0 + inset, y0 - inset), (x0 + extent - inset, y0 - inset),
+                        (x0 + extent - inset, y0 - 0.6 * extent), (x0 + 0.6 * extent, y0 - extent + inset),
+                        (x0 + inset, y0 - extent + inset)])
+    gpd.GeoDataFrame({'name': ['Gia Lai (giả lập)']}, geometry=[boundary], crs=CRS).to_file(
+        os.path.join(root, 'vector', 'gialai.shp'))
+
+    open(os.path.join(root, '.complete'), 'w').close()
+    return root
+
+
+# Chạy một bước và ghi lại thời gian, số pixel/giây, đỉnh RSS. pixels có thể là hàm nhận
+# kết quả của bước khi chỉ biết số pixel sau khi chạy (ví dụ kích thước lưới, số mẫu)
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def count(self, name, pixels):
+        stage = self.stages[name]
+        stage['pixels'] = pixels
+        stage['pixels_per_s'] = pixels / stage['seconds'] if stage['seconds'] > 0 else float('inf')
+
+    def run(self, name, pixels, func, *args, **kwargs):
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.stages[name] = {
+            'seconds': time.perf_counter() - start,
+            'peak_rss_mb': peak_rss_mb(),
+            'children_peak_rss_mb': children_peak_rss_mb(),
+        }
+        self.count(name, pixels(result) if callable(pixels) else pixels)
+        stage = self.stages[name]
+        print(f"  {name:<9} {stage['seconds']:>8.2f} giây  {stage['pixels_per_s']:>14,.0f} pixel/giây  "
+              f"đỉnh RSS {stage['peak_rss_mb']:>8,.0f} MB")
+        return result
+
+
+# Chạy các bước của local.py trên một bộ dữ liệu, với cache trống. Trả về kết quả đo
+def run_pipeline(data_dir, out_dir, workers=None, predictor='sklearn', block_size=1024):
+    import joblib
+    import rasterio
+    import geopandas as gpd
+    import local
+    from alignment import TargetGrid, LAYER_RESAMPLING, AlignedReader, align_raster
+    from feature_cache import FeatureCache
+    from forest_kernel import FlatForest
+    from prediction import predict_to_raster
+    from raster_output import BiomassWriter
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    local.data_dir = data_dir
+    local.output_dir = out_dir
+    local.cache_dir = os.path.join(out_dir, 'cache')
+    os.makedirs(local.cache_dir)
+
+    timer = StageTimer()
+    paths = local.input_paths()
+    gialai = gpd.read_file(paths['vector'])
+
+    reader, meta, transform = timer.run('sentinel', lambda result: int(np.prod(result[0].shape)),
+                                        local.process_sentinel, gialai)
+    rows, cols = reader.shape
+    pixels = rows * cols
+    grid = TargetGrid(meta['crs'], transform, cols, rows)
+
+    layers, _, _ = timer.run('dem', pixels, local.process_dem, gialai, grid)
+    gedi_path = timer.run('gedi', pixels, align_raster, paths['gedi'], grid, LAYER_RESAMPLING['gedi'],
+                          local.cache_dir)
+    gedi_layer = AlignedReader({'gedi': gedi_path}, grid, gialai.geometry.to_crs(grid.crs))
+
+    feature_cache = FeatureCache(os.path.join(local.cache_dir, 'features'))
+    names = reader.names + layers.names
+    cube, gedi = feature_cache.create('benchmark', reader.shape, names)
+    timer.run('features', pixels, local.build_feature_cube, reader, layers, cube=cube,
+              gedi_layer=gedi_layer, gedi=gedi)
+    for source in (reader, layers, gedi_layer):
+        source.close()
+    cube.flush()
+    gedi.flush()
+    del cube, gedi
+    feature_cache.commit('benchmark', {'names': names})
+    cube, gedi, _ = feature_cache.load('benchmark')
+
+    # Tốc độ huấn luyện tính theo số mẫu huấn luyện thay vì số pixel của lưới
+    model, report = timer.run('train', lambda result: result[1]['n_samples'], local.train_model, cube, gedi)
+
+    model_path = os.path.join(out_dir, 'model.joblib')
+    joblib.dump(model, model_path)
+    if predictor == 'flat':
+        forest_path = os.path.join(out_dir, 'forest')
+        FlatForest.from_sklearn(model).save(forest_path)
+        model, model_path = FlatForest.load(forest_path), forest_path
+
+    output_file = os.path.join(out_dir, 'sinh_khoi.tif')
+
+    def predict():
+        with BiomassWriter(output_file, grid.crs, grid.transform, cols, rows) as writer:
+            return predict_to_raster(model, cube, names.index('slope'), writer, model_path=model_path,
+                                     block_size=block_size, workers=workers)
+
+    timer.run('predict', pixels, predict)
+    return {'pixels': pixels, 'rmse': report['rmse'], 'stages': timer.stages,
+            'output_bytes': os.path.getsize(output_file)}
+
+
+def _run_child(data_dir, out_dir, workers, predictor, block_size, result_path):
+    result = run_pipeline(data_dir, out_dir, workers, predictor, block_size)
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Đo một kích thước trong một tiến trình riêng để đỉnh RSS không bị ảnh hưởng bởi lần đo trước
+def benchmark_size(label, work_dir, seed=0, workers=None, predictor='sklearn', block_size=1024):
+    size = SIZES[label]
+    data_dir = os.path.join(work_dir, f"data_{label}_{seed}")
+    print(f"\n[{label}] Lưới {size:,} x {size:,} pixel")
+    start = time.perf_counter()
+    make_dataset(data_dir, size, seed)
+    print(f"  Dữ liệu giả lập: {data_dir} ({time.perf_counter() - start:.1f} giây)")
+
+    result_path = os.path.join(work_dir, f"result_{label}.json")
+    process = multiprocessing.get_context('spawn').Process(
+        target=_run_child, args=(data_dir, os.path.join(work_dir, f"out_{label}"), workers,
+                                 predictor, block_size, result_path))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Lần đo {label} thất bại (mã thoát {process.exitcode})")
+    with open(result_path, encoding='utf-8') as f:
+        result = json.load(f)
+
+    return dict(result, size=label, time=time.strftime('%Y-%m-%dT%H:%M:%S'), commit=_git_commit(),
+                host=socket.gethostname(), cpu_count=os.cpu_count(), workers=workers or os.cpu_count(),
+                predictor=predictor, seed=seed)
+
+
+# So sánh một kết quả với baseline cùng kích thước: pixel/giây giảm hoặc đỉnh RSS (của tiến
+# trình chính hay của các worker dự đoán) tăng quá tolerance đều là hồi quy. Trả về danh sách
+# mô tả các hồi quy
+def compare(result, baseline, tolerance=DEFAULT_TOLERANCE):
+    regressions = []
+    for stage in STAGES:
+        base, current = baseline['stages'].get(stage), result['stages'].get(stage)
+        if base is None or current is None:
+            continue
+        if (base['seconds'] >= MIN_COMPARE_SECONDS
+                and current['pixels_per_s'] < base['pixels_per_s'] * (1 - tolerance)):
+            regressions.append(f"{result['size']}/{stage}: {current['pixels_per_s']:,.0f} pixel/giây "
+                               f"< baseline {base['pixels_per_s']:,.0f}")
+        for key, label in (('peak_rss_mb', 'đỉnh RSS'), ('children_peak_rss_mb', 'đỉnh RSS tiến trình con')):
+            if key in base and current[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{result['size']}/{stage}: {label} {current[key]:,.0f} MB "
+                                   f"> baseline {base[key]:,.0f} MB")
+    if result['output_bytes'] > baseline['output_bytes'] * (1 + tolerance):
+        regressions.append(f"{result['size']}: đầu ra {result['output_bytes']:,} byte "
+                           f"> baseline {baseline['output_bytes']:,} byte")
+    return regressions
+
+
+def _load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def main(argv=None):
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Đo hiệu năng pipeline sinh khối trên dữ liệu giả lập")
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['1k'],
+                        help="Các kích thước lưới cần đo (pixel mỗi cạnh)")
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'gialai_benchmark'),
+                        help="Thư mục chứa dữ liệu giả lập (được dùng lại) và kết quả tạm")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help="Số tiến trình dự đoán (mặc định: số CPU)")
+    parser.add_argument('--predictor', choices=('sklearn', 'flat'), default='sklearn',
+                        help="Bộ dự đoán, như --predictor của local.py (mặc định: sklearn)")
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--history', default=None,
+                        help="File JSON lưu lịch sử các lần đo, được nối thêm "
+                             "(mặc định: <work-dir>/benchmark_history.json)")
+    parser.add_argument('--baseline', default=None,
+                        help="File JSON baseline để so sánh (mặc định: <work-dir>/benchmark_baseline.json)")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Mức suy giảm cho phép so với baseline (0.2 = 20%%)")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="Ghi kết quả lần đo này làm baseline thay vì so sánh")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    args.history = args.history or os.path.join(args.work_dir, 'benchmark_history.json')
+    args.baseline = args.baseline or os.path.join(args.work_dir, 'benchmark_baseline.json')
+    history = _load_json(args.history, [])
+    baseline = _load_json(args.baseline, {})
+    regressions = []
+
+    for label in args.sizes:
+        result = benchmark_size(label, args.work_dir, args.seed, args.workers, args.predictor, args.block_size)
+        history.append(result)
+        _write_json(args.history, history)
+        if args.update_baseline:
+            baseline[label] = result
+        elif label in baseline:
+            regressions += compare(result, baseline[label], args.tolerance)
+        else:
+            print(f"  Chưa có baseline cho {label} (chạy với --update-baseline để tạo)")
+
+    if args.update_baseline:
+        _write_json(args.baseline, baseline)
+        print(f"\nĐã cập nhật baseline: {args.baseline}")
+    print(f"Lịch sử đo: {args.history}")
+
+    if regressions:
+        print("\n" + "!" * 80)
+        print(f"HỒI QUY HIỆU NĂNG ({len(regressions)}):")
+        for regression in regressions:
+            print(f"  - {regression}")
+        print("!" * 80)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
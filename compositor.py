@@ -0,0 +1,208 @@
+import os
+import re
+import sys
+import time
+import argparse
+import datetime
+import warnings
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from alignment import TargetGrid
+from prediction import iter_windows
+from sentinel_reader import REFLECTANCE_SCALE
+from spectral_indices import INDICES, compute_indices
+
+# Ngưỡng Cloud Score+ giống maskLowQA trong skun.py: giữ pixel có cs >= 0.5
+CS_THRESHOLD = 0.5
+
+# Các band được tổng hợp mặc định (giống bands trong download_data.py)
+DEFAULT_BANDS = ('B02', 'B03', 'B04', 'B08', 'B11')
+
+BAND_PATTERN = re.compile(r'_(B\d{2}|B8A)[_.]')
+CS_PATTERN = re.compile(r'(^|_)cs([_.]|$)', re.IGNORECASE)
+DATE_PATTERN = re.compile(r'(20\d{6})')
+
+
+# Tìm các cảnh trong scenes_dir: mỗi thư mục con là một cảnh gồm các file band
+# (..._B04_10m.jp2) và một raster Cloud Score+ (tên chứa "_cs"), ngày lấy từ tên thư mục.
+# Chỉ giữ cảnh trong khoảng [start, end) giống filterDate của Earth Engine
+def find_scenes(scenes_dir, start, end, bands=DEFAULT_BANDS):
+    scenes = []
+    for name in sorted(os.listdir(scenes_dir)):
+        scene_dir = os.path.join(scenes_dir, name)
+        match = DATE_PATTERN.search(name)
+        if not os.path.isdir(scene_dir) or not match:
+            continue
+        date = datetime.datetime.strptime(match.group(1), '%Y%m%d').date()
+        if not start <= date < end:
+            continue
+
+        files = {}
+        for f in os.listdir(scene_dir):
+            if not f.endswith(('.tif', '.jp2')):
+                continue
+            band = BAND_PATTERN.search(f)
+            if band and band.group(1) in bands:
+                files[band.group(1)] = os.path.join(scene_dir, f)
+            elif CS_PATTERN.search(os.path.splitext(f)[0]):
+                files['cs'] = os.path.join(scene_dir, f)
+
+        missing = [band for band in (*bands, 'cs') if band not in files]
+        if missing:
+            print(f"  Bỏ qua cảnh {name}: thiếu {', '.join(missing)}")
+            continue
+        scenes.append({'name': name, 'date': date, 'files': files})
+    return scenes
+
+
+# Lưới đích phủ vùng nghiên cứu với độ phân giải res trong hệ tọa độ crs
+def grid_from_geometry(geometry, crs, res):
+    left, bottom, right, top = geometry.to_crs(crs).total_bounds
+    left, top = np.floor(left / res) * res, np.ceil(top / res) * res
+    width = int(np.ceil((right - left) / res))
+    height = int(np.ceil((top - bottom) / res))
+    return TargetGrid(rasterio.crs.CRS.from_user_input(crs), from_origin(left, top, res, res), width, height)
+
+
+# Các file nguồn đã mở trong tiến trình worker, chiếu lên lưới đích qua WarpedVRT
+_open_sources = {}
+
+
+def _source(path, grid):
+    if path not in _open_sources:
+        src = rasterio.open(path)
+        if (src.crs, src.transform, src.width, src.height) != tuple(grid):
+            src = WarpedVRT(src, crs=grid.crs, transform=grid.transform, width=grid.width,
+                            height=grid.height, resampling=Resampling.bilinear)
+        _open_sources[path] = src
+    return _open_sources[path]
+
+
+# Đọc một band của mọi cảnh trong cửa sổ thành mảng (n_scenes, h, w) float32,
+# pixel không có dữ liệu là NaN
+def _read_stack(scenes, band, grid, window):
+    row_start, row_end, col_start, col_end = window
+    rio_window = Window(col_start, row_start, col_end - col_start, row_end - row_start)
+    stack = np.empty((len(scenes), row_end - row_start, col_end - col_start), dtype=np.float32)
+    for k, scene in enumerate(scenes):
+        data = _source(scene['files'][band], grid).read(1, window=rio_window, masked=True)
+        stack[k] = data.astype(np.float32).filled(np.nan)
+    return stack
+
+
+# Tổng hợp một cửa sổ: che mây theo Cloud Score+, scale độ phản xạ, tính chỉ số cho
+# từng cảnh rồi lấy trung vị theo thời gian (bỏ qua NaN)
+def composite_window(window, scenes, grid, bands, indices):
+    clear = _read_stack(scenes, 'cs', grid, window) >= CS_THRESHOLD
+
+    reflectance = {}
+    for band in bands:
+        stack = _read_stack(scenes, band, grid, window)
+        stack[~clear | (stack == 0)] = np.nan
+        stack *= np.float32(REFLECTANCE_SCALE)
+        reflectance[band] = stack
+
+    layers = dict(reflectance)
+    layers.update(compute_indices(reflectance, indices))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # Pixel bị mây ở mọi cảnh
+        medians = {name: np.nanmedian(stack, axis=0).astype(np.float32) for name, stack in layers.items()}
+    return window, medians
+
+
+# Tạo ảnh tổng hợp trung vị cho toàn bộ lưới, xử lý song song theo cửa sổ.
+# Bộ nhớ tỉ lệ với (kích thước cửa sổ x số cảnh), không phụ thuộc kích thước vùng.
+# Band được ghi dưới dạng DN uint16 (nodata 0) để dùng trực tiếp làm đầu vào Sentinel-2
+# của local.py; chỉ số được ghi dạng float32 trong thư mục con indices/
+def build_composite(scenes, grid, out_dir, bands=DEFAULT_BANDS, indices=(), block_size=512, workers=None):
+    os.makedirs(out_dir, exist_ok=True)
+    res = int(round(abs(grid.transform.a)))
+    profile = {
+        'driver': 'GTiff', 'height': grid.height, 'width': grid.width, 'count': 1,
+        'crs': grid.crs, 'transform': grid.transform,
+        'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate',
+    }
+
+    outputs = {}
+    for band in bands:
+        path = os.path.join(out_dir, f"S2_median_{band}_{res}m.tif")
+        outputs[band] = rasterio.open(path, 'w', dtype='uint16', nodata=0, predictor=2, **profile)
+    if indices:
+        os.makedirs(os.path.join(out_dir, "indices"), exist_ok=True)
+    for name in indices:
+        path = os.path.join(out_dir, "indices", f"S2_median_{name}_{res}m.tif")
+        outputs[name] = rasterio.open(path, 'w', dtype='float32', nodata=np.nan, predictor=3, **profile)
+
+    def write(window, medians):
+        row_start, row_end, col_start, col_end = window
+        rio_window = Window(col_start, row_start, col_end - col_start, row_end - row_start)
+        for name, data in medians.items():
+            if name in bands:
+                data = np.where(np.isnan(data), 0, np.clip(np.round(data / REFLECTANCE_SCALE), 1, 65535))
+            outputs[name].write(data.astype(outputs[name].dtypes[0]), 1, window=rio_window)
+
+    windows = list(iter_windows(grid.height, grid.width, block_size))
+    workers = workers or os.cpu_count()
+    print(f"  Tổng hợp {len(scenes)} cảnh, {len(windows)} cửa sổ với {workers} tiến trình...")
+    start = time.perf_counter()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for window in windows:
+                pending.add(executor.submit(composite_window, window, scenes, grid, bands, indices))
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write(*future.result())
+            for future in pending:
+                write(*future.result())
+    finally:
+        for dst in outputs.values():
+            dst.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"  Hoàn tất trong {elapsed:.1f} giây "
+          f"({grid.width * grid.height / elapsed:,.0f} pixel/giây)")
+    return {name: dst.name for name, dst in outputs.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tổng hợp trung vị Sentinel-2 cục bộ có che mây Cloud Score+")
+    parser.add_argument('scenes_dir', help="Thư mục chứa các cảnh (mỗi cảnh một thư mục con)")
+    parser.add_argument('out_dir', help="Thư mục ghi ảnh tổng hợp, ví dụ <data_dir>/sentinel")
+    parser.add_argument('--start', default='2022-10-10')
+    parser.add_argument('--end', default='2023-10-10')
+    parser.add_argument('--vector', default='shapefile/gia_lai.shp', help="Ranh giới vùng nghiên cứu")
+    parser.add_argument('--crs', default='EPSG:32648')
+    parser.add_argument('--res', type=float, default=10)
+    parser.add_argument('--bands', nargs='+', default=list(DEFAULT_BANDS))
+    parser.add_argument('--indices', nargs='*', default=[], choices=list(INDICES),
+                        help="Chỉ số lấy trung vị theo từng cảnh như addIndices + median()")
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    import geopandas as gpd
+
+    start = datetime.date.fromisoformat(args.start)
+    end = datetime.date.fromisoformat(args.end)
+    scenes = find_scenes(args.scenes_dir, start, end, args.bands)
+    if not scenes:
+        print("Không tìm thấy cảnh nào trong khoảng thời gian")
+        return 1
+
+    grid = grid_from_geometry(gpd.read_file(args.vector).geometry, args.crs, args.res)
+    build_composite(scenes, grid, args.out_dir, args.bands, args.indices, args.block_size, args.workers)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,8 @@ import ee
 import os
 import geemap
 import datetime
-import time
+
+from ee_export import Exporter
 
 # Khởi tạo Earth Engine API
 ee.Initialize(project='ee-bonglantrungmuoi')
@@ -68,58 +69,16 @@ def addIndices(image):
 s2Processed = filteredS2WithCs.map(maskLowQA).select('B.*').map(scaleBands).map(addIndices)
 s2Composite = s2Processed.median()
 
-# Export dữ liệu Sentinel-2 vào Google Drive
-print("  Đang chuẩn bị export dữ liệu Sentinel-2...")
+# Band Sentinel-2 và chỉ số được export (xuất cùng DEM và độ dốc thành một ảnh nhiều band)
 bands = ['B2', 'B3', 'B4', 'B8', 'B11', 'ndvi', 'evi', 'mndwi', 'ndbi']
 scale = 100  # Sử dụng độ phân giải thấp hơn để giảm kích thước
 
-for band in bands:
-    print(f"    Đang export band {band}...")
-    band_data = s2Composite.select(band)
-    
-    # Export sang Google Drive
-    task = ee.batch.Export.image.toDrive(
-        image=band_data.clip(geometry),
-        description=f'sentinel2_{band}',
-        folder=folder_name,
-        region=geometry.geometry().bounds(),
-        scale=scale,
-        maxPixels=1e9
-    )
-    task.start()
-    print(f"    Đã bắt đầu export {band} vào Google Drive (theo dõi tại https://code.earthengine.google.com/tasks)")
-
 # 3. Export dữ liệu DEM
 print("\n[3/4] Đang xử lý dữ liệu DEM...")
 glo30 = ee.ImageCollection('COPERNICUS/DEM/GLO30')
 elevation = glo30.select('DEM').filterBounds(geometry).mosaic()
 slope = ee.Terrain.slope(elevation)
 
-# Export DEM và Slope vào Google Drive
-print("  Đang export DEM...")
-task_dem = ee.batch.Export.image.toDrive(
-    image=elevation.clip(geometry),
-    description='dem',
-    folder=folder_name,
-    region=geometry.geometry().bounds(),
-    scale=100,
-    maxPixels=1e9
-)
-task_dem.start()
-print("  Đã bắt đầu export DEM vào Google Drive")
-
-print("  Đang export Slope...")
-task_slope = ee.batch.Export.image.toDrive(
-    image=slope.clip(geometry),
-    description='slope',
-    folder=folder_name,
-    region=geometry.geometry().bounds(),
-    scale=100,
-    maxPixels=1e9
-)
-task_slope.start()
-print("  Đã bắt đầu export Slope vào Google Drive")
-
 # 4. Export dữ liệu GEDI
 print("\n[4/4] Đang xử lý dữ liệu GEDI...")
 gedi = ee.ImageCollection("LARSE/GEDI/GEDI04_A_002_MONTHLY")
@@ -139,41 +98,51 @@ def errorMask(image):
 gediProcessed = gediFiltered.map(qualityMask).map(errorMask)
 gediMosaic = gediProcessed.mosaic().select('agbd')
 
-# Export GEDI vào Google Drive
-print("  Đang export GEDI...")
-task_gedi = ee.batch.Export.image.toDrive(
-    image=gediMosaic.clip(geometry),
-    description='gedi_agbd',
-    folder=folder_name,
-    region=geometry.geometry().bounds(),
-    scale=500,  # GEDI có độ phân giải thấp
-    maxPixels=1e9
+# Export: composite Sentinel-2 + DEM + độ dốc thành một ảnh nhiều band (median chỉ được
+# tính một lần phía server), GEDI riêng ở 500 m. Vùng lớn được chia thành các mảnh để
+# không vượt maxPixels; manifest ghi lại các mảnh để ghép lại sau khi tải về
+print("\nĐang khởi chạy các task export...")
+region = geometry.geometry().bounds().getInfo()['coordinates'][0]
+lons, lats = [p[0] for p in region], [p[1] for p in region]
+bounds = (min(lons), min(lats), max(lons), max(lats))
+
+exporter = Exporter(folder_name)
+# Band Sentinel-2 được đưa về DN (bỏ hệ số 0.0001 của scaleBands) và tách thành uint16
+# nodata 0 như compositor.py, vì SentinelReader của local.py tự nhân REFLECTANCE_SCALE
+s2_bands = [b for b in bands if b.startswith('B')]
+composite = (s2Composite.select(s2_bands).multiply(10000).round()
+             .addBands(s2Composite.select([b for b in bands if b not in s2_bands]))
+             .addBands(elevation.rename('dem')).addBands(slope.rename('slope')))
+exporter.export(
+    'sentinel', composite.clip(geometry), bounds, scale, bands + ['dem', 'slope'],
+    # Bố cục thư mục Data mà local.py đọc (B2 -> sentinel/S2_median_B02_100m.tif)
+    outputs={**{b: f"sentinel/S2_median_B{int(b[1:]):02d}_{scale}m.tif" for b in s2_bands},
+             'dem': "dem/glo30.tif"},
+    dtypes={b: 'uint16' for b in s2_bands},
 )
-task_gedi.start()
-print("  Đã bắt đầu export GEDI vào Google Drive")
+exporter.export('gedi', gediMosaic.clip(geometry), bounds, 500, ['agbd'],  # GEDI có độ phân giải thấp
+                outputs={'agbd': "gedi/gedi_agbd.tif"})
 
-print("\n=== HOÀN TẤT CHUẨN BỊ EXPORT TASKS ===")
+manifest_path = os.path.join(data_dir, f"{folder_name}_manifest.json")
+exporter.write_manifest(manifest_path)
+
+print("\n=== ĐÃ KHỞI CHẠY CÁC TASK EXPORT ===")
 print(f"Tất cả dữ liệu đang được export vào Google Drive, thư mục: {folder_name}")
+print(f"Manifest: {manifest_path}")
 print("Bạn có thể theo dõi tiến trình export tại: https://code.earthengine.google.com/tasks")
-print("Sau khi tất cả các task hoàn thành, hãy tải dữ liệu từ Google Drive về thư mục Data")
-print("Lưu ý: Quá trình export có thể mất 10-30 phút tùy thuộc vào kích thước dữ liệu và tải của server GEE")
-
-# Kiểm tra trạng thái các task
-print("\nĐang kiểm tra trạng thái các task export (sẽ kiểm tra trong 60 giây)...")
-tasks = [task, task_dem, task_slope, task_gedi]
-task_names = ['Sentinel-2', 'DEM', 'Slope', 'GEDI']
-
-# Kiểm tra trong 60 giây
-for i in range(6):
-    print(f"\nLần kiểm tra {i+1}/6 (sau {i*10} giây):")
-    for j, task in enumerate(tasks):
-        status = task.status()
-        state = status.get('state', 'UNKNOWN')
-        print(f"  - {task_names[j]}: {state}")
-    
-    if i < 5:  # Không cần sleep ở lần cuối
-        time.sleep(10)  # Chờ 10 giây
 
-print("\nQuá trình kiểm tra kết thúc. Các task sẽ tiếp tục chạy trên máy chủ GEE.")
-print("Vui lòng truy cập https://code.earthengine.google.com/tasks để xem trạng thái chi tiết.")
-print("Sau khi tất cả task hoàn thành, hãy tải xuống dữ liệu từ Google Drive vào thư mục Data.")
\ No newline at end of file
+# Theo dõi đồng thời mọi task cho tới khi kết thúc (Ctrl+C để dừng theo dõi, các task vẫn
+# tiếp tục chạy trên máy chủ GEE)
+print("\nĐang theo dõi trạng thái các task export...")
+try:
+    states = exporter.monitor()
+except KeyboardInterrupt:
+    states = {shard['prefix']: shard['state'] for shard in exporter.shards()}
+    print("\nDừng theo dõi. Các task sẽ tiếp tục chạy trên máy chủ GEE.")
+exporter.write_manifest(manifest_path)
+
+failed = [prefix for prefix, state in states.items() if state in ('FAILED', 'CANCELLED')]
+if failed:
+    print(f"\nCác task không thành công: {', '.join(failed)}")
+print("\nSau khi tất cả task hoàn thành, tải các file .tif trong thư mục Google Drive về máy rồi ghép bằng:")
+print(f"  python ee_export.py {manifest_path} <thư mục chứa file tải về> {data_dir} --extract")
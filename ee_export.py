@@ -0,0 +1,303 @@
+import os
+import sys
+import glob
+import json
+import math
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+# Giới hạn maxPixels truyền cho mỗi task export
+MAX_PIXELS = 1e9
+
+# Số pixel tối đa của một mảnh (shard): 5000 x 5000 pixel, nhỏ hơn nhiều so với maxPixels và
+# đủ nhỏ để GEE không tự chia một mảnh nhiều band thành nhiều file
+SHARD_PIXELS = 25_000_000
+
+# Giá trị nodata ghi vào GeoTIFF export (pixel bị mask)
+NODATA = -9999.0
+
+# Số mét trên một độ vĩ tuyến, dùng để đổi scale (mét) sang kích thước pixel (độ)
+METERS_PER_DEGREE = 111320.0
+
+# Trạng thái kết thúc của task Earth Engine
+TERMINAL_STATES = ('COMPLETED', 'FAILED', 'CANCELLED')
+
+
+# Lưới export trong EPSG:4326 bao phủ bounds (xmin, ymin, xmax, ymax) với pixel scale mét;
+# bước kinh độ được chia cho cos(vĩ độ) ở tâm vùng để pixel có cạnh scale mét theo cả hai
+# chiều. Gốc lưới được làm tròn theo bội số kích thước pixel để các mảnh khớp nhau từng pixel
+def export_grid(bounds, scale):
+    xmin, ymin, xmax, ymax = bounds
+    ysize = scale / METERS_PER_DEGREE
+    xsize = ysize / math.cos(math.radians((ymin + ymax) / 2))
+    x0 = math.floor(xmin / xsize) * xsize
+    y0 = math.ceil(ymax / ysize) * ysize
+    return {
+        'crs': 'EPSG:4326',
+        'transform': [xsize, 0, x0, 0, -ysize, y0],
+        'width': max(1, math.ceil((xmax - x0) / xsize)),
+        'height': max(1, math.ceil((y0 - ymin) / ysize)),
+    }
+
+
+# Chia lưới thành các mảnh vuông tối đa shard_pixels pixel; mỗi mảnh có vị trí (col_off,
+# row_off), kích thước và bounds đúng theo biên pixel của lưới
+def shard_grid(grid, shard_pixels=SHARD_PIXELS):
+    xsize, _, x0, _, ysize, y0 = grid['transform']
+    ysize = -ysize
+    side = max(1, int(math.sqrt(shard_pixels)))
+    shards = []
+    for row_off in range(0, grid['height'], side):
+        for col_off in range(0, grid['width'], side):
+            width = min(side, grid['width'] - col_off)
+            height = min(side, grid['height'] - row_off)
+            shards.append({
+                'col_off': col_off, 'row_off': row_off, 'width': width, 'height': height,
+                'bounds': [x0 + col_off * xsize, y0 - (row_off + height) * ysize,
+                           x0 + (col_off + width) * xsize, y0 - row_off * ysize],
+            })
+    return shards
+
+
+# Điều phối export từ Earth Engine: mỗi sản phẩm là một ảnh nhiều band được chia thành
+# các mảnh theo lưới chung, mỗi mảnh một task Export.image.toDrive. monitor() theo dõi
+# đồng thời mọi task với thời gian chờ tăng dần; manifest ghi lại lưới, các mảnh và trạng
+# thái để bước sau (assemble) ghép các file tải về thành VRT. ee_module/batch cho phép
+# thay thế module ee và ee.batch (ví dụ bằng module giả khi kiểm thử)
+class Exporter:
+    def __init__(self, folder, ee_module=None, batch=None, max_pixels=MAX_PIXELS,
+                 shard_pixels=SHARD_PIXELS):
+        if ee_module is None:
+            import ee as ee_module
+        self.ee = ee_module
+        self.batch = batch if batch is not None else ee_module.batch
+        self.folder = folder
+        self.max_pixels = max_pixels
+        self.shard_pixels = min(shard_pixels, max_pixels)
+        self.products = {}
+        self.tasks = {}
+
+    # Khởi chạy các task export cho một ảnh. bands: tên band theo thứ tự trong ảnh;
+    # outputs: {band: đường dẫn tương đối} cho các band cần tách thành file riêng khi ghép;
+    # dtypes: {band: kiểu dữ liệu} của file tách ra (mặc định float32, xem extract_band)
+    def export(self, name, image, bounds, scale, bands, outputs=None, dtypes=None):
+        grid = export_grid(bounds, scale)
+        shards = shard_grid(grid, self.shard_pixels)
+        image = image.select(list(bands)).toFloat()
+        for i, shard in enumerate(shards):
+            prefix = f"{name}_{i:04d}" if len(shards) > 1 else name
+            region = self.ee.Geometry.Rectangle(shard['bounds'], 'EPSG:4326', False)
+            task = self.batch.Export.image.toDrive(
+                image=image,
+                description=prefix,
+                folder=self.folder,
+                fileNamePrefix=prefix,
+                region=region,
+                crs=grid['crs'],
+                crsTransform=grid['transform'],
+                maxPixels=self.max_pixels,
+                fileFormat='GeoTIFF',
+                formatOptions={'noData': NODATA},
+            )
+            task.start()
+            self.tasks[prefix] = task
+            shard.update(prefix=prefix, task_id=getattr(task, 'id', None), state='READY', error=None)
+
+        self.products[name] = dict(grid, scale=scale, bands=list(bands), outputs=outputs or {},
+                                   dtypes=dtypes or {}, shards=shards)
+        print(f"  Đã khởi chạy {len(shards)} task export cho {name} "
+              f"({grid['width']} x {grid['height']} pixel, {len(bands)} band)")
+        return shards
+
+    def shards(self):
+        for product in self.products.values():
+            yield from product['shards']
+
+    def _status(self, prefix):
+        try:
+            return prefix, self.tasks[prefix].status(), None
+        except Exception as e:
+            return prefix, None, e
+
+    # Theo dõi mọi task chưa kết thúc: mỗi vòng hỏi trạng thái đồng thời trên thread pool,
+    # sau đó chờ delay giây; delay nhân đôi sau mỗi vòng không có thay đổi (tối đa max_delay)
+    # và trở về initial_delay khi có task đổi trạng thái. Dừng khi mọi task kết thúc hoặc
+    # quá timeout giây; trả về {prefix: trạng thái}
+    def monitor(self, initial_delay=5, max_delay=300, timeout=None, max_workers=16,
+                sleep=time.sleep, clock=time.monotonic):
+        shards = {shard['prefix']: shard for shard in self.shards()}
+        start = clock()
+        delay = initial_delay
+        while True:
+            active = [prefix for prefix, shard in shards.items() if shard['state'] not in TERMINAL_STATES]
+            if not active:
+                break
+            changed = False
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(active))) as executor:
+                for prefix, status, error in executor.map(self._status, active):
+                    if error is not None:
+                        # Lỗi mạng tạm thời: giữ trạng thái cũ và hỏi lại ở vòng sau
+                        print(f"  - {prefix}: không lấy được trạng thái ({error})")
+                        continue
+                    state = status.get('state', 'UNKNOWN')
+                    if state != shards[prefix]['state']:
+                        shards[prefix]['state'] = state
+                        shards[prefix]['error'] = status.get('error_message')
+                        changed = True
+                        message = f": {shards[prefix]['error']}" if shards[prefix]['error'] else ''
+                        print(f"  - {prefix}: {state}{message}")
+
+            remaining = sum(shard['state'] not in TERMINAL_STATES for shard in shards.values())
+            if not remaining:
+                break
+            if timeout is not None and clock() - start + delay > timeout:
+                print(f"  Hết thời gian chờ, còn {remaining} task chưa kết thúc")
+                break
+            delay = initial_delay if changed else min(delay * 2, max_delay)
+            sleep(delay)
+        return {prefix: shard['state'] for prefix, shard in shards.items()}
+
+    def manifest(self):
+        return {'folder': self.folder, 'nodata': NODATA, 'products': self.products,
+                'updated': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    def write_manifest(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+        return path
+
+
+# Các file đã tải về của một mảnh: <prefix>.tif, hoặc <prefix>-<row>-<col>.tif khi GEE tự
+# chia mảnh thành nhiều file
+def shard_files(shards_dir, prefix):
+    exact = os.path.join(shards_dir, f"{prefix}.tif")
+    if os.path.exists(exact):
+        return [exact]
+    return sorted(glob.glob(os.path.join(shards_dir, glob.escape(prefix) + '-*.tif')))
+
+
+# Ghi VRT nhiều band ghép các file mảnh lên lưới của sản phẩm; vị trí mỗi file được tính
+# từ geotransform thực của file nên không phụ thuộc cách GEE chia file
+def write_vrt(path, product, files, nodata=NODATA):
+    import rasterio
+    from rasterio.crs import CRS
+
+    xsize, _, x0, _, ysize, y0 = product['transform']
+    sources = []
+    for file in files:
+        with rasterio.open(file) as src:
+            col_off = int(round((src.transform.c - x0) / xsize))
+            row_off = int(round((src.transform.f - y0) / ysize))
+            sources.append((os.path.relpath(file, os.path.dirname(path)), src.width, src.height,
+                            col_off, row_off, src.count))
+
+    lines = [f'<VRTDataset rasterXSize="{product["width"]}" rasterYSize="{product["height"]}">',
+             f'  <SRS>{escape(CRS.from_string(product["crs"]).to_wkt())}</SRS>',
+             f'  <GeoTransform>{x0!r}, {xsize!r}, 0, {y0!r}, 0, {ysize!r}</GeoTransform>']
+    for band, name in enumerate(product['bands'], start=1):
+        lines += [f'  <VRTRasterBand dataType="Float32" band="{band}">',
+                  f'    <Description>{escape(name)}</Description>',
+                  f'    <NoDataValue>{nodata!r}</NoDataValue>']
+        for filename, width, height, col_off, row_off, count in sources:
+            if band > count:
+                continue
+            lines += ['    <ComplexSource>',
+                      f'      <SourceFilename relativeToVRT="1">{escape(filename)}</SourceFilename>',
+                      f'      <SourceBand>{band}</SourceBand>',
+                      f'      <SrcRect xOff="0" yOff="0" xSize="{width}" ySize="{height}"/>',
+                      f'      <DstRect xOff="{col_off}" yOff="{row_off}" xSize="{width}" ySize="{height}"/>',
+                      f'      <NODATA>{nodata!r}</NODATA>',
+                      '    </ComplexSource>']
+        lines.append('  </VRTRasterBand>')
+    lines.append('</VRTDataset>')
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+# Tách một band của VRT thành GeoTIFF dạng tile (đọc/ghi theo dải hàng). dtype='uint16' ghi
+# DN nguyên với nodata 0 như compositor.py (band Sentinel-2 mà SentinelReader nhân với
+# REFLECTANCE_SCALE); mặc định giữ float32 với nodata của VRT
+def extract_band(vrt_path, band, out_path, dtype='float32', strip_rows=1024):
+    import numpy as np
+    import rasterio
+    from rasterio.windows import Window
+
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    with rasterio.open(vrt_path) as src:
+        integer = np.issubdtype(np.dtype(dtype), np.integer)
+        profile = {
+            'driver': 'GTiff', 'height': src.height, 'width': src.width, 'count': 1,
+            'dtype': dtype, 'nodata': 0 if integer else src.nodata, 'crs': src.crs, 'transform': src.transform,
+            'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate',
+            'predictor': 2 if integer else 1,
+        }
+        top = np.iinfo(dtype).max if integer else None
+        tmp_path = out_path + '.tmp'
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for row_start in range(0, src.height, strip_rows):
+                window = Window(0, row_start, src.width, min(strip_rows, src.height - row_start))
+                if integer:
+                    data = src.read(band, window=window, masked=True)
+                    valid = ~np.ma.getmaskarray(data) & np.isfinite(data.filled(0))
+                    data = np.where(valid, np.clip(np.round(data.filled(0)), 1, top), 0).astype(dtype)
+                else:
+                    data = src.read(band, window=window)
+                dst.write(data, 1, window=window)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+# Ghép các mảnh đã tải về (shards_dir) theo manifest: mỗi sản phẩm thành <tên>.vrt trong
+# out_dir; nếu extract, các band có trong outputs được tách thành GeoTIFF tại out_dir/<đường dẫn>
+def assemble(manifest_path, shards_dir, out_dir, extract=False):
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    os.makedirs(out_dir, exist_ok=True)
+
+    results = {}
+    for name, product in manifest['products'].items():
+        files, missing = [], []
+        for shard in product['shards']:
+            found = shard_files(shards_dir, shard['prefix'])
+            files += found
+            if not found:
+                missing.append(shard['prefix'])
+        if missing:
+            raise FileNotFoundError(f"Thiếu file cho {len(missing)} mảnh của {name}: {', '.join(missing)}")
+
+        vrt_path = write_vrt(os.path.join(out_dir, f"{name}.vrt"), product, files, manifest['nodata'])
+        print(f"  {name}: ghép {len(files)} file -> {vrt_path}")
+        results[name] = vrt_path
+        if extract:
+            for band, relative in product['outputs'].items():
+                out_path = extract_band(vrt_path, product['bands'].index(band) + 1,
+                                        os.path.join(out_dir, relative),
+                                        product.get('dtypes', {}).get(band, 'float32'))
+                print(f"    {band} -> {out_path}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ghép các mảnh export từ Earth Engine theo manifest")
+    parser.add_argument('manifest', help="File manifest do download_data.py ghi")
+    parser.add_argument('shards_dir', help="Thư mục chứa các file .tif đã tải từ Google Drive")
+    parser.add_argument('out_dir', help="Thư mục Data của dự án")
+    parser.add_argument('--extract', action='store_true',
+                        help="Tách các band thành GeoTIFF theo bố cục thư mục Data (sentinel/, dem/, gedi/)")
+    args = parser.parse_args(argv)
+
+    try:
+        assemble(args.manifest, args.shards_dir, args.out_dir, args.extract)
+    except FileNotFoundError as e:
+        print(e)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
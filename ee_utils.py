@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Gom các kết quả Earth Engine cần đưa về máy (số liệu, danh sách) để đánh giá trong một
+# lần getInfo: các đối tượng được đăng ký bằng add(), lần get() đầu tiên gửi một
+# ee.Dictionary chứa tất cả đối tượng đang chờ, kết quả được ghi nhớ cho các lần sau.
+# Nếu cả lô bị lỗi (ví dụ một biểu thức hỏng), từng đối tượng được lấy song song trên
+# thread pool để lỗi của mục này không làm mất kết quả của mục khác; get() ném lại lỗi
+# riêng của mục đó. ee_module cho phép thay thế module ee (ví dụ bằng module giả khi kiểm thử)
+class EEResults:
+    def __init__(self, ee_module=None, max_workers=8):
+        if ee_module is None:
+            import ee as ee_module
+        self.ee = ee_module
+        self.max_workers = max_workers
+        self.pending = {}
+        self.values = {}
+        self.errors = {}
+        self.round_trips = 0
+
+    def add(self, name, obj):
+        self.values.pop(name, None)
+        self.errors.pop(name, None)
+        self.pending[name] = obj
+        return self
+
+    def _get_info(self, obj):
+        self.round_trips += 1
+        return obj.getInfo()
+
+    # Đánh giá mọi đối tượng đang chờ
+    def fetch(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            self.values.update(self._get_info(self.ee.Dictionary(pending)))
+            return
+        except Exception:
+            pass
+
+        def fetch_one(item):
+            name, obj = item
+            try:
+                return name, self._get_info(obj), None
+            except Exception as e:
+                return name, None, e
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as executor:
+            for name, value, error in executor.map(fetch_one, pending.items()):
+                if error is None:
+                    self.values[name] = value
+                else:
+                    self.errors[name] = error
+
+    def get(self, name):
+        if name in self.pending:
+            self.fetch()
+        if name in self.errors:
+            raise self.errors[name]
+        return self.values[name]
+
+    __getitem__ = get
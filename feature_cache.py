@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+
+# Tăng khi thay đổi cách xử lý đặc trưng để vô hiệu hóa toàn bộ cache cũ
+CACHE_VERSION = 1
+
+# Dung lượng tối đa mặc định của cache (byte)
+DEFAULT_MAX_BYTES = 100 * 1024 ** 3
+
+
+# Cache khối đặc trưng (features + gedi) trên đĩa dưới dạng các file .npy memory-map.
+# Mỗi mục là một thư mục <root>/<key>/ gồm cube.npy (rows, cols, n_features),
+# gedi.npy (rows, cols) và meta.json; khóa là hash của các file đầu vào và tham số xử lý
+class FeatureCache:
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    # Khóa cache: đường dẫn, mtime, kích thước của từng file đầu vào + tham số xử lý
+    @staticmethod
+    def key(paths, **params):
+        files = []
+        for path in sorted(paths):
+            stat = os.stat(path)
+            files.append([os.path.abspath(path), stat.st_mtime, stat.st_size])
+        payload = {'version': CACHE_VERSION, 'files': files, 'params': params}
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self.path(key), 'meta.json'))
+
+    # Mở mục cache ở chế độ chỉ đọc, không sao chép dữ liệu vào RAM
+    def load(self, key):
+        entry = self.path(key)
+        with open(os.path.join(entry, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        cube = np.load(os.path.join(entry, 'cube.npy'), mmap_mode='r')
+        gedi = np.load(os.path.join(entry, 'gedi.npy'), mmap_mode='r')
+
+        # Cập nhật thời điểm sử dụng cho việc loại bỏ theo LRU
+        os.utime(os.path.join(entry, 'meta.json'))
+        return cube, gedi, meta
+
+    # Tạo mục cache mới trong thư mục tạm, trả về các memmap để ghi dữ liệu
+    def create(self, key, shape, names):
+        tmp = self.path(key) + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        rows, cols = shape
+        cube = np.lib.format.open_memmap(os.path.join(tmp, 'cube.npy'), mode='w+',
+                                         dtype=np.float32, shape=(rows, cols, len(names)))
+        gedi = np.lib.format.open_memmap(os.path.join(tmp, 'gedi.npy'), mode='w+',
+                                         dtype=np.float32, shape=(rows, cols))
+        return cube, gedi
+
+    # Hoàn tất mục cache: ghi meta.json, đổi tên thư mục tạm rồi loại bỏ mục cũ nếu vượt dung lượng
+    def commit(self, key, meta):
+        tmp = self.path(key) + '.tmp'
+        with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        shutil.rmtree(self.path(key), ignore_errors=True)
+        os.replace(tmp, self.path(key))
+        self.evict(keep=key)
+
+    # Danh sách mục cache: (key, dung lượng, thời điểm dùng gần nhất), cũ nhất trước
+    def entries(self):
+        result = []
+        for key in os.listdir(self.root):
+            entry = self.path(key)
+            meta_path = os.path.join(entry, 'meta.json')
+            if not os.path.exists(meta_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            result.append((key, size, os.path.getmtime(meta_path)))
+        return sorted(result, key=lambda item: item[2])
+
+    # Loại bỏ các mục ít được dùng nhất cho đến khi tổng dung lượng <= max_bytes
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            print(f"  Xóa mục cache đặc trưng cũ {key[:12]} ({size / 1024 ** 2:,.0f} MB)")
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
+
+    # Xóa một mục (theo key) hoặc toàn bộ cache
+    def invalidate(self, key=None):
+        keys = [key] if key else os.listdir(self.root)
+        for k in keys:
+            shutil.rmtree(self.path(k), ignore_errors=True)
+        return len(keys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quản lý cache khối đặc trưng")
+    parser.add_argument('root', help="Thư mục cache, ví dụ <output_dir>/cache/features")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help="Liệt kê các mục cache")
+    invalidate = sub.add_parser('invalidate', help="Xóa một mục hoặc toàn bộ cache")
+    invalidate.add_argument('key', nargs='?', help="Khóa cần xóa (bỏ trống để xóa tất cả)")
+    args = parser.parse_args(argv)
+
+    cache = FeatureCache(args.root)
+    if args.command == 'list':
+        for key, size, used in cache.entries():
+            print(f"{key}  {size / 1024 ** 2:>10,.1f} MB  {time.strftime('%Y-%m-%d %H:%M', time.localtime(used))}")
+    else:
+        n = cache.invalidate(args.key)
+        print(f"Đã xóa {n} mục cache")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Số pixel mỗi lô khi duyệt cây
+DEFAULT_BATCH_SIZE = 65536
+
+# Sau mỗi COMPACT_EVERY tầng mới loại các pixel đã tới lá; loại ở mọi tầng tốn hơn lợi
+COMPACT_EVERY = 6
+
+# Số nút tối đa của cả rừng: chỉ số nút là int32 và phép duyệt tính 2 * nút + 1
+MAX_NODES = (np.iinfo(np.int32).max - 1) // 2
+
+
+# Thứ tự duyệt theo tầng (BFS) của các nút trong một cây sklearn. Các nút cùng tầng
+# nằm liền nhau nên phép duyệt đồng bộ theo tầng truy cập bộ nhớ gọn hơn thứ tự DFS gốc
+def level_order(children_left, children_right):
+    levels = [np.array([0])]
+    frontier = levels[0]
+    while frontier.size:
+        inner = frontier[children_left[frontier] != -1]
+        frontier = np.stack([children_left[inner], children_right[inner]], axis=1).ravel()
+        levels.append(frontier)
+    return np.concatenate(levels)
+
+
+# Random forest dạng phẳng: toàn bộ nút của mọi cây nằm trong các mảng liên tục
+# (feature, threshold, children, value) kiểu int32/float32, chỉ số con là chỉ số toàn cục.
+# children[2 * i] là con trái, children[2 * i + 1] là con phải của nút i.
+# Nút lá trỏ về chính nó nên các pixel đã tới lá đứng yên khi duyệt tiếp.
+# Mục đích là bộ nhớ: các mảng nhỏ hơn pickle của sklearn và được nạp bằng memory-map nên mọi
+# worker dự đoán dùng chung một bản. Tốc độ dự đoán không nhanh hơn sklearn (xấp xỉ, hoặc chậm
+# hơn với các cây sâu)
+class FlatForest:
+    ARRAYS = ('feature', 'threshold', 'children', 'value', 'is_leaf', 'roots')
+
+    def __init__(self, feature, threshold, children, value, is_leaf, roots, n_features):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.is_leaf = is_leaf
+        self.roots = roots
+        self.n_features = n_features
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    # Xuất RandomForestRegressor (hoặc DecisionTreeRegressor đơn lẻ) của sklearn
+    @classmethod
+    def from_sklearn(cls, model):
+        estimators = getattr(model, 'estimators_', [model])
+        parts = {name: [] for name in cls.ARRAYS}
+        offset = 0
+
+        n_nodes = sum(estimator.tree_.node_count for estimator in estimators)
+        if n_nodes > MAX_NODES:
+            raise ValueError(f"Rừng có {n_nodes:,} nút, vượt giới hạn {MAX_NODES:,} nút của chỉ số int32")
+
+        for estimator in estimators:
+            tree = estimator.tree_
+            order = level_order(tree.children_left, tree.children_right)
+            new_id = np.empty_like(order)
+            new_id[order] = np.arange(len(order)) + offset
+
+            children_left = tree.children_left[order]
+            children_right = tree.children_right[order]
+            leaf = children_left == -1
+            nodes = np.arange(len(order)) + offset
+
+            # sklearn so sánh x (float32) <= threshold (float64); làm tròn ngưỡng xuống
+            # giá trị float32 gần nhất để phép so sánh trên float32 cho kết quả giống hệt
+            threshold = tree.threshold[order].astype(np.float32)
+            above = threshold.astype(np.float64) > tree.threshold[order]
+            threshold[above] = np.nextafter(threshold[above], np.float32(-np.inf))
+
+            parts['feature'].append(np.where(leaf, 0, tree.feature[order]).astype(np.int32))
+            parts['threshold'].append(np.where(leaf, 0, threshold).astype(np.float32))
+            left = np.where(leaf, nodes, new_id[np.maximum(children_left, 0)])
+            right = np.where(leaf, nodes, new_id[np.maximum(children_right, 0)])
+            parts['children'].append(np.stack([left, right], axis=1).ravel().astype(np.int32))
+            parts['value'].append(tree.value[order, 0, 0].astype(np.float32))
+            parts['is_leaf'].append(leaf)
+            parts['roots'].append(np.array([offset], dtype=np.int32))
+            offset += tree.node_count
+
+        arrays = {name: np.ascontiguousarray(np.concatenate(values)) for name, values in parts.items()}
+        return cls(n_features=int(estimators[0].n_features_in_), **arrays)
+
+    # Lưu mỗi mảng thành một file .npy để có thể nạp lại bằng memory-map
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(directory, 'forest.json'), 'w', encoding='utf-8') as f:
+            json.dump({'n_features': self.n_features, 'n_trees': self.n_trees,
+                       'n_nodes': len(self.feature)}, f, indent=2)
+
+    # Nạp mô hình; với mmap=True các mảng không được đọc vào RAM cho đến khi dùng tới
+    # và nhiều tiến trình dùng chung một bản trong page cache
+    @classmethod
+    def load(cls, directory, mmap=True):
+        with open(os.path.join(directory, 'forest.json'), encoding='utf-8') as f:
+            info = json.load(f)
+        mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mode)
+                  for name in cls.ARRAYS}
+        return cls(n_features=info['n_features'], **arrays)
+
+    # Duyệt một cây cho một lô pixel; flat_x là lô đã làm phẳng, base = vị trí hàng
+    # của từng pixel trong flat_x. Mọi pixel đi xuống cùng lúc, mỗi tầng là vài phép
+    # gather/so sánh trên toàn lô
+    def _traverse(self, root, flat_x, base, out):
+        node = np.full(len(base), root, dtype=np.int32)
+        pixels = None
+        level = 0
+
+        while node.size:
+            right = flat_x.take(self.feature.take(node) + base) > self.threshold.take(node)
+            node <<= 1
+            node += right
+            node = self.children.take(node)
+
+            level += 1
+            if level % COMPACT_EVERY == 0:
+                done = self.is_leaf.take(node)
+                if done.any():
+                    if pixels is None:
+                        pixels = np.arange(len(base), dtype=np.int32)
+                    out[pixels[done]] = self.value.take(node[done])
+                    active = ~done
+                    node, pixels, base = node[active], pixels[active], base[active]
+
+    # Giá trị lá của từng cây cho mỗi pixel: mảng (n_trees, n_pixels) float32.
+    # Các cây được chia cho n_threads luồng (các phép take/so sánh của NumPy nhả GIL)
+    def predict_trees(self, X, batch_size=DEFAULT_BATCH_SIZE, n_threads=1):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_pixels = X.shape[0]
+        out = np.empty((self.n_trees, n_pixels), dtype=np.float32)
+
+        def run(trees, start, stop, flat_x, base):
+            for t in trees:
+                self._traverse(int(self.roots[t]), flat_x, base, out[t, start:stop])
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for start in range(0, n_pixels, batch_size):
+                stop = min(start + batch_size, n_pixels)
+                flat_x = X[start:stop].ravel()
+                base = np.arange(stop - start, dtype=np.int32) * self.n_features
+                groups = np.array_split(np.arange(self.n_trees), n_threads)
+                list(executor.map(run, groups, [start] * n_threads, [stop] * n_threads,
+                                  [flat_x] * n_threads, [base] * n_threads))
+        return out
+
+    # Dự đoán giống RandomForestRegressor.predict: trung bình giá trị lá của các cây
+    def predict(self, X, batch_size=DEFAULT_BATCH_SIZE, n_threads=1):
+        return self.predict_trees(X, batch_size, n_threads).mean(axis=0, dtype=np.float64)
+
+
+# So sánh bộ nhớ, thời gian nạp, sai số và thời gian dự đoán giữa FlatForest và sklearn trên dữ
+# liệu giả lập
+def benchmark(n_samples=100000, n_features=13, n_trees=100, n_pixels=200000, n_threads=1, seed=0):
+    import pickle
+    from sklearn.ensemble import RandomForestRegressor
+
+    rng = np.random.default_rng(seed)
+    X = rng.random((n_samples, n_features), dtype=np.float32)
+    y = X[:, 0] * 200 + np.sin(X[:, 1] * 6) * 50 + rng.normal(0, 10, n_samples)
+    rf = RandomForestRegressor(n_estimators=n_trees, n_jobs=-1, random_state=42).fit(X, y)
+    rf.n_jobs = n_threads
+    forest = FlatForest.from_sklearn(rf)
+    X_pred = rng.random((n_pixels, n_features), dtype=np.float32)
+
+    start = time.perf_counter()
+    expected = rf.predict(X_pred)
+    sklearn_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = forest.predict(X_pred, n_threads=n_threads)
+    flat_time = time.perf_counter() - start
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        forest.save(tmp)
+        start = time.perf_counter()
+        FlatForest.load(tmp)
+        load_time = time.perf_counter() - start
+
+    print(f"Rừng: {n_trees} cây, {len(forest.feature):,} nút, {n_pixels:,} pixel dự đoán")
+    print(f"  Bộ nhớ: pickle {len(pickle.dumps(rf)) / 1024 ** 2:,.1f} MB, "
+          f"FlatForest {forest.nbytes / 1024 ** 2:,.1f} MB; nạp mmap {load_time * 1000:.1f} ms")
+    print(f"  Sai số lớn nhất so với sklearn: {np.abs(result - expected).max():.2e}")
+    print(f"  Thời gian dự đoán ({n_threads} luồng):")
+    print(f"    sklearn:           {sklearn_time:8.2f} s  ({n_pixels / sklearn_time:>12,.0f} pixel/giây)")
+    print(f"    FlatForest:        {flat_time:8.2f} s  ({n_pixels / flat_time:>12,.0f} pixel/giây, "
+          f"{flat_time / sklearn_time:.2f} lần thời gian của sklearn)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="So sánh bộ nhớ, sai số và thời gian dự đoán của FlatForest với sklearn")
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--trees', type=int, default=100)
+    parser.add_argument('--pixels', type=int, default=200000)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args(argv)
+    benchmark(n_samples=args.samples, n_trees=args.trees, n_pixels=args.pixels,
+              n_threads=args.threads)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Các nhóm chùm tia trong file GEDI L4A (.h5)
+BEAMS = ('BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011')
+
+# Tên cột chuẩn -> các tên có thể gặp trong bảng footprint (CSV/Parquet) hoặc trong file L4A
+COLUMN_ALIASES = {
+    'lat': ('lat', 'lat_lowestmode', 'latitude'),
+    'lon': ('lon', 'lon_lowestmode', 'longitude'),
+    'agbd': ('agbd',),
+    'agbd_se': ('agbd_se',),
+    'l4_quality_flag': ('l4_quality_flag',),
+    'degrade_flag': ('degrade_flag',),
+}
+
+# Các cột được lưu sau khi lọc, với kiểu dữ liệu gọn nhất đủ độ chính xác
+# (float64 cho tọa độ: sai số float32 ở kinh độ ~108° là ~1 m)
+STORE_COLUMNS = {'lon': np.float64, 'lat': np.float64, 'agbd': np.float32, 'agbd_se': np.float32}
+
+# Ngưỡng sai số tương đối agbd_se / agbd, giống errorMask trong skun.py
+MAX_RELATIVE_SE = 0.3
+
+# Cạnh ô (pixel) của chỉ mục lưới: footprint được truy cập lần lượt theo từng ô
+INDEX_TILE = 512
+
+
+# Đọc các cột cần thiết của một file GEDI L4A (.h5) từ mọi chùm tia
+def read_l4a(path, beams=BEAMS):
+    import h5py
+
+    columns = {name: [] for name in COLUMN_ALIASES}
+    with h5py.File(path, 'r') as f:
+        for beam in beams:
+            if beam not in f:
+                continue
+            group = f[beam]
+            for name, aliases in COLUMN_ALIASES.items():
+                alias = next((alias for alias in aliases if alias in group), None)
+                if alias is None:
+                    raise ValueError(f"{os.path.basename(path)}/{beam} không có cột {name} "
+                                     f"(đã thử: {', '.join(aliases)})")
+                columns[name].append(group[alias][()])
+    return {name: np.concatenate(parts) if parts else np.empty(0) for name, parts in columns.items()}
+
+
+# Đọc bảng footprint dạng CSV hoặc Parquet (một dòng mỗi footprint)
+def read_table(path):
+    import pandas as pd
+
+    table = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+    columns = {}
+    for name, aliases in COLUMN_ALIASES.items():
+        alias = next((alias for alias in aliases if alias in table.columns), None)
+        if alias is None:
+            raise ValueError(f"{os.path.basename(path)} không có cột {name} (đã thử: {', '.join(aliases)})")
+        columns[name] = table[alias].to_numpy()
+    return columns
+
+
+# Mặt nạ footprint hợp lệ (vectorized): cờ chất lượng L4 = 1, không suy giảm, AGBD dương
+# và agbd_se / agbd <= max_relative_se; bounds (lon_min, lat_min, lon_max, lat_max) nếu có
+def quality_mask(columns, max_relative_se=MAX_RELATIVE_SE, bounds=None):
+    agbd = columns['agbd']
+    keep = (columns['l4_quality_flag'] == 1) & (columns['degrade_flag'] == 0) & (agbd > 0)
+    keep &= columns['agbd_se'] <= max_relative_se * agbd
+    if bounds is not None:
+        lon_min, lat_min, lon_max, lat_max = bounds
+        lon, lat = columns['lon'], columns['lat']
+        keep &= (lon >= lon_min) & (lon <= lon_max) & (lat >= lat_min) & (lat <= lat_max)
+    return keep
+
+
+# Đọc và lọc một file (chạy trong worker); chỉ trả về các cột được lưu
+def _read_filtered(path, max_relative_se, bounds):
+    columns = read_l4a(path) if path.endswith('.h5') else read_table(path)
+    keep = quality_mask(columns, max_relative_se, bounds)
+    return len(keep), {name: columns[name][keep].astype(dtype) for name, dtype in STORE_COLUMNS.items()}
+
+
+# Đọc các file footprint song song, lọc chất lượng và ghi kho footprint dạng cột vào out_dir:
+# mỗi cột một file .npy (nạp bằng memory-map) và meta.json (nguồn, bộ lọc, số footprint).
+# Ghi vào thư mục tạm rồi đổi tên để không để lại kho dở dang
+def ingest(paths, out_dir, bounds=None, max_relative_se=MAX_RELATIVE_SE, workers=None):
+    tmp = out_dir.rstrip('/\\') + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    parts = {name: [] for name in STORE_COLUMNS}
+    n_read = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = executor.map(_read_filtered, paths, [max_relative_se] * len(paths), [bounds] * len(paths))
+        for path, (n, columns) in zip(paths, results):
+            n_read += n
+            for name, values in columns.items():
+                parts[name].append(values)
+            print(f"  {os.path.basename(path)}: giữ {len(columns['agbd']):,} / {n:,} footprint")
+
+    n_kept = 0
+    for name, dtype in STORE_COLUMNS.items():
+        values = np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=dtype)
+        np.save(os.path.join(tmp, f"{name}.npy"), values)
+        n_kept = len(values)
+
+    meta = {
+        'sources': {os.path.abspath(path): [os.stat(path).st_mtime, os.stat(path).st_size] for path in paths},
+        'filters': {'l4_quality_flag': 1, 'degrade_flag': 0, 'max_relative_se': max_relative_se,
+                    'bounds': list(bounds) if bounds is not None else None},
+        'n_read': n_read, 'n_footprints': n_kept, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp, out_dir)
+    return FootprintStore(out_dir)
+
+
+# Kho footprint đã lọc; các cột được nạp bằng memory-map
+class FootprintStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+                        for name in STORE_COLUMNS}
+
+    def __len__(self):
+        return self.meta['n_footprints']
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    # Khóa của kho (nguồn + bộ lọc), dùng trong khóa mô hình
+    @property
+    def key(self):
+        payload = {'sources': self.meta['sources'], 'filters': self.meta['filters']}
+        return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+# Vị trí pixel (hàng, cột) của các điểm lon/lat trên lưới grid, và mặt nạ điểm nằm trong lưới
+def pixel_positions(lon, lat, grid):
+    from pyproj import Transformer
+
+    if grid.crs.is_geographic:
+        x, y = np.asarray(lon), np.asarray(lat)
+    else:
+        x, y = Transformer.from_crs('EPSG:4326', grid.crs, always_xy=True).transform(lon, lat)
+    cols, rows = ~grid.transform * (np.asarray(x), np.asarray(y))
+    rows = np.floor(rows).astype(np.int64)
+    cols = np.floor(cols).astype(np.int64)
+    inside = (rows >= 0) & (rows < grid.height) & (cols >= 0) & (cols < grid.width)
+    return rows, cols, inside
+
+
+# Chỉ mục lưới của các footprint: thứ tự footprint sắp theo (ô tile x tile pixel, hàng, cột),
+# để khi lấy mẫu khối đặc trưng mỗi vùng của memmap được đọc một lần thay vì nhảy ngẫu nhiên
+class GridIndex:
+    def __init__(self, rows, cols, tile=INDEX_TILE):
+        self.tile = tile
+        self.rows = np.asarray(rows)
+        self.cols = np.asarray(cols)
+        tile_rows, tile_cols = self.rows // tile, self.cols // tile
+        n_tile_cols = int(tile_cols.max()) + 1 if len(self.cols) else 1
+        self.order = np.lexsort((self.cols, self.rows, tile_rows * n_tile_cols + tile_cols))
+
+    def __len__(self):
+        return len(self.rows)
+
+
+# Giá trị khối đặc trưng (rows, cols, F) tại các footprint. Truy cập theo thứ tự của chỉ mục
+# nên memmap được đọc gần như tuần tự. Trả về mảng (N, F) theo thứ tự footprint ban đầu
+def sample_cube(cube, index):
+    out = np.empty((len(index), cube.shape[2]), dtype=cube.dtype)
+    order = index.order
+    out[order] = cube[index.rows[order], index.cols[order]]
+    return out
+
+
+# Mẫu huấn luyện từ footprint GEDI: đặc trưng của pixel chứa footprint, mục tiêu là AGBD của
+# footprint. Bỏ footprint ngoài lưới hoặc có đặc trưng NaN, rồi chọn ngẫu nhiên (có seed)
+# tối đa sample_size footprint. Trả về X, y, hàng, cột như validation.sample_training
+def sample_footprints(store, cube, grid, sample_size=100000, seed=42):
+    rows, cols, inside = pixel_positions(store['lon'], store['lat'], grid)
+    agbd = np.asarray(store['agbd'])[inside]
+    rows, cols = rows[inside], cols[inside]
+    if len(agbd) > sample_size:
+        keep = np.sort(np.random.default_rng(seed).choice(len(agbd), sample_size, replace=False))
+        agbd, rows, cols = agbd[keep], rows[keep], cols[keep]
+
+    X = sample_cube(cube, GridIndex(rows, cols))
+    complete = ~np.isnan(X).any(axis=1)
+    return X[complete], agbd[complete], rows[complete], cols[complete]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Nhập footprint GEDI L4A vào kho dạng cột")
+    parser.add_argument('inputs', nargs='+', help="Các file GEDI L4A (.h5) hoặc bảng footprint (.csv/.parquet)")
+    parser.add_argument('--out', required=True, help="Thư mục kho footprint")
+    parser.add_argument('--vector', default=None,
+                        help="Shapefile ranh giới; chỉ giữ footprint trong hình chữ nhật bao")
+    parser.add_argument('--max-relative-se', type=float, default=MAX_RELATIVE_SE)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    bounds = None
+    if args.vector:
+        import geopandas as gpd
+        bounds = tuple(gpd.read_file(args.vector).to_crs('EPSG:4326').total_bounds)
+
+    start = time.perf_counter()
+    store = ingest(args.inputs, args.out, bounds, args.max_relative_se, args.workers)
+    print(f"Đã lưu {len(store):,} / {store.meta['n_read']:,} footprint vào {args.out} "
+          f"({time.perf_counter() - start:.1f} giây)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
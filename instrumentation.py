@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+# resource chỉ có trên POSIX; trên Windows các số liệu RSS/CPU dùng psutil (nếu có) hoặc 0
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Các bước chuẩn của pipeline (tên dùng trong báo cáo và cho --profile-stage)
+STAGES = ('transcode', 'read', 'align', 'mask', 'indices', 'slope', 'features', 'sampling', 'cv', 'fit', 'score',
+          'predict', 'write', 'plot', 'fetch', 'export')
+
+# Các cột của báo cáo CSV, theo thứ tự
+REPORT_FIELDS = ('stage', 'calls', 'wall_s', 'cpu_s', 'children_cpu_s', 'cpu_util', 'peak_rss_delta_mb',
+                 'peak_rss_mb', 'pixels', 'pixels_per_s', 'bytes_read', 'bytes_written')
+
+# Khoảng lấy mẫu (giây) của bộ lấy mẫu ngăn xếp
+SAMPLE_INTERVAL = 0.005
+
+
+# Đặt lại đỉnh RSS của tiến trình (Linux: ghi 5 vào /proc/self/clear_refs); bỏ qua nếu không hỗ trợ
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Đỉnh RSS (MB) của tiến trình kể từ lần đặt lại gần nhất (VmHWM), hoặc từ lúc khởi động
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024 ** 2
+    except ImportError:
+        return 0.0
+
+
+# Đỉnh RSS (MB) lớn nhất trong các tiến trình con đã kết thúc (worker dự đoán, huấn luyện);
+# 0 nếu không hỗ trợ
+def children_peak_rss_mb():
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+# Số byte tiến trình đã đọc/ghi qua các lời gọi hệ thống (rchar/wchar trong /proc/self/io);
+# không gồm dữ liệu đọc qua memory-map và I/O của tiến trình con. (0, 0) nếu không hỗ trợ
+def io_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+# Thời gian CPU (giây) của các tiến trình con đã kết thúc; os.times() trả 0 trên Windows
+def _children_cpu():
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return children.ru_utime + children.ru_stime
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def _snapshot():
+    return (time.perf_counter(), time.process_time(), _children_cpu(), peak_rss_mb(), *io_bytes())
+
+
+# Số liệu của một lần chạy bước; pixel và byte có thể được cộng thêm trong lúc chạy
+class Measure:
+    __slots__ = ('pixels', 'bytes_read', 'bytes_written')
+
+    def __init__(self, pixels=0, bytes_read=0, bytes_written=0):
+        self.pixels = pixels
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+
+    def add(self, pixels=0, bytes_read=0, bytes_written=0):
+        self.pixels += pixels
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+
+# Lấy mẫu ngăn xếp của một thread theo chu kỳ, đếm theo dạng "collapsed stacks" (dùng được
+# với flamegraph.pl / speedscope). Chạy trên thread riêng nên không cần thư viện ngoài
+class StackSampler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = None
+
+    def start(self, thread_id):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(thread_id, self._stop), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self, thread_id, stop):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+# Ghi nhận thời gian thực, thời gian CPU (của tiến trình và các tiến trình con đã kết thúc),
+# mức tăng đỉnh RSS, số pixel và số byte đọc/ghi của từng bước; các lần chạy cùng tên được
+# cộng dồn. Bước lồng nhau được tính cho cả bước ngoài lẫn bước trong. Mỗi lần vào/ra bước
+# chỉ đọc vài bộ đếm của /proc nên có thể bật thường xuyên khi chạy thật.
+# profile_stage: tên bước cần profile bằng cProfile (profile_mode='cprofile') hoặc bằng bộ
+# lấy mẫu ngăn xếp (profile_mode='sample'); kết quả được ghi cùng báo cáo
+class Recorder:
+    def __init__(self, profile_stage=None, profile_mode='cprofile'):
+        if profile_mode not in ('cprofile', 'sample'):
+            raise ValueError(f"Chế độ profile không hỗ trợ: {profile_mode}")
+        self.profile_stage = profile_stage
+        self.profile_mode = profile_mode
+        self.profiler = None
+        self._profiling = 0
+        self.stages = {}
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._start = _snapshot()
+
+    def _begin_profile(self):
+        self._profiling += 1
+        if self._profiling > 1:
+            return
+        if self.profile_mode == 'cprofile':
+            import cProfile
+            self.profiler = self.profiler or cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = self.profiler or StackSampler()
+            self.profiler.start(threading.get_ident())
+
+    def _end_profile(self):
+        self._profiling -= 1
+        if self._profiling:
+            return
+        if self.profile_mode == 'cprofile':
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+
+    @contextmanager
+    def stage(self, name, pixels=0, bytes_read=0, bytes_written=0):
+        measure = Measure(pixels, bytes_read, bytes_written)
+        profile = name == self.profile_stage
+        if profile:
+            self._begin_profile()
+        start = _snapshot()
+        try:
+            yield measure
+        finally:
+            end = _snapshot()
+            if profile:
+                self._end_profile()
+            totals = self.stages.get(name)
+            if totals is None:
+                totals = self.stages[name] = dict.fromkeys(REPORT_FIELDS[1:], 0)
+                totals['stage'] = name
+            totals['calls'] += 1
+            totals['wall_s'] += end[0] - start[0]
+            totals['cpu_s'] += end[1] - start[1]
+            totals['children_cpu_s'] += end[2] - start[2]
+            totals['peak_rss_delta_mb'] = max(totals['peak_rss_delta_mb'], end[3] - start[3])
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'], end[3])
+            totals['pixels'] += measure.pixels
+            totals['bytes_read'] += measure.bytes_read + end[4] - start[4]
+            totals['bytes_written'] += measure.bytes_written + end[5] - start[5]
+
+    # Các dòng báo cáo theo thứ tự bước được chạy lần đầu, kèm dòng tổng của cả lần chạy
+    def rows(self):
+        rows = []
+        for totals in self.stages.values():
+            row = {field: totals[field] for field in REPORT_FIELDS if field in totals}
+            wall = row['wall_s']
+            row['cpu_util'] = (row['cpu_s'] + row['children_cpu_s']) / wall if wall > 0 else 0.0
+            row['pixels_per_s'] = row['pixels'] / wall if wall > 0 and row['pixels'] else 0.0
+            rows.append(row)
+
+        end = _snapshot()
+        wall = end[0] - self._start[0]
+        rows.append({
+            'stage': 'total', 'calls': 1, 'wall_s': wall, 'cpu_s': end[1] - self._start[1],
+            'children_cpu_s': end[2] - self._start[2],
+            'cpu_util': (end[1] - self._start[1] + end[2] - self._start[2]) / wall if wall > 0 else 0.0,
+            'peak_rss_delta_mb': end[3] - self._start[3], 'peak_rss_mb': end[3], 'pixels': 0,
+            'pixels_per_s': 0.0, 'bytes_read': end[4] - self._start[4], 'bytes_written': end[5] - self._start[5],
+        })
+        return rows
+
+    # Ghi báo cáo <stem>.json và <stem>.csv (và kết quả profile nếu có); trả về đường dẫn JSON
+    def write(self, stem, **info):
+        import csv
+
+        rows = self.rows()
+        report = {'started': self.started, 'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'argv': sys.argv, 'pid': os.getpid(), 'cpu_count': os.cpu_count(),
+                  'children_peak_rss_mb': children_peak_rss_mb(), **info, 'stages': rows}
+
+        if self.profiler is not None:
+            if self.profile_mode == 'cprofile':
+                import pstats
+                report['profile'] = f"{stem}_{self.profile_stage}.prof"
+                self.profiler.dump_stats(report['profile'])
+                with open(f"{stem}_{self.profile_stage}.txt", 'w', encoding='utf-8') as f:
+                    pstats.Stats(self.profiler, stream=f).sort_stats('cumulative').print_stats(40)
+            else:
+                report['profile'] = f"{stem}_{self.profile_stage}.folded"
+                self.profiler.write(report['profile'])
+
+        with open(f"{stem}.json", 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        with open(f"{stem}.csv", 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        return f"{stem}.json"
+
+    # Bảng tóm tắt in ra màn hình
+    def summary(self):
+        lines = [f"  {'Bước':<10} {'Lần':>6} {'Thời gian (s)':>14} {'CPU (s)':>10} {'Pixel/giây':>14} "
+                 f"{'Tăng RSS (MB)':>14}"]
+        for row in self.rows():
+            lines.append(f"  {row['stage']:<10} {row['calls']:>6} {row['wall_s']:>14.2f} "
+                         f"{row['cpu_s'] + row['children_cpu_s']:>10.2f} {row['pixels_per_s']:>14,.0f} "
+                         f"{row['peak_rss_delta_mb']:>14,.0f}")
+        return '\n'.join(lines)
+
+
+# Recorder đang hoạt động của tiến trình; None = không ghi nhận (stage() gần như không tốn gì)
+_active = None
+
+
+class _NullStage:
+    def __enter__(self):
+        return _NULL_MEASURE
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _NullMeasure:
+    def add(self, pixels=0, bytes_read=0, bytes_written=0):
+        pass
+
+
+_NULL_MEASURE = _NullMeasure()
+_NULL_STAGE = _NullStage()
+
+
+def activate(recorder):
+    global _active
+    _active = recorder
+    return recorder
+
+
+def deactivate():
+    global _active
+    recorder, _active = _active, None
+    return recorder
+
+
+# Bọc một bước: with stage('read', pixels=n) as measure: ...; measure.add(...) để cộng thêm
+def stage(name, pixels=0, bytes_read=0, bytes_written=0):
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name, pixels, bytes_read, bytes_written)
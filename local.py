@@ -1,256 +1,549 @@
 import os
+import sys
+import argparse
 import rasterio
 import numpy as np
-import geopandas as gpd
-import pandas as pd
-from rasterio.mask import mask
-from sklearn.ensemble import RandomForestRegressor
-import matplotlib.pyplot as plt
-import dask.array as da
-from dask_cuda import LocalCUDACluster
-from dask.distributed import Client
-import cupy as cp  # NumPy API trên GPU
+from prediction import predict_to_raster, UNCERTAINTY_STATS
+from sentinel_reader import SentinelReader, REFLECTANCE_SCALE
+from spectral_indices import INDICES
+from alignment import TargetGrid, LAYER_RESAMPLING, AlignedReader, grid_of, source_key, align_raster
+from terrain import compute_slope_raster
+from feature_cache import FeatureCache
+from aggregation import aggregate_array, coarse_grid_m, warp_array
+from forest_kernel import FlatForest
+from model_store import ModelStore, input_hashes, sample_fingerprint
+from raster_output import BiomassWriter, render_preview
+from zonal import ZonalStats, rasterize_zones
+from validation import (DEFAULT_BLOCK_SIZE_M, block_pixels_of, sample_training, spatial_blocks, spatial_folds,
+                        cross_validate)
+from instrumentation import STAGES, Recorder, activate, deactivate, stage
+from gedi_footprints import FootprintStore, sample_footprints
+from transcode import transcode_jp2
+from planner import default_budget, inspect_inputs, coarse_shape, plan, describe
 
-# Thiết lập xử lý song song
-cluster = LocalCUDACluster()  # Tận dụng GPU A4000
-client = Client(cluster)
-print(f"Dashboard: {client.dashboard_link}")
+# Các thư viện nặng (geopandas, pandas, scikit-learn, matplotlib, dask) chỉ được
+# import khi cần để việc import module này nhanh và không đòi hỏi GPU
 
 # Đường dẫn đến dữ liệu
 data_dir = "D:/GiaLai_Project/Data"  # Thay đổi theo thư mục của bạn
 output_dir = "D:/GiaLai_Project/Results"
-os.makedirs(output_dir, exist_ok=True)
+cache_dir = os.path.join(output_dir, "cache")  # Các lớp đã căn chỉnh lên lưới chung
 
 # Khoảng thời gian nghiên cứu
 start_date = "2022-10-10"
 end_date = "2023-10-10"
-print("="*80)
-print(f"THÔNG TIN DỰ ÁN: Phân tích sinh khối rừng Gia Lai")
-print(f"Khoảng thời gian nghiên cứu: {start_date} đến {end_date}")
-print(f"LƯU Ý: Đảm bảo dữ liệu Sentinel-2 và GEDI trong thư mục {data_dir} thuộc khoảng thời gian này")
-print("="*80)
 
-# 1. Xử lý dữ liệu Sentinel-2 với Dask để xử lý song song
-def process_sentinel():
-    print("Đang xử lý dữ liệu Sentinel-2...")
+# Tham số Random Forest (cũng là một phần của khóa mô hình trong model_store)
+FOREST_PARAMS = {'n_estimators': 100, 'random_state': 42}
+TRAINING_SAMPLES = 100000
+
+# Các backend tính toán song song có thể chọn
+BACKENDS = ('none', 'threads', 'processes', 'cuda')
+
+# Khởi tạo backend tính toán song song theo yêu cầu:
+# none - không dùng dask; threads/processes - dask LocalCluster; cuda - LocalCUDACluster (nếu có)
+def start_backend(kind='none'):
+    if kind == 'none':
+        return None
+    
+    from dask.distributed import Client, LocalCluster
+    if kind == 'cuda':
+        try:
+            from dask_cuda import LocalCUDACluster
+            cluster = LocalCUDACluster()  # Tận dụng GPU
+        except ImportError:
+            print("  Không tìm thấy dask_cuda, dùng LocalCluster đa tiến trình")
+            cluster = LocalCluster(processes=True)
+    else:
+        cluster = LocalCluster(processes=(kind == 'processes'))
+    
+    client = Client(cluster)
+    print(f"Dashboard: {client.dashboard_link}")
+    return client
+
+# Đường dẫn các file đầu vào
+def input_paths():
     sentinel_path = os.path.join(data_dir, "sentinel")
     
-    # Lấy danh sách file
-    sentinel_files = [os.path.join(sentinel_path, f) 
-                     for f in os.listdir(sentinel_path) 
-                     if f.endswith('.tif') or f.endswith('.jp2')]
-    
-    # Đọc tệp shapefile Gia Lai
-    gialai = gpd.read_file(os.path.join(data_dir, "vector/gialai.shp"))
-    
-    # Xử lý từng band
-    sentinel_data = {}
-    meta = None
-    
-    for file in sentinel_files:
-        band_name = os.path.basename(file).split('_')[2]  # Ví dụ: B04, B08...
-        print(f"  Đang đọc band {band_name}...")
-        
-        with rasterio.open(file) as src:
-            if meta is None:
-                meta = src.meta.copy()
-            
-            # Cắt theo ranh giới Gia Lai
-            out_image, out_transform = mask(src, gialai.geometry, crop=True)
-            
-            # Chuyển sang dask array để xử lý song song
-            data_array = da.from_array(out_image[0], chunks=(2048, 2048))
-            # Scale để chuyển thành độ phản xạ
-            data_array = data_array * 0.0001
-            
-            sentinel_data[band_name] = data_array
-            
-    # Tính các chỉ số thực vật
-    print("  Đang tính các chỉ số thực vật...")
-    
-    # Dùng dask để tính toán hiệu quả
-    ndvi = (sentinel_data['B08'] - sentinel_data['B04']) / (sentinel_data['B08'] + sentinel_data['B04'] + 1e-8)
-    
-    evi = 2.5 * ((sentinel_data['B08'] - sentinel_data['B04']) / 
-                 (sentinel_data['B08'] + 6 * sentinel_data['B04'] - 7.5 * sentinel_data['B02'] + 1))
-    
-    # Thêm các chỉ số vào kết quả
-    sentinel_data['ndvi'] = ndvi
-    sentinel_data['evi'] = evi
-    
-    # Chuyển thành numpy arrays (tính toán thực)
-    for band in sentinel_data:
-        sentinel_data[band] = sentinel_data[band].compute()
-    
-    return sentinel_data, meta, out_transform
+    # Lấy danh sách file Sentinel-2 theo tên band, ví dụ: B04, B08...
+    sentinel_files = {f.split('_')[2]: os.path.join(sentinel_path, f)
+                      for f in os.listdir(sentinel_path)
+                      if f.endswith('.tif') or f.endswith('.jp2')}
+    
+    return {
+        'sentinel': sentinel_files,
+        'dem': os.path.join(data_dir, "dem/glo30.tif"),
+        'gedi': os.path.join(data_dir, "gedi/gedi_agbd.tif"),
+        'vector': os.path.join(data_dir, "vector/gialai.shp"),
+        'worldcover': os.path.join(data_dir, "worldcover/worldcover.tif"),
+    }
+
+# 1. Xử lý dữ liệu Sentinel-2: đọc theo từng cửa sổ, không nạp toàn bộ band vào RAM.
+# gialai là ranh giới Gia Lai (GeoDataFrame) đã được đọc một lần trong main()
+def process_sentinel(gialai, block_size=2048, workers=None):
+    print("Đang xử lý dữ liệu Sentinel-2...")
+    paths = input_paths()
+    sentinel_files = paths['sentinel']
+    print(f"  Các band: {', '.join(sorted(sentinel_files))}")
+    
+    # File JPEG2000 được chuyển một lần sang GeoTIFF dạng tile trong cache (theo checksum),
+    # các lần đọc theo cửa sổ sau đó không phải giải mã JPEG2000 nữa
+    with stage('transcode'):
+        sentinel_files = transcode_jp2(sentinel_files, os.path.join(cache_dir, "jp2"), workers)
+    
+    # Căn chỉnh các band (ví dụ B11 20m) lên lưới của band có độ phân giải cao nhất
+    ref_grids = []
+    for path in sentinel_files.values():
+        with rasterio.open(path) as src:
+            ref_grids.append((abs(src.res[0] * src.res[1]), grid_of(src)))
+    grid = min(ref_grids, key=lambda item: item[0])[1]
+    sentinel_files = {band: align_raster(path, grid, LAYER_RESAMPLING['sentinel'], cache_dir, block_size)
+                      for band, path in sentinel_files.items()}
+    
+    # Reader cắt theo ranh giới Gia Lai, scale độ phản xạ và tính các chỉ số phổ cho từng cửa sổ
+    reader = SentinelReader(sentinel_files, gialai.geometry)
+    
+    return reader, reader.meta, reader.transform
 
-# 2. Xử lý DEM với CuPy để tận dụng GPU
-def process_dem(gialai):
+# 2. Xử lý DEM: tính độ dốc (độ) trên DEM gốc theo từng tile, sau đó căn chỉnh
+# DEM và độ dốc lên lưới chung. Dùng CuPy nếu có GPU, ngược lại chạy trên CPU.
+# Trả về AlignedReader của hai lớp; chúng được đọc theo cửa sổ khi ghép khối đặc trưng
+def process_dem(gialai, grid, workers=None, block_size=2048):
     print("Đang xử lý dữ liệu DEM...")
-    dem_file = os.path.join(data_dir, "dem/glo30.tif")
+    dem_file = input_paths()['dem']
     
     with rasterio.open(dem_file) as src:
-        dem, dem_transform = mask(src, gialai.geometry, crop=True)
-        dem = dem[0]
         dem_meta = src.meta.copy()
     
-    # Chuyển lên GPU để tính toán nhanh hơn
-    dem_gpu = cp.array(dem)
-    
-    # Tính độ dốc trên GPU
-    dx, dy = cp.gradient(dem_gpu)
-    slope_gpu = cp.sqrt(dx**2 + dy**2)
+    # Độ dốc được lưu trong cache, chỉ tính lại khi file DEM thay đổi
+    os.makedirs(cache_dir, exist_ok=True)
+    slope_file = os.path.join(cache_dir, f"slope_{source_key(dem_file, unit='degrees')[:16]}.tif")
+    if not os.path.exists(slope_file):
+        with stage('slope', dem_meta['width'] * dem_meta['height']):
+            compute_slope_raster(dem_file, slope_file, workers=workers)
     
-    # Chuyển về CPU
-    slope = cp.asnumpy(slope_gpu)
-    dem = cp.asnumpy(dem_gpu)
+    layers = AlignedReader({
+        'dem': align_raster(dem_file, grid, LAYER_RESAMPLING['dem'], cache_dir, block_size),
+        'slope': align_raster(slope_file, grid, LAYER_RESAMPLING['slope'], cache_dir, block_size),
+    }, grid, gialai.geometry.to_crs(grid.crs))
     
-    return {'dem': dem, 'slope': slope}, dem_meta, dem_transform
+    return layers, dem_meta, grid.transform
 
-# 3. Huấn luyện mô hình RandomForest
-def train_model(sentinel_data, dem_data, gedi_data):
-    print("Đang huấn luyện mô hình Random Forest...")
-    
-    # Kết hợp các đặc trưng
-    features = {}
-    for band, data in sentinel_data.items():
-        features[band] = data
-    
-    for name, data in dem_data.items():
-        features[name] = data
+# Ghép các đặc trưng thành khối (rows, cols, n_features) float32
+# Mỗi pixel là một hàng liên tục, thuận tiện cho việc lấy mẫu và dự đoán theo block.
+# Sentinel-2 và các lớp đã căn chỉnh (layers: AlignedReader của DEM, độ dốc) được đọc và
+# ghi vào khối theo từng cửa sổ; nếu cube là memmap trên đĩa thì bộ nhớ chỉ phụ thuộc kích
+# thước cửa sổ. gedi_layer (AlignedReader một lớp) được ghi cùng cửa sổ vào mảng gedi
+def build_feature_cube(sentinel_reader, layers, cube=None, block_size=2048, gedi_layer=None, gedi=None):
+    names = sentinel_reader.names + layers.names
+    rows, cols = sentinel_reader.shape
+    
+    if cube is None:
+        cube = np.empty((rows, cols, len(names)), dtype=np.float32)
+    
+    # Band, chỉ số phổ và các lớp căn chỉnh được ghi thẳng vào các lát của khối
+    for window in sentinel_reader.windows(block_size):
+        row_start, row_end, col_start, col_end = window
+        block = cube[row_start:row_end, col_start:col_end]
+        sentinel_reader.read(window, out={name: block[..., k] for k, name in enumerate(sentinel_reader.names)})
+        layers.read(window, out={name: block[..., k] for k, name in enumerate(names) if name in layers.names})
+        if gedi_layer is not None:
+            gedi_layer.read(window, out={gedi_layer.names[0]: gedi[row_start:row_end, col_start:col_end]})
+    
+    return cube, names
+
+# Chạy các bước 1-3 (Sentinel-2, DEM, GEDI) và ghi khối đặc trưng vào cache.
+# block_size, workers: kích thước cửa sổ và số tiến trình (theo planner)
+def prepare_features(feature_cache, key, gialai, block_size=2048, workers=None):
+    paths = input_paths()
     
-    # Lấy mẫu dữ liệu huấn luyện (không sử dụng tất cả pixel)
-    # Chia nhỏ giảm áp lực lên RAM
-    sample_size = 100000  # Số mẫu để huấn luyện
+    # 1. Xử lý Sentinel-2
+    sentinel_reader, sentinel_meta, sentinel_transform = process_sentinel(gialai, block_size, workers)
     
-    X = []
-    y = []
-    valid_mask = ~np.isnan(gedi_data)
-    valid_indices = np.where(valid_mask)
+    # Lưới chung: lưới Sentinel-2 đã cắt theo ranh giới Gia Lai
+    grid = TargetGrid(sentinel_meta['crs'], sentinel_transform, *sentinel_reader.shape[::-1])
     
-    if len(valid_indices[0]) > sample_size:
-        # Chọn ngẫu nhiên mẫu từ những điểm có dữ liệu
-        sample_idx = np.random.choice(len(valid_indices[0]), sample_size, replace=False)
-        rows = valid_indices[0][sample_idx]
-        cols = valid_indices[1][sample_idx]
+    # 2. Xử lý DEM
+    layers, dem_meta, dem_transform = process_dem(gialai, grid, workers, block_size)
+    
+    # 3. Căn chỉnh dữ liệu GEDI (đã được tiền xử lý) lên lưới chung. Khi chỉ huấn luyện
+    # trên footprint GEDI (--gedi-footprints) thì có thể không có raster GEDI
+    gedi_layer = None
+    if os.path.exists(paths['gedi']):
+        print("Đang căn chỉnh dữ liệu GEDI...")
+        gedi_layer = AlignedReader({'gedi': align_raster(paths['gedi'], grid, LAYER_RESAMPLING['gedi'],
+                                                         cache_dir, block_size)},
+                                   grid, gialai.geometry.to_crs(grid.crs))
+    else:
+        print(f"  Không tìm thấy {paths['gedi']}, bỏ qua raster GEDI")
+    
+    # Ghi trực tiếp vào memmap của cache
+    print("Đang ghép khối đặc trưng...")
+    names = sentinel_reader.names + layers.names
+    cube, gedi = feature_cache.create(key, sentinel_reader.shape, names)
+    if gedi_layer is None:
+        gedi[:] = np.nan
+    with stage('features', cube.shape[0] * cube.shape[1]):
+        build_feature_cube(sentinel_reader, layers, cube=cube, block_size=block_size,
+                           gedi_layer=gedi_layer, gedi=gedi)
+    sentinel_reader.close()
+    layers.close()
+    if gedi_layer is not None:
+        gedi_layer.close()
+    cube.flush()
+    gedi.flush()
+    del cube, gedi
+    
+    feature_cache.commit(key, {
+        'names': names,
+        'crs': grid.crs.to_wkt(),
+        'transform': list(grid.transform)[:6],
+        'shape': list(sentinel_reader.shape),
+        'inputs': paths,
+    })
+
+# Gộp khối đặc trưng lên lưới thô grid_res (mét), giống reduceResolution(mean) trong skun.py.
+# Khối thô được lưu thành một mục cache riêng, gộp theo dải hàng nên bộ nhớ có giới hạn.
+# grid_res được đổi sang pixel theo CRS của khối (kể cả CRS địa lý); nếu không phải bội số
+# nguyên của pixel gốc thì gộp bằng warp trung bình của GDAL
+def coarsen_features(feature_cache, key, grid_res):
+    coarse_key = FeatureCache.key([], features=key, grid_res=grid_res)
+    if feature_cache.has(coarse_key):
+        print(f"Dùng lại khối đặc trưng {grid_res:g} m trong cache ({coarse_key[:12]})")
+        return coarse_key
+    
+    cube, gedi, meta = feature_cache.load(key)
+    src_grid = TargetGrid(rasterio.crs.CRS.from_wkt(meta['crs']), rasterio.Affine(*meta['transform']),
+                          *meta['shape'][::-1])
+    grid, factor = coarse_grid_m(src_grid, grid_res)
+    coarse_cube, coarse_gedi = feature_cache.create(coarse_key, (grid.height, grid.width), meta['names'])
+    if factor is not None:
+        print(f"Đang gộp khối đặc trưng lên lưới {grid_res:g} m (khối {factor}x{factor} pixel)...")
+        aggregate_array(cube, factor, 'mean', out=coarse_cube)
+        aggregate_array(gedi, factor, 'mean', out=coarse_gedi)
     else:
-        rows = valid_indices[0]
-        cols = valid_indices[1]
+        print(f"Đang gộp khối đặc trưng lên lưới {grid_res:g} m ({grid.width} x {grid.height} pixel, warp trung bình)...")
+        warp_array(cube, src_grid, grid, 'mean', out=coarse_cube)
+        warp_array(gedi, src_grid, grid, 'mean', out=coarse_gedi)
+    coarse_cube.flush()
+    coarse_gedi.flush()
+    del coarse_cube, coarse_gedi
+    
+    feature_cache.commit(coarse_key, dict(meta, transform=list(grid.transform)[:6],
+                                          shape=[grid.height, grid.width], grid_res=grid_res))
+    return coarse_key
+
+# 3. Huấn luyện mô hình RandomForest. Với cv_folds > 0, trước khi huấn luyện mô hình cuối
+# sẽ đánh giá chéo không gian (các khối block_pixels pixel, hoặc (hàng, cột), không bị chia giữa
+# các fold).
+# samples: (X, y, hàng, cột) đã lấy sẵn, ví dụ từ footprint GEDI; mặc định lấy từ raster GEDI.
+# n_jobs: số luồng dựng cây (-1 = tất cả CPU cores).
+# Trả về (mô hình, báo cáo: RMSE, kết quả đánh giá chéo, số mẫu, dấu vân tay tập mẫu)
+def train_model(cube, gedi_data, sample_size=TRAINING_SAMPLES, seed=42, client=None, cv_folds=0, block_pixels=500,
+                samples=None, n_jobs=-1):
+    from sklearn.ensemble import RandomForestRegressor
+    
+    print("Đang huấn luyện mô hình Random Forest...")
     
-    for i, j in zip(rows, cols):
-        feature_vector = [features[k][i, j] for k in features if not np.isnan(features[k][i, j])]
-        if len(feature_vector) == len(features):  # Kiểm tra không có giá trị NaN
-            X.append(feature_vector)
-            y.append(gedi_data[i, j])
+    # Lấy mẫu dữ liệu huấn luyện (không sử dụng tất cả pixel) bằng RNG có seed
+    # để các lần chạy lấy cùng một tập mẫu
+    if samples is None:
+        with stage('sampling', gedi_data.size):
+            samples = sample_training(cube, gedi_data, sample_size, seed)
+    X, y, rows, cols = samples
+    print(f"  Số mẫu huấn luyện: {len(y):,}")
+    
+    report = {'n_samples': len(y), 'sample_fingerprint': sample_fingerprint(X, y),
+              'cv_rmse': None, 'cv_r2': None}
+    if cv_folds:
+        folds = spatial_folds(spatial_blocks(rows, cols, block_pixels), cv_folds, seed)
+        with stage('cv', len(y) * cv_folds):
+            report['cv_rmse'], report['cv_r2'] = cross_validate(
+                X, y, folds, {'n_estimators': FOREST_PARAMS['n_estimators']}, seed, n_jobs)
+        print(f"  Đánh giá chéo không gian {cv_folds} fold: "
+              f"RMSE {report['cv_rmse']:.4f}, R² {report['cv_r2']:.4f}")
     
     # Sử dụng Random Forest với cài đặt tận dụng đa nhân của CPU
     rf = RandomForestRegressor(
-        n_estimators=100,
-        n_jobs=-1,  # Sử dụng tất cả CPU cores
-        random_state=42
+        n_jobs=n_jobs,  # Mặc định sử dụng tất cả CPU cores
+        **FOREST_PARAMS
     )
-    rf.fit(X, y)
+    with stage('fit', len(y)):
+        if client is None:
+            rf.fit(X, y)
+        else:
+            # Phân phối việc dựng cây lên cụm dask qua joblib
+            import joblib
+            with joblib.parallel_config(backend='dask'):
+                rf.fit(X, y)
     
     # Tính RMSE trên tập huấn luyện
-    y_pred = rf.predict(X)
-    rmse = np.sqrt(np.mean((y - y_pred) ** 2))
-    print(f"  RMSE trên tập huấn luyện: {rmse:.4f}")
+    with stage('score', len(y)):
+        y_pred = rf.predict(X)
+    report['rmse'] = float(np.sqrt(np.mean((y - y_pred) ** 2)))
+    print(f"  RMSE trên tập huấn luyện: {report['rmse']:.4f}")
     
-    return rf, features
+    return rf, report
 
 # Hàm chính
-def main():
-    # Đọc dữ liệu shapefile
-    gialai = gpd.read_file(os.path.join(data_dir, "vector/gialai.shp"))
-    
-    # 1. Xử lý Sentinel-2
-    sentinel_data, sentinel_meta, sentinel_transform = process_sentinel()
-    
-    # 2. Xử lý DEM
-    dem_data, dem_meta, dem_transform = process_dem(gialai)
-    
-    # 3. Đọc dữ liệu GEDI (đã được tiền xử lý)
-    print("Đang đọc dữ liệu GEDI...")
-    with rasterio.open(os.path.join(data_dir, "gedi/gedi_agbd.tif")) as src:
-        gedi_data, gedi_transform = mask(src, gialai.geometry, crop=True)
-        gedi_data = gedi_data[0]
-    
-    # 4. Huấn luyện mô hình
-    model, features = train_model(sentinel_data, dem_data, gedi_data)
+def main(argv=None):
+    import pandas as pd
+    import geopandas as gpd
+    
+    parser = argparse.ArgumentParser(description="Phân tích sinh khối rừng Gia Lai")
+    parser.add_argument('--backend', choices=BACKENDS, default='none',
+                        help="Backend tính toán song song (mặc định: none)")
+    parser.add_argument('--rebuild-features', action='store_true',
+                        help="Bỏ qua cache và tính lại khối đặc trưng")
+    parser.add_argument('--cache-max-gb', type=float, default=100,
+                        help="Dung lượng tối đa của cache khối đặc trưng (GB)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Số tiến trình song song tối đa (1 = chạy tuần tự; mặc định: theo planner)")
+    parser.add_argument('--cores', type=int, default=os.cpu_count(),
+                        help="Số nhân CPU được dùng (mặc định: tất cả)")
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help="Ngân sách bộ nhớ (GB) để chọn kích thước cửa sổ, số tiến trình và số mẫu "
+                             "huấn luyện (mặc định: 80%% bộ nhớ vật lý)")
+    parser.add_argument('--predictor', choices=('sklearn', 'flat'), default='sklearn',
+                        help="Bộ dự đoán: sklearn - RandomForestRegressor; flat - FlatForest dạng mảng phẳng "
+                             "nạp bằng memory-map, các worker dùng chung một bản (ít bộ nhớ hơn; không nhanh "
+                             "hơn sklearn, chậm hơn ~0.6x với các cây sâu mà pipeline này huấn luyện)")
+    parser.add_argument('--output-dtype', choices=('float32', 'int16'), default='float32',
+                        help="Kiểu dữ liệu GeoTIFF đầu ra (int16 lưu với hệ số 0.1 Mg/ha)")
+    parser.add_argument('--compress', choices=('deflate', 'zstd'), default='deflate',
+                        help="Thuật toán nén GeoTIFF đầu ra")
+    parser.add_argument('--grid-res', type=float, default=None,
+                        help="Huấn luyện và dự đoán trên lưới thô (mét), ví dụ 100 như skun.py")
+    parser.add_argument('--uncertainty', action='store_true',
+                        help="Ghi thêm độ lệch chuẩn và phân vị 5/95 giữa các cây (GeoTIFF nhiều band)")
+    parser.add_argument('--cv-folds', type=int, default=0,
+                        help="Số fold đánh giá chéo theo khối không gian (0 = bỏ qua)")
+    parser.add_argument('--cv-block-size', type=float, default=DEFAULT_BLOCK_SIZE_M,
+                        help="Cạnh khối không gian khi đánh giá chéo (mét)")
+    parser.add_argument('--predict-only', action='store_true',
+                        help="Chỉ dự đoán bằng mô hình đã lưu cho cùng dữ liệu đầu vào, không huấn luyện")
+    parser.add_argument('--retrain', action='store_true',
+                        help="Huấn luyện lại và lưu thành phiên bản mới dù đã có mô hình phù hợp")
+    parser.add_argument('--zones', default=None,
+                        help="Shapefile các vùng (huyện/xã) để thống kê sinh khối theo vùng "
+                             "(mặc định: ranh giới trong thư mục vector)")
+    parser.add_argument('--zone-field', default=None,
+                        help="Cột tên vùng trong shapefile (mặc định: ADM3_VI/ADM2_VI/ADM1_VI nếu có)")
+    parser.add_argument('--gedi-footprints', default=None,
+                        help="Kho footprint GEDI L4A (tạo bằng gedi_footprints.py): huấn luyện trên từng "
+                             "footprint thay vì raster GEDI 500 m")
+    parser.add_argument('--profile-stage', choices=STAGES, default=None,
+                        help="Profile một bước (cProfile hoặc lấy mẫu ngăn xếp), ghi cùng báo cáo hiệu năng")
+    parser.add_argument('--profile-mode', choices=('cprofile', 'sample'), default='cprofile',
+                        help="cprofile - thống kê mọi lời gọi hàm; sample - lấy mẫu ngăn xếp (ít ảnh hưởng hơn)")
+    args = parser.parse_args(argv)
+    
+    # Ghi nhận thời gian, CPU, bộ nhớ và I/O của từng bước; báo cáo được ghi cùng kết quả
+    recorder = activate(Recorder(args.profile_stage, args.profile_mode))
+    
+    os.makedirs(output_dir, exist_ok=True)
+    print("="*80)
+    print(f"THÔNG TIN DỰ ÁN: Phân tích sinh khối rừng Gia Lai")
+    print(f"Khoảng thời gian nghiên cứu: {start_date} đến {end_date}")
+    print(f"LƯU Ý: Đảm bảo dữ liệu Sentinel-2 và GEDI trong thư mục {data_dir} thuộc khoảng thời gian này")
+    print("="*80)
+    
+    # 1-3. Khối đặc trưng: dùng lại cache nếu các file đầu vào và tham số không đổi
+    paths = input_paths()
+    gialai = gpd.read_file(paths['vector'])
+    inputs = [*paths['sentinel'].values(), paths['dem']]
+    inputs += [paths['gedi']] if os.path.exists(paths['gedi']) else []
+    vector_stem = os.path.splitext(paths['vector'])[0]
+    inputs += [vector_stem + ext for ext in ('.shp', '.shx', '.dbf', '.prj') if os.path.exists(vector_stem + ext)]
+    
+    feature_cache = FeatureCache(os.path.join(cache_dir, "features"),
+                                 max_bytes=int(args.cache_max_gb * 1024 ** 3))
+    key = FeatureCache.key(inputs, reflectance_scale=REFLECTANCE_SCALE,
+                           resampling={k: v.name for k, v in LAYER_RESAMPLING.items()},
+                           indices={name: str(spec) for name, spec in INDICES.items()})
+    if args.rebuild_features:
+        feature_cache.invalidate(key)
+    footprints = FootprintStore(args.gedi_footprints) if args.gedi_footprints else None
+    
+    # Kế hoạch bộ nhớ: chọn kích thước cửa sổ, số tiến trình và số mẫu huấn luyện theo kích
+    # thước lưới và số band; dừng trước khi chạy nếu cả cấu hình nhỏ nhất cũng vượt ngân sách
+    budget = int(args.memory_budget * 1024 ** 3) if args.memory_budget else default_budget()
+    cores = min(args.cores, args.workers or args.cores)
+    if budget is None:
+        print("Không xác định được bộ nhớ vật lý, bỏ qua kế hoạch bộ nhớ (đặt --memory-budget để giới hạn)")
+        memory_plan = {'block_size': 1024, 'workers': cores, 'sample_size': TRAINING_SAMPLES}
+    else:
+        # Bước đặc trưng đã có trong cache và (với --predict-only) các bước lấy mẫu/huấn luyện
+        # không chạy nên không tính vào ngân sách
+        skip = ('features',) if feature_cache.has(key) else ()
+        skip += ('sampling', 'train') if args.predict_only else ()
+        info = inspect_inputs(paths['sentinel'], gialai.geometry)
+        memory_plan = plan(info['rows'], info['cols'], info['bands'], info['features'], budget, cores,
+                           TRAINING_SAMPLES, skip=skip,
+                           predictor=args.predictor, stats=len(UNCERTAINTY_STATS) if args.uncertainty else 0,
+                           grid_shape=coarse_shape(info, args.grid_res) if args.grid_res else None,
+                           gedi_raster=os.path.exists(paths['gedi']),
+                           footprints=len(footprints) if footprints is not None else 0)
+        print("Kế hoạch bộ nhớ:")
+        print(describe(memory_plan))
+        if not memory_plan['fits']:
+            print("Hãy tăng --memory-budget, dùng --grid-res để giảm kích thước lưới hoặc chạy trên máy nhiều RAM hơn")
+            deactivate()
+            return 1
+    workers = memory_plan['workers']
+    sample_size = memory_plan['sample_size']
+    
+    # Thiết lập xử lý song song (chỉ khởi tạo khi chạy, không khởi tạo lúc import)
+    client = start_backend(args.backend)
+    
+    if feature_cache.has(key):
+        print(f"Dùng lại khối đặc trưng trong cache ({key[:12]})")
+    else:
+        prepare_features(feature_cache, key, gialai, memory_plan['block_size'], workers)
+    if args.grid_res:
+        key = coarsen_features(feature_cache, key, args.grid_res)
+    cube, gedi_data, cube_meta = feature_cache.load(key)
+    names = cube_meta['names']
+    crs = rasterio.crs.CRS.from_wkt(cube_meta['crs'])
+    transform = rasterio.Affine(*cube_meta['transform'])
+    
+    # 4. Huấn luyện mô hình, hoặc dùng lại mô hình đã lưu cho cùng khối đặc trưng và tham số.
+    # Khóa dùng số mẫu yêu cầu (TRAINING_SAMPLES), không phải số mẫu kế hoạch bộ nhớ chọn, để
+    # đổi --memory-budget không làm mất mô hình đã lưu; số mẫu kế hoạch và số mẫu thực tế nằm
+    # trong model.json. Mô hình được huấn luyện với kế hoạch ít mẫu hơn lần này (ngân sách bộ
+    # nhớ chặt hơn) thì được huấn luyện lại, trừ khi --predict-only
+    model_store = ModelStore(os.path.join(cache_dir, "models"))
+    model_params = {'forest': FOREST_PARAMS, 'sample_size': TRAINING_SAMPLES, 'seed': 42}
+    if footprints is not None:
+        model_params['gedi_footprints'] = footprints.key
+    model_key = ModelStore.key(key, **model_params)
+    model_dir = model_store.latest(model_key)
+    if args.predict_only and model_dir is None:
+        print(f"Không có mô hình đã lưu cho dữ liệu đầu vào này ({model_key[:12]}); hãy chạy không có --predict-only")
+        if client is not None:
+            client.close()
+        deactivate()
+        return 1
+    
+    report = ModelStore.meta(model_dir) if model_dir is not None else None
+    undersampled = (report is not None
+                    and report.get('planned_samples', report.get('n_samples', 0)) < sample_size)
+    if undersampled and not (args.predict_only or args.retrain):
+        print(f"Mô hình đã lưu {model_key[:12]}/{report['version']} chỉ dùng "
+              f"{report.get('n_samples', 0):,} mẫu (kế hoạch lần này {sample_size:,} mẫu), huấn luyện lại")
+    
+    if report is not None and (args.predict_only or not (args.retrain or undersampled)):
+        if report['names'] != names:
+            raise ValueError("Thứ tự đặc trưng của mô hình đã lưu không khớp với khối đặc trưng")
+        print(f"Dùng lại mô hình đã lưu {model_key[:12]}/{report['version']} "
+              f"({report.get('n_samples', 0):,} mẫu, RMSE {report['rmse']:.4f})")
+        model = ModelStore.load(model_dir)
+    else:
+        block_pixels = block_pixels_of(args.cv_block_size, transform, crs, cube.shape[0])
+        samples = None
+        if footprints is not None:
+            # Đặc trưng tại pixel chứa từng footprint, đọc theo ô của chỉ mục lưới
+            print(f"Đang lấy mẫu tại {len(footprints):,} footprint GEDI...")
+            with stage('sampling', len(footprints)):
+                samples = sample_footprints(footprints, cube, TargetGrid(crs, transform, *cube.shape[1::-1]),
+                                            sample_size, 42)
+        model, report = train_model(cube, gedi_data, sample_size, client=client, cv_folds=args.cv_folds,
+                                    block_pixels=block_pixels, samples=samples, n_jobs=workers)
+        model_dir = model_store.save(model_key, model, dict(
+            report, names=names, feature_key=key, inputs=input_hashes(inputs), planned_samples=sample_size))
+        print(f"  Đã lưu mô hình: {model_dir}")
+    rmse = report['rmse']
     
     # 5. Dự đoán sinh khối
     print("Đang dự đoán sinh khối...")
     
-    # Tạo mảng đặc trưng cho dự đoán
-    rows, cols = dem_data['dem'].shape
-    prediction_map = np.full((rows, cols), np.nan)
-    
-    # Dự đoán theo blocks để tiết kiệm bộ nhớ
-    block_size = 1000
-    for row_start in range(0, rows, block_size):
-        for col_start in range(0, cols, block_size):
-            row_end = min(row_start + block_size, rows)
-            col_end = min(col_start + block_size, cols)
-            
-            # Lấy mẫu trong block
-            block_features = []
-            block_indices = []
-            
-            for i in range(row_start, row_end):
-                for j in range(col_start, col_end):
-                    # Kiểm tra điều kiện độ dốc và mặt nạ
-                    if dem_data['slope'][i, j] <= 30:
-                        feature_vector = [features[k][i, j] for k in features 
-                                         if not np.isnan(features[k][i, j])]
-                        if len(feature_vector) == len(features):
-                            block_features.append(feature_vector)
-                            block_indices.append((i, j))
-            
-            if block_features:
-                # Dự đoán sinh khối cho block
-                block_predictions = model.predict(block_features)
-                
-                # Gán kết quả vào bản đồ dự đoán
-                for idx, (i, j) in enumerate(block_indices):
-                    prediction_map[i, j] = block_predictions[idx]
+    # Mô hình dùng để dự đoán: FlatForest (mảng phẳng, nạp bằng memory-map; được xuất từ
+    # mô hình sklearn ở lần đầu dùng) hoặc sklearn; các worker nạp lại từ thư mục phiên bản
+    if args.predictor == 'flat':
+        predictor_path = ModelStore.forest(model_dir)
+        predictor = FlatForest.load(predictor_path)
+    else:
+        predictor = model
+        predictor_path = os.path.join(model_dir, "model.joblib")
+    
+    # Tổng sinh khối được cộng dồn trong lúc ghi: nhân với diện tích thật của pixel và
+    # chỉ giữ các lớp WorldCover như skun.py (nếu có file WorldCover)
+    rows, cols = cube.shape[:2]
+    grid = TargetGrid(crs, transform, cols, rows)
+    landcover_file = None
+    if os.path.exists(paths['worldcover']):
+        landcover_file = align_raster(paths['worldcover'], grid, LAYER_RESAMPLING['worldcover'], cache_dir)
+    else:
+        print(f"  Không tìm thấy {paths['worldcover']}, tổng sinh khối không áp dụng mặt nạ lớp phủ")
+    
+    # Thống kê theo vùng: rasterize các vùng một lần lên lưới dự đoán (có cache),
+    # ZonalStats cộng dồn cả tổng toàn tỉnh lẫn thống kê từng vùng trong cùng một lượt
+    zones_path = args.zones or paths['vector']
+    zones = gialai if zones_path == paths['vector'] else gpd.read_file(zones_path)
+    zone_field = args.zone_field or next((field for field in ('ADM3_VI', 'ADM2_VI', 'ADM1_VI')
+                                          if field in zones.columns), None)
+    labels_file = rasterize_zones(zones, zones_path, grid, cache_dir)
+    biomass_total = ZonalStats(grid, labels_file, len(zones), landcover_file)
+    
+    # Dự đoán theo tile song song; mỗi block được ghép thành một mảng đặc trưng,
+    # gọi predict một lần và ghi thẳng vào GeoTIFF
+    block_size = memory_plan['block_size']  # Bội số của kích thước tile GeoTIFF để mỗi tile chỉ được ghi một lần
+    output_file = os.path.join(output_dir, "sinh_khoi_gia_lai.tif")
+    # Chế độ độ bất định: band 1 là trung bình, các band sau là std, p05, p95 (Mg/ha)
+    stats = UNCERTAINTY_STATS if args.uncertainty else None
+    descriptions = ['agbd'] + [f'agbd_{stat}' for stat in stats[1:]] if stats else ['agbd']
+    with stage('predict', rows * cols), \
+            BiomassWriter(output_file, crs, transform, cols, rows, count=len(descriptions),
+                          dtype=args.output_dtype, compress=args.compress,
+                          descriptions=descriptions) as writer:
+        n_predicted, biomass_sum = predict_to_raster(
+            predictor, cube, names.index('slope'), writer, model_path=predictor_path,
+            block_size=block_size, workers=workers, client=client,
+            accumulators=[biomass_total], stats=stats)
+    biomass_total.close()
     
     # 6. Lưu kết quả
     print("Đang lưu kết quả...")
     
-    # Lưu bản đồ sinh khối dưới dạng GeoTIFF
-    with rasterio.open(
-        os.path.join(output_dir, "sinh_khoi_gia_lai.tif"),
-        'w',
-        driver='GTiff',
-        height=rows,
-        width=cols,
-        count=1,
-        dtype=prediction_map.dtype,
-        crs=sentinel_meta['crs'],
-        transform=sentinel_transform
-    ) as dst:
-        dst.write(prediction_map, 1)
-    
-    # Tính tổng sinh khối
-    pixel_area_ha = 0.01  # Diện tích pixel theo hecta (giả định độ phân giải 10m)
-    total_biomass = np.nansum(prediction_map) * pixel_area_ha
-    print(f"Tổng sinh khối ước tính: {total_biomass:.2f} Mg")
+    # Tổng sinh khối = tổng (sinh khối x diện tích pixel) trên các pixel thuộc lớp phủ rừng
+    total_biomass = biomass_total.total
+    print(f"Tổng sinh khối ước tính: {total_biomass:.2f} Mg "
+          f"trên {biomass_total.area_ha:,.1f} ha")
     
     # Lưu kết quả số liệu 
     results = pd.DataFrame({
-        'Metric': ['RMSE', 'Total_Biomass_Mg'],
-        'Value': [np.sqrt(np.mean((model.predict(block_features) - block_predictions) ** 2)), total_biomass]
+        'Metric': ['RMSE', 'Total_Biomass_Mg', 'Masked_Area_ha'],
+        'Value': [rmse, total_biomass, biomass_total.area_ha]
     })
+    if report.get('cv_rmse') is not None:
+        results = pd.concat([results, pd.DataFrame({'Metric': ['CV_RMSE', 'CV_R2'],
+                                                    'Value': [report['cv_rmse'], report['cv_r2']]})],
+                            ignore_index=True)
     results.to_csv(os.path.join(output_dir, "ket_qua_sinh_khoi.csv"), index=False)
     
-    # Tạo bản đồ
-    plt.figure(figsize=(12, 10))
-    plt.imshow(prediction_map, cmap='viridis')
-    plt.colorbar(label='Sinh khối (Mg/ha)')
-    plt.title('Bản đồ sinh khối rừng tỉnh Gia Lai')
-    plt.savefig(os.path.join(output_dir, "ban_do_sinh_khoi.png"), dpi=300)
+    # Thống kê sinh khối theo vùng
+    zone_table = biomass_total.table(list(zones[zone_field]) if zone_field else None)
+    zone_table.to_csv(os.path.join(output_dir, "thong_ke_theo_vung.csv"), index=False)
+    print(f"  Đã ghi thống kê cho {len(zone_table)} vùng vào thong_ke_theo_vung.csv")
+    
+    # Tạo bản đồ xem nhanh từ overview của GeoTIFF
+    with stage('plot'):
+        render_preview(output_file, os.path.join(output_dir, "ban_do_sinh_khoi.png"),
+                       title='Bản đồ sinh khối rừng tỉnh Gia Lai', label='Sinh khối (Mg/ha)')
+    
+    if client is not None:
+        client.close()
+    
+    # Báo cáo hiệu năng (JSON + CSV) cạnh ket_qua_sinh_khoi.csv
+    deactivate()
+    report_path = recorder.write(os.path.join(output_dir, "bao_cao_hieu_nang"),
+                                 pixels=rows * cols, backend=args.backend, workers=workers,
+                                 predictor=args.predictor, memory_plan=memory_plan)
+    print("Hiệu năng theo từng bước:")
+    print(recorder.summary())
+    print(f"  Đã ghi báo cáo hiệu năng: {report_path}")
     
     print(f"Hoàn tất! Kết quả đã được lưu trong thư mục {output_dir}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
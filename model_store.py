@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+
+from transcode import file_checksum
+
+# Tăng khi thay đổi định dạng hoặc cách huấn luyện để không dùng lại mô hình cũ
+STORE_VERSION = 1
+
+
+# Dấu vân tay của tập mẫu huấn luyện (X, y): hash nội dung mảng
+def sample_fingerprint(X, y):
+    digest = hashlib.sha1()
+    for array in (X, y):
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.shape, array.dtype.str)).encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+# Lưu trữ các mô hình đã huấn luyện. Mỗi khóa (khối đặc trưng + tham số huấn luyện) là một
+# thư mục <root>/<key>/ chứa các phiên bản v0001, v0002, ...; mỗi phiên bản gồm:
+#   model.joblib - RandomForestRegressor của sklearn (không nén)
+#   forest/      - cùng mô hình dạng FlatForest (.npy), chỉ được xuất khi cần (--predictor flat)
+#   model.json   - thứ tự đặc trưng, dấu vân tay mẫu, tham số, RMSE, SHA-1 các file đầu vào
+class ModelStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    # Khóa mô hình: khóa khối đặc trưng (đã gồm hash các file đầu vào) + tham số huấn luyện
+    @staticmethod
+    def key(feature_key, **params):
+        payload = {'version': STORE_VERSION, 'features': feature_key, 'params': params}
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def versions(self, key):
+        entry = self.path(key)
+        if not os.path.isdir(entry):
+            return []
+        return sorted(v for v in os.listdir(entry)
+                      if v.startswith('v') and os.path.exists(os.path.join(entry, v, 'model.json')))
+
+    # Thư mục phiên bản mới nhất của khóa, hoặc None nếu chưa có mô hình
+    def latest(self, key):
+        versions = self.versions(key)
+        return os.path.join(self.path(key), versions[-1]) if versions else None
+
+    # Lưu mô hình thành phiên bản mới; ghi vào thư mục tạm rồi đổi tên
+    def save(self, key, model, meta):
+        import joblib
+
+        versions = self.versions(key)
+        version = f"v{int(versions[-1][1:]) + 1 if versions else 1:04d}"
+        target = os.path.join(self.path(key), version)
+        tmp = target + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        joblib.dump(model, os.path.join(tmp, 'model.joblib'))
+        meta = dict(meta, key=key, version=version, created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    hyperparameters={k: v for k, v in model.get_params().items()})
+        with open(os.path.join(tmp, 'model.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp, target)
+        return target
+
+    @staticmethod
+    def meta(version_dir):
+        with open(os.path.join(version_dir, 'model.json'), encoding='utf-8') as f:
+            return json.load(f)
+
+    # Nạp mô hình sklearn của một phiên bản. Cây của sklearn chép các mảng nút vào bộ nhớ
+    # riêng khi unpickle, nên mỗi tiến trình nạp mô hình giữ một bản đầy đủ (chỉ FlatForest
+    # mới dùng chung được qua memory-map, xem forest())
+    @staticmethod
+    def load(version_dir):
+        import joblib
+        return joblib.load(os.path.join(version_dir, 'model.joblib'))
+
+    # Thư mục FlatForest của một phiên bản; xuất từ model.joblib ở lần đầu được yêu cầu
+    # (ghi vào thư mục tạm rồi đổi tên). FlatForest được nạp bằng memory-map nên các worker
+    # dùng chung một bản trong page cache
+    @staticmethod
+    def forest(version_dir):
+        from forest_kernel import FlatForest
+
+        target = os.path.join(version_dir, 'forest')
+        if not os.path.exists(os.path.join(target, 'forest.json')):
+            tmp = target + '.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            FlatForest.from_sklearn(ModelStore.load(version_dir)).save(tmp)
+            shutil.rmtree(target, ignore_errors=True)
+            os.replace(tmp, target)
+        return target
+
+    # Danh sách (key, phiên bản, RMSE, thời điểm tạo) của mọi mô hình
+    def entries(self):
+        result = []
+        for key in sorted(os.listdir(self.root)):
+            for version in self.versions(key):
+                meta = self.meta(os.path.join(self.path(key), version))
+                result.append((key, version, meta.get('rmse'), meta.get('created')))
+        return result
+
+
+# SHA-1 nội dung của từng file đầu vào, ghi vào metadata mô hình; tính lại mỗi lần lưu (chỉ
+# sau khi huấn luyện) nên chạm mtime hay sao chép file không đổi giá trị, còn sửa nội dung thì có
+def input_hashes(paths):
+    return {path: file_checksum(path) for path in paths if os.path.exists(path)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quản lý các mô hình đã huấn luyện")
+    parser.add_argument('root', help="Thư mục lưu mô hình, ví dụ <output_dir>/cache/models")
+    parser.add_argument('command', choices=('list', 'show'))
+    parser.add_argument('key', nargs='?', help="Khóa mô hình (cho lệnh show)")
+    args = parser.parse_args(argv)
+
+    store = ModelStore(args.root)
+    if args.command == 'list':
+        for key, version, rmse, created in store.entries():
+            rmse = f"{rmse:.4f}" if rmse is not None else '-'
+            print(f"{key}  {version}  RMSE {rmse}  {created}")
+    else:
+        version_dir = store.latest(args.key)
+        if version_dir is None:
+            print(f"Không có mô hình cho khóa {args.key}")
+            return 1
+        print(json.dumps(store.meta(version_dir), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
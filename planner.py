@@ -0,0 +1,247 @@
+import os
+import sys
+import argparse
+
+from raster_output import BLOCK_SIZE as TILE_SIZE
+from prediction import UNCERTAINTY_CHUNK, UNCERTAINTY_STATS
+
+# Lập kế hoạch bộ nhớ cho local.py: từ kích thước lưới, số band, ngân sách bộ nhớ và số
+# nhân CPU, chọn kích thước cửa sổ, số tiến trình song song và số mẫu huấn luyện sao cho
+# đỉnh bộ nhớ ước tính của từng bước nằm trong ngân sách. Các hệ số dưới đây được đo trên
+# dữ liệu tổng hợp của benchmark.py (tracemalloc và kích thước mô hình đã lưu)
+
+# Kích thước cửa sổ có thể chọn (bội số của tile GeoTIFF đầu ra), ưu tiên cửa sổ lớn
+BLOCK_SIZES = (4 * TILE_SIZE, 2 * TILE_SIZE, TILE_SIZE)
+
+# Khối đặc trưng luôn là float32: cây của sklearn so sánh ngưỡng ở float32 nên float64
+# chỉ tốn gấp đôi bộ nhớ (và dung lượng cache) mà không thay đổi kết quả dự đoán
+FEATURE_DTYPE = 'float32'
+FEATURE_BYTES = 4
+
+# Số mẫu huấn luyện nhỏ nhất planner được phép giảm xuống
+MIN_SAMPLES = 20000
+
+# Phần bộ nhớ vật lý dùng làm ngân sách mặc định
+MEMORY_FRACTION = 0.8
+
+# Bộ nhớ nền của tiến trình chính (Python, numpy, rasterio, geopandas, sklearn) và của mỗi
+# worker (fork từ tiến trình chính nên phần lớn trang nhớ dùng chung)
+PROCESS_BYTES = 400 * 1024 ** 2
+WORKER_BYTES = 100 * 1024 ** 2
+
+# Đọc một cửa sổ của lớp đã căn chỉnh (DEM, độ dốc, GEDI qua AlignedReader): mảng masked
+# float32, bản sao đã điền NaN và mặt nạ ranh giới (~10 byte/pixel, từng lớp một)
+READ_OVERHEAD = 10
+
+# Tile tính độ dốc (terrain.compute_slope_raster, 2048 + halo) trong mỗi worker: DEM, mặt nạ,
+# gradient hai chiều và kết quả
+SLOPE_TILE_BYTES = 6 * 2050 ** 2 * 4
+
+# Lấy mẫu từ raster GEDI: mặt nạ bool và chỉ số int64 của các pixel có GEDI (tối đa cả lưới)
+SAMPLING_BYTES = 9
+# Mỗi footprint GEDI: kinh/vĩ độ, agbd, vị trí pixel và chỉ mục lưới
+FOOTPRINT_BYTES = 40
+
+# Số nút của một cây hồi quy sâu tối đa trên mỗi mẫu huấn luyện (đo được ~1.26) và số byte
+# mỗi nút: cây sklearn (struct Node + giá trị float64), FlatForest (các mảng phẳng)
+NODES_PER_SAMPLE = 1.3
+NODE_BYTES = {'sklearn': 72, 'flat': 21}
+# Bộ nhớ làm việc của mỗi luồng dựng cây (chỉ số mẫu, giá trị đặc trưng đã sắp xếp)
+BUILDER_BYTES = 40
+
+# Số byte mỗi (cây x pixel) trong một lô UNCERTAINTY_CHUNK ở chế độ độ bất định: bộ đệm
+# float32 và bản sao của np.percentile
+TREE_VALUE_BYTES = 13
+
+# Bản đồ xem nhanh (raster_output.render_preview): overview tối đa 2048 x 2048 và hình
+# matplotlib 300 dpi, không phụ thuộc kích thước lưới
+PREVIEW_BYTES = 512 * 1024 ** 2
+
+
+# Ngân sách mặc định (byte): MEMORY_FRACTION bộ nhớ vật lý, None nếu không đọc được
+def default_budget():
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * MEMORY_FRACTION)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+# Kích thước lưới đặc trưng từ header các file Sentinel-2 ({band: đường dẫn}), không đọc
+# pixel: lưới của band có độ phân giải cao nhất, cắt theo hình chữ nhật bao geometry
+# (GeoSeries) như SentinelReader. Trả về {'rows', 'cols', 'grid', 'bands', 'features'}
+def inspect_inputs(sentinel_files, geometry=None, extra_features=('dem', 'slope')):
+    import rasterio
+    from rasterio.features import geometry_window
+    from alignment import TargetGrid
+    from spectral_indices import available_indices
+
+    finest = None
+    for path in sentinel_files.values():
+        with rasterio.open(path) as src:
+            area = abs(src.res[0] * src.res[1])
+            if finest is None or area < finest[0]:
+                finest = (area, path)
+
+    with rasterio.open(finest[1]) as src:
+        grid = TargetGrid(src.crs, src.transform, src.width, src.height)
+        if geometry is not None:
+            window = geometry_window(src, list(geometry.to_crs(src.crs)))
+            window = window.round_offsets().round_lengths()
+            grid = TargetGrid(src.crs, src.window_transform(window), int(window.width), int(window.height))
+
+    bands = sorted(sentinel_files)
+    n_features = len(bands) + len(available_indices(bands)) + len(extra_features)
+    return {'rows': grid.height, 'cols': grid.width, 'grid': grid, 'bands': len(bands),
+            'features': n_features}
+
+
+# Kích thước (hàng, cột) lưới thô grid_res (mét) của lưới đặc trưng info, như coarsen_features
+# trong local.py
+def coarse_shape(info, grid_res):
+    from aggregation import coarse_grid_m
+
+    grid = coarse_grid_m(info['grid'], grid_res)[0]
+    return grid.height, grid.width
+
+
+# Đỉnh bộ nhớ ước tính (byte) của từng bước với một cấu hình. grid_shape: lưới huấn luyện và
+# dự đoán (lưới thô khi dùng --grid-res, mặc định là lưới đặc trưng); stats: số band độ bất
+# định (0 = chỉ trung bình); gedi_raster: có raster GEDI toàn lưới; footprints: số footprint
+# GEDI dùng để lấy mẫu
+def estimate(rows, cols, bands, features, block_size, workers, sample_size, predictor='sklearn',
+             n_trees=100, stats=0, grid_shape=None, gedi_raster=True, footprints=0):
+    rows_out, cols_out = grid_shape or (rows, cols)
+    if footprints:
+        sample_size = min(sample_size, footprints)
+    window = block_size ** 2
+
+    # Ghép khối đặc trưng: cửa sổ Sentinel-2 (band thô, độ phản xạ, bộ đệm chỉ số phổ), cửa
+    # sổ các lớp đã căn chỉnh và các tile độ dốc song song
+    features_bytes = (window * ((2 * bands + 8) * FEATURE_BYTES + READ_OVERHEAD)
+                      + workers * SLOPE_TILE_BYTES)
+
+    # Lấy mẫu: chỉ số các pixel có GEDI (hoặc các footprint) và ma trận mẫu
+    samples_bytes = 2 * sample_size * features * FEATURE_BYTES
+    if gedi_raster and not footprints:
+        sampling_bytes = rows_out * cols_out * SAMPLING_BYTES + samples_bytes
+    else:
+        sampling_bytes = footprints * FOOTPRINT_BYTES + samples_bytes
+
+    # Huấn luyện: mô hình sklearn và bộ nhớ làm việc của các luồng dựng cây
+    model_bytes = int(n_trees * NODES_PER_SAMPLE * sample_size * NODE_BYTES['sklearn'])
+    train_bytes = samples_bytes + model_bytes + min(workers, n_trees) * sample_size * BUILDER_BYTES
+
+    # Dự đoán: mỗi worker giữ cửa sổ đặc trưng (bản liền mạch và các pixel hợp lệ), kết quả
+    # float64, bản sao mô hình sklearn (FlatForest được memory-map nên dùng chung một bản);
+    # tiến trình chính giữ mô hình và tối đa 2 x workers cửa sổ kết quả chờ ghi
+    window = min(window, rows_out * cols_out)
+    per_window = window * (2 * features * FEATURE_BYTES + 32 + 8 * stats)
+    if stats:
+        per_window += min(window, UNCERTAINTY_CHUNK) * n_trees * TREE_VALUE_BYTES
+    elif predictor == 'flat':
+        per_window += window * n_trees * FEATURE_BYTES
+    flat_bytes = int(n_trees * NODES_PER_SAMPLE * sample_size * NODE_BYTES['flat'])
+    if workers == 1:
+        predict_bytes = model_bytes + per_window
+    else:
+        worker_model = model_bytes if predictor == 'sklearn' else 0
+        predict_bytes = (model_bytes + 2 * workers * window * 8 * max(stats, 1)
+                         + workers * (WORKER_BYTES + worker_model + per_window))
+    if predictor == 'flat':
+        predict_bytes += flat_bytes
+
+    return {name: PROCESS_BYTES + value for name, value in (
+        ('features', features_bytes), ('sampling', sampling_bytes),
+        ('train', train_bytes), ('predict', predict_bytes), ('plot', PREVIEW_BYTES))}
+
+
+# Các số mẫu được thử: sample_size, rồi giảm một nửa mỗi lần cho tới MIN_SAMPLES
+def _sample_sizes(sample_size):
+    sizes = [sample_size]
+    while sizes[-1] > MIN_SAMPLES:
+        sizes.append(max(sizes[-1] // 2, MIN_SAMPLES))
+    return sizes
+
+
+# Chọn cấu hình trong ngân sách budget (byte) với tối đa cores tiến trình. Ưu tiên giữ số mẫu
+# huấn luyện (ảnh hưởng tới mô hình), rồi số tiến trình (tốc độ), rồi cửa sổ lớn. Trả về dict
+# kế hoạch; 'fits' là False (kèm ước tính của cấu hình nhỏ nhất) nếu không cấu hình nào vừa.
+# skip: các bước không chạy lần này (ví dụ 'features' khi khối đặc trưng đã có trong cache).
+# Các tham số khác giống estimate()
+def plan(rows, cols, bands, features, budget, cores, sample_size, skip=(), **options):
+    def stages_of(block_size, workers, samples):
+        stages = estimate(rows, cols, bands, features, block_size, workers, samples, **options)
+        return {name: value for name, value in stages.items() if name not in skip}
+
+    best = None
+    for samples in _sample_sizes(sample_size):
+        for block_size in BLOCK_SIZES:
+            for workers in range(cores, 0, -1):
+                stages = stages_of(block_size, workers, samples)
+                if max(stages.values()) <= budget:
+                    break
+            else:
+                continue
+            if best is None or workers > best['workers']:
+                best = {'block_size': block_size, 'workers': workers, 'sample_size': samples, 'stages': stages}
+            if workers == cores:
+                break
+        if best is not None:
+            break
+
+    fits = best is not None
+    if not fits:
+        samples = _sample_sizes(sample_size)[-1]
+        best = {'block_size': BLOCK_SIZES[-1], 'workers': 1, 'sample_size': samples,
+                'stages': stages_of(BLOCK_SIZES[-1], 1, samples)}
+    peak = max(best['stages'].values())
+    return dict(best, fits=fits, dtype=FEATURE_DTYPE, budget=budget, cores=cores, peak=peak,
+                limit=max(best['stages'], key=best['stages'].get), shape=[rows, cols], features=features)
+
+
+# Mô tả kế hoạch để in ra màn hình
+def describe(result):
+    gb = 1024 ** 3
+    lines = [f"  Ngân sách {result['budget'] / gb:.1f} GB, {result['cores']} nhân, lưới "
+             f"{result['shape'][0]:,} x {result['shape'][1]:,} pixel, {result['features']} đặc trưng {result['dtype']}",
+             f"  Cửa sổ {result['block_size']} px, {result['workers']} tiến trình, "
+             f"{result['sample_size']:,} mẫu huấn luyện"]
+    for name, value in result['stages'].items():
+        mark = ' <- lớn nhất' if name == result['limit'] else ''
+        lines.append(f"    {name:<10} {value / gb:>8.2f} GB{mark}")
+    if not result['fits']:
+        lines.append(f"  Không đủ bộ nhớ: cấu hình nhỏ nhất cần khoảng {result['peak'] / gb:.1f} GB "
+                     f"(bước {result['limit']}), vượt ngân sách {result['budget'] / gb:.1f} GB")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ước tính bộ nhớ và chọn cấu hình chạy cho local.py")
+    parser.add_argument('inputs', nargs='+', help="Các file Sentinel-2 (tên dạng S2_median_<band>_...)")
+    parser.add_argument('--vector', default=None, help="Ranh giới dùng để cắt lưới (shapefile)")
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help="Ngân sách bộ nhớ (GB), mặc định 80%% bộ nhớ vật lý")
+    parser.add_argument('--cores', type=int, default=os.cpu_count())
+    parser.add_argument('--sample-size', type=int, default=100000)
+    parser.add_argument('--predictor', choices=('sklearn', 'flat'), default='sklearn')
+    parser.add_argument('--uncertainty', action='store_true')
+    parser.add_argument('--grid-res', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    geometry = None
+    if args.vector:
+        import geopandas as gpd
+        geometry = gpd.read_file(args.vector).geometry
+    info = inspect_inputs({os.path.basename(path).split('_')[2]: path for path in args.inputs}, geometry)
+    budget = int(args.memory_budget * 1024 ** 3) if args.memory_budget else default_budget()
+    grid_shape = coarse_shape(info, args.grid_res) if args.grid_res else None
+
+    result = plan(info['rows'], info['cols'], info['bands'], info['features'], budget, args.cores,
+                  args.sample_size, predictor=args.predictor,
+                  stats=len(UNCERTAINTY_STATS) if args.uncertainty else 0, grid_shape=grid_shape)
+    print(describe(result))
+    return 0 if result['fits'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
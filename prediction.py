@@ -0,0 +1,200 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+# Ngưỡng độ dốc: chỉ dự đoán cho pixel có độ dốc <= ngưỡng này
+MAX_SLOPE = 30
+
+# Các band của bản đồ độ bất định: trung bình, độ lệch chuẩn và phân vị 5/95 giữa các cây
+UNCERTAINTY_STATS = ('mean', 'std', 'p05', 'p95')
+
+# Số pixel mỗi lô khi tính giá trị của từng cây (bộ đệm n_trees x lô float32)
+UNCERTAINTY_CHUNK = 65536
+
+
+# Chia lưới (rows x cols) thành các cửa sổ (row_start, row_end, col_start, col_end)
+def iter_windows(rows, cols, block_size):
+    for row_start in range(0, rows, block_size):
+        for col_start in range(0, cols, block_size):
+            row_end = min(row_start + block_size, rows)
+            col_end = min(col_start + block_size, cols)
+            yield row_start, row_end, col_start, col_end
+
+
+# Lấy các đặc trưng của một cửa sổ từ khối (rows, cols, n_features) thành mảng
+# liên tục (n_pixels, n_features). Khối dùng float32 vì cây quyết định của sklearn
+# cũng ép kiểu về float32 khi dự đoán
+def stack_window(cube, window):
+    row_start, row_end, col_start, col_end = window
+    block = cube[row_start:row_end, col_start:col_end]
+    return np.ascontiguousarray(block).reshape(-1, cube.shape[2])
+
+
+# Mặt nạ pixel hợp lệ: độ dốc <= ngưỡng và không có đặc trưng nào là NaN
+def valid_pixels(block, slope, max_slope=MAX_SLOPE):
+    with np.errstate(invalid='ignore'):
+        valid = slope.ravel() <= max_slope
+    valid &= ~np.isnan(block).any(axis=1)
+    return valid
+
+
+# Giá trị dự đoán của từng cây cho các pixel X: mảng (n_trees, n_pixels) float32.
+# FlatForest duyệt mọi cây trong một lần gọi; với sklearn mỗi cây dự đoán một lần,
+# tổng công việc bằng đúng một lần RandomForestRegressor.predict
+def tree_predictions(model, X, out=None):
+    if hasattr(model, 'predict_trees'):
+        return model.predict_trees(X)
+    estimators = model.estimators_
+    if out is None:
+        out = np.empty((len(estimators), X.shape[0]), dtype=np.float32)
+    for t, estimator in enumerate(estimators):
+        out[t] = estimator.predict(X, check_input=False)
+    return out
+
+
+# Các thống kê trên phân bố giá trị của các cây: 'mean', 'std' và phân vị 'pNN' (ví dụ 'p05')
+def tree_statistics(trees, stats):
+    result = np.empty((len(stats), trees.shape[1]))
+    quantiles = [float(stat[1:]) for stat in stats if stat.startswith('p')]
+    percentiles = dict(zip(quantiles, np.percentile(trees, quantiles, axis=0))) if quantiles else {}
+    for k, stat in enumerate(stats):
+        if stat == 'mean':
+            result[k] = trees.mean(axis=0, dtype=np.float64)
+        elif stat == 'std':
+            result[k] = trees.std(axis=0, dtype=np.float64)
+        else:
+            result[k] = percentiles[float(stat[1:])]
+    return result
+
+
+# Dự đoán cho một cửa sổ: gọi predict một lần, trả về mảng 2D (NaN ở pixel không hợp lệ).
+# Nếu có stats (ví dụ UNCERTAINTY_STATS) thì trả về mảng (len(stats), h, w): giá trị của
+# các cây được tính theo từng lô UNCERTAINTY_CHUNK pixel nên bộ đệm (n_trees x lô) có giới hạn
+# và mọi thống kê dùng chung một lần duyệt cây
+def predict_window(model, cube, slope, window, max_slope=MAX_SLOPE, stats=None):
+    row_start, row_end, col_start, col_end = window
+    block = stack_window(cube, window)
+    valid = valid_pixels(block, slope[row_start:row_end, col_start:col_end], max_slope)
+    shape = (row_end - row_start, col_end - col_start)
+
+    if stats is None:
+        result = np.full(block.shape[0], np.nan)
+        if valid.any():
+            result[valid] = model.predict(block[valid])
+        return result.reshape(shape), int(valid.sum())
+
+    result = np.full((len(stats), block.shape[0]), np.nan)
+    index = np.flatnonzero(valid)
+    buffer = None
+    if not hasattr(model, 'predict_trees'):
+        buffer = np.empty((len(model.estimators_), min(len(index), UNCERTAINTY_CHUNK)), dtype=np.float32)
+    for start in range(0, len(index), UNCERTAINTY_CHUNK):
+        chunk = index[start:start + UNCERTAINTY_CHUNK]
+        X = np.ascontiguousarray(block[chunk])
+        out = None if buffer is None else buffer[:, :len(chunk)]
+        result[:, chunk] = tree_statistics(tree_predictions(model, X, out), stats)
+    return result.reshape(len(stats), *shape), int(valid.sum())
+
+
+# Trạng thái của tiến trình worker: mô hình và khối đặc trưng chỉ được nạp một lần,
+# khối đặc trưng được mở bằng memmap nên các worker dùng chung page cache của hệ điều hành
+_worker_state = {}
+
+
+# Nạp mô hình đã lưu: thư mục FlatForest (memory-map, các worker dùng chung page cache) hoặc
+# file joblib của sklearn (mỗi worker giữ một bản riêng vì cây sklearn chép mảng nút khi nạp)
+def load_model(model_path):
+    if os.path.isdir(model_path):
+        from forest_kernel import FlatForest
+        return FlatForest.load(model_path)
+
+    import joblib
+    model = joblib.load(model_path)
+    model.n_jobs = 1  # Song song theo tile, không song song theo cây trong mỗi worker
+    return model
+
+
+def _load_worker_state(model_path, cube_path):
+    key = (model_path, cube_path)
+    if key not in _worker_state:
+        _worker_state.clear()
+        _worker_state[key] = load_model(model_path), np.load(cube_path, mmap_mode='r')
+    return _worker_state[key]
+
+
+# Tác vụ dự đoán một tile trong worker: chỉ nhận đường dẫn và cửa sổ, không nhận mảng
+def _predict_tile(window, model_path, cube_path, slope_index, max_slope, stats=None):
+    model, cube = _load_worker_state(model_path, cube_path)
+    block_map, n_valid = predict_window(model, cube, cube[:, :, slope_index], window, max_slope, stats)
+    return window, block_map, n_valid
+
+
+# Dự đoán theo tile và ghi từng cửa sổ thẳng vào GeoTIFF qua writer
+# (raster_output.BiomassWriter, band 1; với stats mỗi thống kê là một band theo thứ tự,
+# stats[0] nên là 'mean').
+# workers > 1: chạy trên ProcessPoolExecutor, hoặc trên cụm dask nếu có client;
+# model_path là bản đã lưu của model (thư mục FlatForest hoặc file joblib) để mỗi
+# worker nạp một lần, đặc trưng được đọc từ file memmap của cube.
+# Kết quả giống hệt bản chạy tuần tự. Mỗi cửa sổ cũng được chuyển cho các accumulators
+# (đối tượng có add(window, block_map), ví dụ zonal.BiomassTotal) theo thứ tự ghi;
+# với stats chỉ band đầu tiên được chuyển cho accumulators và cộng vào tổng.
+# Trả về (số pixel đã dự đoán, tổng giá trị dự đoán)
+def predict_to_raster(model, cube, slope_index, writer, model_path, block_size=1000,
+                      workers=None, client=None, max_slope=MAX_SLOPE, accumulators=(), stats=None):
+    rows, cols = cube.shape[:2]
+    windows = list(iter_windows(rows, cols, block_size))
+    workers = workers or os.cpu_count()
+    cube_path = getattr(cube, 'filename', None)
+    n_predicted = 0
+    total = 0.0
+    start = time.perf_counter()
+
+    def write(window, block_map, n_valid):
+        nonlocal n_predicted, total
+        if stats is None:
+            writer.write_window(window, block_map)
+        else:
+            for band, data in enumerate(block_map, start=1):
+                writer.write_window(window, data, band=band)
+            block_map = block_map[0]
+        for accumulator in accumulators:
+            accumulator.add(window, block_map)
+        n_predicted += n_valid
+        total += np.nansum(block_map)
+
+    if (workers == 1 and client is None) or cube_path is None:
+        # Chạy tuần tự trong tiến trình hiện tại
+        slope = cube[:, :, slope_index]
+        for window in windows:
+            write(window, *predict_window(model, cube, slope, window, max_slope, stats))
+    else:
+        args = (model_path, cube_path, slope_index, max_slope, stats)
+
+        if client is not None:
+            from dask.distributed import as_completed
+            print(f"  Dự đoán {len(windows)} tile trên cụm dask...")
+            futures = client.map(_predict_tile, windows, *[[arg] * len(windows) for arg in args])
+            for future in as_completed(futures):
+                write(*future.result())
+                future.release()
+        else:
+            print(f"  Dự đoán {len(windows)} tile với {workers} tiến trình...")
+            # Giới hạn số tile đang xử lý để bộ nhớ chờ ghi không tăng theo kích thước bản đồ
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = set()
+                for window in windows:
+                    pending.add(executor.submit(_predict_tile, window, *args))
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            write(*future.result())
+                for future in pending:
+                    write(*future.result())
+
+    elapsed = time.perf_counter() - start
+    rate = rows * cols / elapsed if elapsed > 0 else float('inf')
+    print(f"  Đã dự đoán {n_predicted:,} pixel hợp lệ / {rows * cols:,} pixel "
+          f"trong {elapsed:.1f} giây ({rate:,.0f} pixel/giây)")
+    return n_predicted, total
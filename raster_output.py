@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from instrumentation import stage
+
+# Giá trị nodata cho từng kiểu dữ liệu đầu ra
+NODATA = {'float32': -9999.0, 'int16': -32768}
+
+# Hệ số lưu trữ khi ghi dạng int16: giá trị thật = giá trị lưu * INT16_SCALE (0.1 Mg/ha)
+INT16_SCALE = 0.1
+
+# Kích thước tile nội bộ của GeoTIFF
+BLOCK_SIZE = 512
+
+
+# Các mức overview (2, 4, 8, ...) cho tới khi cạnh nhỏ hơn một tile
+def overview_levels(width, height, min_size=BLOCK_SIZE):
+    levels = []
+    factor = 2
+    while max(width, height) / factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels or [2]
+
+
+# Ghi bản đồ sinh khối theo từng cửa sổ vào GeoTIFF dạng tile, nén DEFLATE/ZSTD,
+# kiểu float32 hoặc int16 có hệ số scale. Dữ liệu được ghi vào file tạm; close()
+# dựng overview rồi sao chép sang bố cục Cloud-Optimized GeoTIFF tại path
+class BiomassWriter:
+    def __init__(self, path, crs, transform, width, height, count=1, dtype='float32',
+                 compress='deflate', descriptions=None):
+        if dtype not in NODATA:
+            raise ValueError(f"Kiểu dữ liệu đầu ra không hỗ trợ: {dtype}")
+        self.path = path
+        self.tmp_path = path + '.tmp.tif'
+        self.dtype = dtype
+        self.nodata = NODATA[dtype]
+        self.profile = {
+            'driver': 'GTiff', 'height': height, 'width': width, 'count': count,
+            'dtype': dtype, 'nodata': self.nodata, 'crs': crs, 'transform': transform,
+            'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE,
+            'compress': compress, 'predictor': 3 if dtype == 'float32' else 2,
+            'BIGTIFF': 'IF_SAFER',
+        }
+        self.dst = rasterio.open(self.tmp_path, 'w', **self.profile)
+        if dtype == 'int16':
+            self.dst.scales = [INT16_SCALE] * count
+        if descriptions:
+            self.dst.descriptions = descriptions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.dst.close()
+            os.remove(self.tmp_path)
+
+    # Ghi một cửa sổ (row_start, row_end, col_start, col_end); NaN được đổi thành nodata
+    def write_window(self, window, data, band=1):
+        row_start, row_end, col_start, col_end = window
+        with stage('write', data.size):
+            invalid = np.isnan(data)
+            if self.dtype == 'int16':
+                data = np.clip(np.round(data / INT16_SCALE), -32767, 32767)
+            data = np.where(invalid, self.nodata, data).astype(self.dtype)
+            self.dst.write(data, band, window=Window(col_start, row_start,
+                                                     col_end - col_start, row_end - row_start))
+
+    # Dựng overview (trung bình) và chuyển sang bố cục COG: overview và tile nằm trong file
+    def close(self):
+        with stage('write'):
+            self.dst.build_overviews(overview_levels(self.dst.width, self.dst.height), Resampling.average)
+            self.dst.update_tags(ns='rio_overview', resampling='average')
+            self.dst.close()
+
+            rasterio.shutil.copy(self.tmp_path, self.path, driver='GTiff', copy_src_overviews=True,
+                                 tiled=True, blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE,
+                                 compress=self.profile['compress'], predictor=self.profile['predictor'],
+                                 BIGTIFF='IF_SAFER')
+            os.remove(self.tmp_path)
+
+
+# Đọc một band ở độ phân giải giảm (GDAL tự dùng overview phù hợp), trả về mảng masked
+def read_overview(path, max_size=2048, band=1):
+    with rasterio.open(path) as src:
+        factor = max(1, int(np.ceil(max(src.width, src.height) / max_size)))
+        out_shape = (max(1, src.height // factor), max(1, src.width // factor))
+        data = src.read(band, out_shape=out_shape, masked=True, resampling=Resampling.average)
+        return data * src.scales[band - 1] if src.scales[band - 1] != 1 else data
+
+
+# Vẽ ảnh xem nhanh từ overview thay vì từ mảng độ phân giải gốc
+def render_preview(path, png_path, title, label, max_size=2048):
+    import matplotlib.pyplot as plt
+
+    data = read_overview(path, max_size)
+    plt.figure(figsize=(12, 10))
+    plt.imshow(data, cmap='viridis')
+    plt.colorbar(label=label)
+    plt.title(title)
+    plt.savefig(png_path, dpi=300)
+    plt.close()
@@ -0,0 +1,107 @@
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
+from prediction import iter_windows
+from instrumentation import stage
+from spectral_indices import IndexEvaluator, available_indices, index_bands
+
+# Hệ số chuyển giá trị số (DN) sang độ phản xạ
+REFLECTANCE_SCALE = 0.0001
+
+# Đọc dữ liệu Sentinel-2 theo từng cửa sổ thay vì nạp toàn bộ band vào RAM.
+# Lưới đầu ra là hình chữ nhật bao ranh giới Gia Lai (tương đương mask(..., crop=True)),
+# pixel nằm ngoài ranh giới hoặc bằng nodata được gán NaN.
+class SentinelReader:
+    def __init__(self, files, geometry):
+        # files: {tên band: đường dẫn .tif/.jp2}
+        self.files = dict(sorted(files.items()))
+        self.datasets = {band: rasterio.open(path) for band, path in self.files.items()}
+
+        ref = next(iter(self.datasets.values()))
+        for band, src in self.datasets.items():
+            if (src.crs, src.transform, src.shape) != (ref.crs, ref.transform, ref.shape):
+                self.close()
+                raise ValueError(f"Band {band} không cùng lưới với các band còn lại")
+
+        self.meta = ref.meta.copy()
+        self.crs = ref.crs
+        self.shapes = list(geometry.to_crs(ref.crs))
+        self.window = geometry_window(ref, self.shapes).round_offsets().round_lengths()
+        self.transform = ref.window_transform(self.window)
+        self.shape = (int(self.window.height), int(self.window.width))
+
+        self.bands = list(self.datasets)
+        self.indices = available_indices(self.bands)
+        self.names = self.bands + self.indices
+        self._evaluators = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for src in self.datasets.values():
+            src.close()
+
+    # Chia lưới đã cắt thành các cửa sổ (row_start, row_end, col_start, col_end)
+    def windows(self, block_size=2048):
+        return iter_windows(*self.shape, block_size)
+
+    # Bộ tính chỉ số cho một tập chỉ số, giữ lại để dùng lại bộ đệm giữa các cửa sổ
+    def _evaluator(self, indices):
+        key = tuple(indices)
+        if key not in self._evaluators:
+            self._evaluators[key] = IndexEvaluator(indices)
+        return self._evaluators[key]
+
+    # Đọc một cửa sổ, trả về {tên: mảng float32}; chỉ số chỉ được tính khi được yêu cầu.
+    # out: {tên: mảng (có thể là view của khối đặc trưng)} để ghi kết quả trực tiếp
+    def read(self, window, names=None, out=None):
+        names = self.names if names is None else names
+        out = {} if out is None else out
+        row_start, row_end, col_start, col_end = window
+        src_window = Window(self.window.col_off + col_start, self.window.row_off + row_start,
+                            col_end - col_start, row_end - row_start)
+
+        pixels = (row_end - row_start) * (col_end - col_start)
+
+        # Mặt nạ ranh giới Gia Lai cho riêng cửa sổ này
+        with stage('mask', pixels):
+            outside = geometry_mask(self.shapes, out_shape=(row_end - row_start, col_end - col_start),
+                                    transform=rasterio.windows.transform(src_window, self.meta['transform']))
+
+        indices = [name for name in names if name in self.indices]
+        needed = {band for band in names if band in self.datasets}
+        for name in indices:
+            needed.update(index_bands(name))
+
+        bands = {}
+        for band in sorted(needed):
+            src = self.datasets[band]
+            with stage('read', pixels):
+                data = src.read(1, window=src_window, boundless=True, fill_value=src.nodata or 0)
+            with stage('mask', pixels):
+                invalid = outside if src.nodata is None else outside | (data == src.nodata)
+                data = data.astype(np.float32)
+                data *= np.float32(REFLECTANCE_SCALE)
+                data[invalid] = np.nan
+            bands[band] = data
+
+        for name in names:
+            if name in bands:
+                if name in out:
+                    out[name][...] = bands[name]
+                else:
+                    out[name] = bands[name]
+        if indices:
+            with stage('indices', pixels * len(indices)):
+                self._evaluator(indices).evaluate(bands, out)
+        return {name: out[name] for name in names}
+
+    # Duyệt tuần tự các cửa sổ, trả về (window, {tên: mảng})
+    def iter_blocks(self, block_size=2048, names=None):
+        for window in self.windows(block_size):
+            yield window, self.read(window, names)
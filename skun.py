@@ -3,10 +3,15 @@ import geemap
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from ee_utils import EEResults
+from instrumentation import Recorder, activate, deactivate, stage
 
 # Khởi tạo Earth Engine API
 ee.Initialize()
 
+# Ghi nhận thời gian của từng bước (lấy kết quả từ GEE, lưu file, vẽ biểu đồ)
+recorder = activate(Recorder())
+
 # Tạo bản đồ
 map_gia_lai = geemap.Map()
 
@@ -147,12 +152,13 @@ def calculateRmse(input_samples):
     rmse = observed.subtract(predicted).pow(2).reduce('mean', [0]).sqrt().get([0])
     return rmse
 
-try:
-    rmse = calculateRmse(predicted_samples)
-    print('RMSE:', rmse.getInfo())
-except Exception as e:
-    print("Lỗi khi tính RMSE:", str(e))
-    print("Tiếp tục với phân tích...")
+# Các kết quả cần đưa về máy (RMSE, tổng AGB, giá trị quan sát/dự đoán) được gom lại
+# và lấy bằng một lần getInfo ở phần tính tổng sinh khối, sau đó dùng lại cho báo cáo
+results = EEResults(ee)
+rmse = calculateRmse(predicted_samples)
+results.add('rmse', rmse)
+results.add('observed', predicted_samples.aggregate_array('agbd'))
+results.add('predicted', predicted_samples.aggregate_array('agbd_predicted'))
 
 # Dự đoán sinh khối
 predictedImage = stackedResampled.classify(
@@ -198,7 +204,22 @@ try:
     
     # Lấy tổng AGB
     totalAgb = stats.getNumber('agbd')
-    print('Tổng sinh khối trên mặt đất (AGB) tại Gia Lai:', totalAgb.getInfo(), 'Mg')
+    results.add('totalAgb', totalAgb)
+except Exception as e:
+    print("Lỗi khi tính tổng sinh khối:", str(e))
+
+# Lấy mọi kết quả đã đăng ký trong một lần gọi tới máy chủ
+with stage('fetch'):
+    results.fetch()
+
+try:
+    print('RMSE:', results['rmse'])
+except Exception as e:
+    print("Lỗi khi tính RMSE:", str(e))
+    print("Tiếp tục với phân tích...")
+
+try:
+    print('Tổng sinh khối trên mặt đất (AGB) tại Gia Lai:', results['totalAgb'], 'Mg')
 except Exception as e:
     print("Lỗi khi tính tổng sinh khối:", str(e))
 
@@ -221,48 +242,56 @@ if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
 # 1. Bản đồ tương tác HTML
-map_gia_lai.to_html(f'{output_dir}/ban_do_sinh_khoi_gia_lai.html')
+with stage('write'):
+    map_gia_lai.to_html(f'{output_dir}/ban_do_sinh_khoi_gia_lai.html')
 print(f"Đã lưu bản đồ tương tác tại: {output_dir}/ban_do_sinh_khoi_gia_lai.html")
 
 # 2. Xuất bản đồ sinh khối dạng GeoTIFF về Google Drive
-task = ee.batch.Export.image.toDrive(
-    image=predictedImage,
-    description='Sinh_khoi_Gia_Lai',
-    folder='Ket_qua_GEE',
-    scale=30,
-    region=geometry,
-    fileFormat='GeoTIFF'
-)
-task.start()
+with stage('export'):
+    task = ee.batch.Export.image.toDrive(
+        image=predictedImage,
+        description='Sinh_khoi_Gia_Lai',
+        folder='Ket_qua_GEE',
+        scale=30,
+        region=geometry,
+        fileFormat='GeoTIFF'
+    )
+    task.start()
 print("Đang xuất bản đồ sinh khối về Google Drive trong thư mục 'Ket_qua_GEE'")
 
 # 3. Lưu kết quả số vào file CSV
 try:
-    results = {
-        'RMSE': [rmse.getInfo()],
-        'Tong_Sinh_Khoi_Mg': [totalAgb.getInfo()]
+    summary = {
+        'RMSE': [results['rmse']],
+        'Tong_Sinh_Khoi_Mg': [results['totalAgb']]
     }
-    pd.DataFrame(results).to_csv(f'{output_dir}/ket_qua_sinh_khoi.csv')
+    with stage('write'):
+        pd.DataFrame(summary).to_csv(f'{output_dir}/ket_qua_sinh_khoi.csv')
     print(f"Đã lưu kết quả số liệu tại: {output_dir}/ket_qua_sinh_khoi.csv")
 except Exception as e:
     print(f"Lỗi khi lưu kết quả số liệu: {str(e)}")
 
 # 4. Tạo biểu đồ đánh giá mô hình
 try:
-    observed = predicted_samples.aggregate_array('agbd').getInfo()
-    predicted = predicted_samples.aggregate_array('agbd_predicted').getInfo()
-
-    plt.figure(figsize=(10, 10))
-    plt.scatter(observed, predicted, alpha=0.5)
-    plt.plot([0, max(observed)], [0, max(observed)], 'r--')
-    plt.xlabel('Sinh khối quan sát (Mg/ha)')
-    plt.ylabel('Sinh khối dự đoán (Mg/ha)')
-    plt.title('So sánh giá trị sinh khối quan sát và dự đoán')
-    plt.savefig(f'{output_dir}/do_chinh_xac_mo_hinh.png', dpi=300)
+    observed = results['observed']
+    predicted = results['predicted']
+
+    with stage('plot', len(observed)):
+        plt.figure(figsize=(10, 10))
+        plt.scatter(observed, predicted, alpha=0.5)
+        plt.plot([0, max(observed)], [0, max(observed)], 'r--')
+        plt.xlabel('Sinh khối quan sát (Mg/ha)')
+        plt.ylabel('Sinh khối dự đoán (Mg/ha)')
+        plt.title('So sánh giá trị sinh khối quan sát và dự đoán')
+        plt.savefig(f'{output_dir}/do_chinh_xac_mo_hinh.png', dpi=300)
     print(f"Đã lưu biểu đồ đánh giá mô hình tại: {output_dir}/do_chinh_xac_mo_hinh.png")
 except Exception as e:
     print(f"Lỗi khi tạo biểu đồ: {str(e)}")
 
+# Báo cáo hiệu năng (JSON + CSV) cạnh ket_qua_sinh_khoi.csv
+deactivate()
+print(f"Đã ghi báo cáo hiệu năng: {recorder.write(f'{output_dir}/bao_cao_hieu_nang')}")
+
 print("\nQuá trình phân tích hoàn tất. Tất cả kết quả đã được lưu tại thư mục:", output_dir)
 print("Bản đồ GeoTIFF đang được xuất về Google Drive, vui lòng kiểm tra sau vài phút.")
 
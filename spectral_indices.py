@@ -0,0 +1,105 @@
+import numpy as np
+
+# Danh mục chỉ số phổ giống addIndices trong skun.js. Mọi chỉ số đều có dạng
+#   scale * (tổ hợp tuyến tính các band + hằng số) / (tổ hợp tuyến tính các band + hằng số)
+# nên được khai báo bằng (scale, tử số, mẫu số); mỗi tổ hợp là {band: hệ số}, khóa 1 là hằng số
+INDICES = {
+    'ndvi': (1.0, {'B08': 1, 'B04': -1}, {'B08': 1, 'B04': 1}),
+    'mndwi': (1.0, {'B03': 1, 'B11': -1}, {'B03': 1, 'B11': 1}),
+    'ndbi': (1.0, {'B11': 1, 'B08': -1}, {'B11': 1, 'B08': 1}),
+    'evi': (2.5, {'B08': 1, 'B04': -1}, {'B08': 1, 'B04': 6, 'B02': -7.5, 1: 1}),
+    'bsi': (1.0, {'B11': 1, 'B04': 1, 'B08': -1, 'B02': -1}, {'B11': 1, 'B04': 1, 'B08': 1, 'B02': 1}),
+    'savi': (1.5, {'B08': 1, 'B04': -1}, {'B08': 1, 'B04': 1, 1: 0.5}),
+    'gci': (1.0, {'B08': 1, 'B03': -1}, {'B03': 1}),  # NIR / GREEN - 1
+    'arvi': (1.0, {'B08': 1, 'B04': -2, 'B02': 1}, {'B08': 1, 'B04': 2, 'B02': -1}),
+    'ndmi': (1.0, {'B08': 1, 'B11': -1}, {'B08': 1, 'B11': 1}),
+    'cire': (1.0, {'B05': 1, 'B04': -1}, {'B04': 1}),  # REDEDGE / RED - 1
+}
+
+
+# Các band cần thiết để tính một chỉ số
+def index_bands(name):
+    _, numerator, denominator = INDICES[name]
+    return tuple(sorted({band for band in (*numerator, *denominator) if band != 1}))
+
+
+# Các chỉ số tính được từ tập band hiện có, theo thứ tự của danh mục
+def available_indices(bands):
+    return [name for name in INDICES if set(index_bands(name)) <= set(bands)]
+
+
+# Khóa chuẩn hóa của một tổ hợp tuyến tính để nhận ra biểu thức con dùng chung
+def _term_key(term):
+    return tuple(sorted(((str(band), float(coef)) for band, coef in term.items()), key=lambda item: item[0]))
+
+
+# Tính một tập chỉ số trong một lượt cho mỗi cửa sổ. Mỗi tổ hợp tuyến tính khác nhau
+# (ví dụ NIR - RED dùng chung cho ndvi/evi/savi) chỉ được tính một lần vào bộ đệm float32
+# dùng lại giữa các cửa sổ; kết quả được ghi thẳng vào mảng out nếu có.
+# Phép chia chỉ thực hiện khi mẫu số khác 0, còn lại là NaN (không cộng epsilon)
+class IndexEvaluator:
+    def __init__(self, names):
+        unknown = [name for name in names if name not in INDICES]
+        if unknown:
+            raise ValueError(f"Chỉ số không hỗ trợ: {', '.join(unknown)}")
+        self.names = list(names)
+        self.terms = {}
+        self.plan = []
+        for name in self.names:
+            scale, numerator, denominator = INDICES[name]
+            keys = []
+            for term in (numerator, denominator):
+                key = _term_key(term)
+                self.terms.setdefault(key, term)
+                keys.append(key)
+            self.plan.append((name, np.float32(scale), *keys))
+        self.bands = sorted({band for name in self.names for band in index_bands(name)})
+        self._scratch = {}
+
+    def _buffers(self, shape):
+        if self._scratch.get('shape') != shape:
+            self._scratch = {'shape': shape}
+            self._scratch.update({key: np.empty(shape, dtype=np.float32) for key in self.terms})
+            self._scratch['tmp'] = np.empty(shape, dtype=np.float32)
+            self._scratch['valid'] = np.empty(shape, dtype=bool)
+        return self._scratch
+
+    # bands: {band: mảng float32 độ phản xạ}; out: {tên: mảng float32 để ghi kết quả} (tùy chọn)
+    def evaluate(self, bands, out=None):
+        out = {} if out is None else out
+        shape = np.shape(bands[self.bands[0]])
+        scratch = self._buffers(shape)
+
+        for key, term in self.terms.items():
+            buf = scratch[key]
+            buf.fill(term.get(1, 0))
+            for band, coef in term.items():
+                if band == 1:
+                    continue
+                if coef == 1:
+                    np.add(buf, bands[band], out=buf)
+                elif coef == -1:
+                    np.subtract(buf, bands[band], out=buf)
+                else:
+                    np.multiply(bands[band], np.float32(coef), out=scratch['tmp'])
+                    np.add(buf, scratch['tmp'], out=buf)
+
+        valid = scratch['valid']
+        for name, scale, numerator, denominator in self.plan:
+            result = out.get(name)
+            if result is None:
+                result = out[name] = np.empty(shape, dtype=np.float32)
+            result[...] = np.nan
+            np.not_equal(scratch[denominator], 0, out=valid)
+            np.divide(scratch[numerator], scratch[denominator], out=result, where=valid)
+            if scale != 1:
+                result *= scale
+        return out
+
+
+# Tính các chỉ số names từ {band: độ phản xạ}; chỉ số thiếu band sẽ bị bỏ qua
+def compute_indices(bands, names, out=None):
+    names = [name for name in names if name in INDICES and set(index_bands(name)) <= set(bands)]
+    if not names:
+        return {} if out is None else out
+    return IndexEvaluator(names).evaluate(bands, out)
@@ -0,0 +1,114 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from prediction import iter_windows
+
+# Số pixel chồng lấn giữa các tile; np.gradient chỉ cần một pixel lân cận
+HALO = 1
+
+
+# Trả về module mảng: CuPy nếu có GPU, ngược lại NumPy
+def array_module():
+    try:
+        import cupy
+        if cupy.cuda.runtime.getDeviceCount() > 0:
+            return cupy
+    except Exception:
+        pass
+    return np
+
+
+# Kích thước pixel theo mét (dx cho từng hàng, dy) của các hàng [row_start, row_end).
+# Với hệ tọa độ địa lý, độ dài một độ kinh tuyến/vĩ tuyến được tính theo ellipsoid WGS84
+def pixel_spacing(transform, crs, row_start, row_end):
+    rows = np.arange(row_start, row_end) + 0.5
+    xres, yres = abs(transform.a), abs(transform.e)
+
+    if crs is not None and crs.is_geographic:
+        lat = np.radians(transform.f + rows * transform.e)
+        m_per_deg_lat = 111132.92 - 559.82 * np.cos(2 * lat) + 1.175 * np.cos(4 * lat) - 0.0023 * np.cos(6 * lat)
+        m_per_deg_lon = 111412.84 * np.cos(lat) - 93.5 * np.cos(3 * lat) + 0.118 * np.cos(5 * lat)
+        return xres * m_per_deg_lon, yres * m_per_deg_lat
+
+    return np.full(rows.shape, xres), np.full(rows.shape, yres)
+
+
+# Độ dốc (độ) của một mảng DEM, dx/dy là kích thước pixel (mét) cho từng hàng
+def slope_degrees(dem, dx, dy, xp=np):
+    dem = xp.asarray(dem, dtype=xp.float32)
+    grad_y, grad_x = xp.gradient(dem)
+    grad_x /= xp.asarray(dx, dtype=xp.float32)[:, None]
+    grad_y /= xp.asarray(dy, dtype=xp.float32)[:, None]
+    slope = xp.degrees(xp.arctan(xp.hypot(grad_x, grad_y)))
+    return slope if xp is np else xp.asnumpy(slope)
+
+
+# Độ dốc của cả mảng DEM trong bộ nhớ (dùng làm tham chiếu cho phiên bản chia tile)
+def slope_of_array(dem, transform, crs):
+    dx, dy = pixel_spacing(transform, crs, 0, dem.shape[0])
+    return slope_degrees(dem, dx, dy)
+
+
+# Tính độ dốc cho một tile: đọc tile kèm halo, tính rồi cắt bỏ halo.
+# Ở biên raster không có halo nên np.gradient dùng sai phân một phía giống hệt bản tính cả mảng
+def _slope_tile(path, window, xp=np):
+    row_start, row_end, col_start, col_end = window
+    with rasterio.open(path) as src:
+        read_row_start = max(row_start - HALO, 0)
+        read_row_end = min(row_end + HALO, src.height)
+        read_col_start = max(col_start - HALO, 0)
+        read_col_end = min(col_end + HALO, src.width)
+        dem = src.read(1, window=Window(read_col_start, read_row_start,
+                                        read_col_end - read_col_start,
+                                        read_row_end - read_row_start), masked=True)
+        dx, dy = pixel_spacing(src.transform, src.crs, read_row_start, read_row_end)
+
+    dem = dem.astype(np.float32).filled(np.nan)
+    slope = slope_degrees(dem, dx, dy, xp)
+    return slope[row_start - read_row_start:row_end - read_row_start,
+                 col_start - read_col_start:col_end - read_col_start]
+
+
+# Tính độ dốc (độ) của raster DEM theo các tile chồng lấn và ghi ra GeoTIFF float32.
+# Các tile được chia cho process pool; nếu có GPU thì tính tuần tự trên CuPy
+def compute_slope_raster(dem_path, out_path, tile_size=2048, workers=None):
+    with rasterio.open(dem_path) as src:
+        profile = src.profile.copy()
+        windows = list(iter_windows(src.height, src.width, tile_size))
+
+    profile.update(driver='GTiff', count=1, dtype='float32', nodata=np.nan,
+                   tiled=True, blockxsize=256, blockysize=256, compress='deflate')
+
+    xp = array_module()
+    tmp_path = out_path + '.tmp'
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        if xp is not np:
+            print("  Tính độ dốc trên GPU (CuPy)...")
+            tiles = (_slope_tile(dem_path, window, xp) for window in windows)
+            for window, slope in zip(windows, tiles):
+                _write_tile(dst, window, slope)
+        else:
+            workers = workers or os.cpu_count()
+            print(f"  Tính độ dốc trên CPU với {workers} tiến trình ({len(windows)} tile)...")
+            # Giới hạn số tile đang xử lý để các tile chờ ghi không dồn lại trong bộ nhớ
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = {}
+                for window in windows:
+                    pending[executor.submit(_slope_tile, dem_path, window)] = window
+                    if len(pending) >= 2 * workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            _write_tile(dst, pending.pop(future), future.result())
+                for future, window in pending.items():
+                    _write_tile(dst, window, future.result())
+    os.replace(tmp_path, out_path)
+
+    return out_path
+
+
+def _write_tile(dst, window, data):
+    row_start, row_end, col_start, col_end = window
+    dst.write(data, 1, window=Window(col_start, row_start, col_end - col_start, row_end - row_start))
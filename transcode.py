@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+# Kích thước tile nội bộ của GeoTIFF chuyển đổi (đọc theo cửa sổ chỉ giải nén các tile cần)
+TILE_SIZE = 512
+
+# Phần mở rộng được chuyển đổi (JPEG2000: giải mã tốn CPU và chậm khi đọc ngẫu nhiên)
+JP2_EXTENSIONS = ('.jp2', '.j2k')
+
+# Kích thước khối khi tính checksum
+CHUNK_SIZE = 16 * 1024 ** 2
+
+# File ghi nhớ checksum theo (đường dẫn, mtime, kích thước) trong thư mục cache
+CHECKSUM_INDEX = 'checksums.json'
+
+
+# SHA-1 nội dung file, đọc theo khối
+def file_checksum(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Checksum của các file, dùng lại giá trị đã tính nếu đường dẫn, mtime và kích thước không đổi
+def checksums(paths, cache_dir):
+    index_path = os.path.join(cache_dir, CHECKSUM_INDEX)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, encoding='utf-8') as f:
+            index = json.load(f)
+
+    result = {}
+    for path in paths:
+        stat = os.stat(path)
+        entry = index.get(os.path.abspath(path))
+        if entry is None or entry[:2] != [stat.st_mtime, stat.st_size]:
+            entry = index[os.path.abspath(path)] = [stat.st_mtime, stat.st_size, file_checksum(path)]
+        result[path] = entry[2]
+
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+    return result
+
+
+# Chuyển một file sang GeoTIFF dạng tile, nén không mất dữ liệu (chạy trong worker)
+def transcode_file(path, out_path, compress='deflate'):
+    import rasterio
+    import rasterio.shutil
+
+    start = time.perf_counter()
+    with rasterio.open(path) as src:
+        predictor = 3 if src.dtypes[0].startswith('float') else 2
+    tmp_path = out_path + '.tmp.tif'
+    rasterio.shutil.copy(path, tmp_path, driver='GTiff', tiled=True, blockxsize=TILE_SIZE,
+                         blockysize=TILE_SIZE, compress=compress, predictor=predictor,
+                         BIGTIFF='IF_SAFER')
+    os.replace(tmp_path, out_path)
+    return out_path, time.perf_counter() - start
+
+
+# Bản GeoTIFF đã chuyển đổi cho các file JPEG2000 trong files ({tên: đường dẫn}), các file
+# khác giữ nguyên. Mỗi file JP2 chỉ được giải mã một lần: bản chuyển đổi nằm trong cache_dir
+# với tên gồm checksum nội dung nguồn, nên đổi tên hoặc sao chép file nguồn vẫn dùng lại được,
+# còn nội dung thay đổi thì tạo bản mới. Các file chưa có bản chuyển đổi được xử lý song song
+def transcode_jp2(files, cache_dir, workers=None, compress='deflate'):
+    jp2 = {name: path for name, path in files.items() if path.lower().endswith(JP2_EXTENSIONS)}
+    if not jp2:
+        return dict(files)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    sums = checksums(list(jp2.values()), cache_dir)
+    targets = {}
+    for name, path in jp2.items():
+        stem = os.path.splitext(os.path.basename(path))[0]
+        targets[name] = os.path.join(cache_dir, f"{stem}_{sums[path][:16]}.tif")
+
+    todo = [name for name, target in targets.items() if not os.path.exists(target)]
+    if todo:
+        workers = min(workers or os.cpu_count(), len(todo))
+        print(f"  Chuyển {len(todo)} file JPEG2000 sang GeoTIFF dạng tile với {workers} tiến trình...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(transcode_file, [jp2[name] for name in todo],
+                                   [targets[name] for name in todo], [compress] * len(todo))
+            for name, (_, seconds) in zip(todo, results):
+                print(f"    {os.path.basename(jp2[name])}: {seconds:.1f} giây")
+    if len(todo) < len(jp2):
+        print(f"  Dùng lại {len(jp2) - len(todo)} bản GeoTIFF đã chuyển đổi từ JPEG2000")
+
+    return {name: targets.get(name, path) for name, path in files.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chuyển các file Sentinel-2 JPEG2000 sang GeoTIFF dạng tile (cache)")
+    parser.add_argument('inputs', nargs='+', help="Các file .jp2")
+    parser.add_argument('--cache-dir', required=True, help="Thư mục cache, ví dụ <output_dir>/cache/jp2")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--compress', choices=('deflate', 'zstd', 'lzw'), default='deflate')
+    args = parser.parse_args(argv)
+
+    outputs = transcode_jp2({path: path for path in args.inputs}, args.cache_dir, args.workers, args.compress)
+    for path, out_path in outputs.items():
+        print(f"{path} -> {out_path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
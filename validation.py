@@ -0,0 +1,255 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Cạnh khối không gian mặc định (mét): các mẫu trong cùng khối luôn nằm chung một fold
+# để tập kiểm tra không nằm sát các mẫu huấn luyện (GEDI tự tương quan trong vài km)
+DEFAULT_BLOCK_SIZE_M = 5000
+
+# Lưới tham số mặc định cho tìm kiếm; n_estimators 50 như skun.py, 100 như local.py
+DEFAULT_GRID = {
+    'n_estimators': [50, 100],
+    'max_depth': [None, 20],
+    'min_samples_leaf': [1, 5],
+    'max_features': [1.0, 0.33],
+}
+
+
+# Cạnh khối block_size_m (mét) tính theo pixel (số hàng, số cột) trên lưới có transform, crs
+# và height hàng. Với CRS địa lý, kích thước pixel theo mét được tính ở hàng giữa lưới
+def block_pixels_of(block_size_m, transform, crs, height):
+    from terrain import pixel_spacing
+
+    dx, dy = pixel_spacing(transform, crs, height // 2, height // 2 + 1)
+    return max(1, int(block_size_m / dy[0])), max(1, int(block_size_m / dx[0]))
+
+
+# Mã khối không gian của từng mẫu theo vị trí pixel (hàng, cột); block_pixels là cạnh khối
+# (pixel) hoặc cặp (số hàng, số cột) của khối
+def spatial_blocks(rows, cols, block_pixels):
+    block_rows, block_cols = np.broadcast_to(block_pixels, 2)
+    block_rows = np.asarray(rows) // block_rows
+    block_cols = np.asarray(cols) // block_cols
+    return block_rows * (int(block_cols.max()) + 1) + block_cols
+
+
+# Chia các khối (không phải các mẫu) ngẫu nhiên vào k fold; trả về fold của từng mẫu
+def spatial_folds(blocks, k=5, seed=42):
+    unique, inverse = np.unique(blocks, return_inverse=True)
+    if len(unique) < k:
+        raise ValueError(f"Chỉ có {len(unique)} khối không gian, không đủ cho {k} fold; "
+                         f"hãy giảm kích thước khối")
+    order = np.random.default_rng(seed).permutation(len(unique))
+    return (order % k)[inverse]
+
+
+# RMSE và R² trên tập kiểm tra
+def scores(y_true, y_pred):
+    sse = float(np.sum((y_true - y_pred) ** 2))
+    sst = float(np.sum((y_true - y_true.mean()) ** 2))
+    return float(np.sqrt(sse / len(y_true))), 1 - sse / sst if sst > 0 else float('nan')
+
+
+# Mảng dùng chung giữa các tiến trình: dữ liệu nằm trong shared memory, worker chỉ nhận
+# (tên, shape, dtype) và gắn vào mà không sao chép hay pickle lại mảng cho mỗi tác vụ
+class SharedArray:
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.spec = (self.shm.name, array.shape, array.dtype.str)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf)[...] = array
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Các mảng dùng chung đã gắn trong tiến trình worker
+_shared = {}
+
+
+def _attach(specs):
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        array.flags.writeable = False
+        _shared[name] = (shm, array)
+
+
+def _array(name):
+    return _shared[name][1]
+
+
+def _forest(params, seed, n_jobs=1, **extra):
+    from sklearn.ensemble import RandomForestRegressor
+    return RandomForestRegressor(random_state=seed, n_jobs=n_jobs, **params, **extra)
+
+
+# Huấn luyện trên các fold khác và dự đoán fold `fold` cho một bộ tham số (chạy trong worker)
+def _fit_fold(params, fold, seed):
+    X, y, folds = _array('X'), _array('y'), _array('folds')
+    test = folds == fold
+    model = _forest(params, seed)
+
+    start = time.perf_counter()
+    model.fit(X[~test], y[~test])
+    fit_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    y_pred = model.predict(X[test])
+    predict_time = time.perf_counter() - start
+    return params, fold, np.flatnonzero(test), y_pred, fit_time, predict_time
+
+
+# Các bộ tham số của lưới (tích Descartes)
+def parameter_grid(grid):
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+# Đánh giá chéo không gian k fold cho mọi bộ tham số trong grid trên một process pool.
+# X, y, folds được đặt một lần vào shared memory; mỗi tác vụ (bộ tham số, fold) chỉ gửi
+# tham số. Trả về danh sách kết quả (RMSE, R² gộp trên tập kiểm tra, thời gian huấn luyện
+# và dự đoán), sắp xếp theo RMSE
+def grid_search(X, y, folds, grid=DEFAULT_GRID, workers=None, seed=42):
+    configs = parameter_grid(grid) if isinstance(grid, dict) else list(grid)
+    k = int(folds.max()) + 1
+    workers = workers or os.cpu_count()
+    arrays = {'X': SharedArray(np.asarray(X, dtype=np.float32)), 'y': SharedArray(y),
+              'folds': SharedArray(folds)}
+    predictions = [np.empty(len(y)) for _ in configs]
+    timing = [[0.0, 0.0] for _ in configs]
+
+    print(f"  Đánh giá {len(configs)} bộ tham số x {k} fold với {workers} tiến trình...")
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach,
+                                 initargs=({name: a.spec for name, a in arrays.items()},)) as executor:
+            jobs = [(c, fold) for c in range(len(configs)) for fold in range(k)]
+            results = executor.map(_fit_fold, [configs[c] for c, _ in jobs],
+                                   [fold for _, fold in jobs], [seed] * len(jobs))
+            for (c, _), (_, _, test, y_pred, fit_time, predict_time) in zip(jobs, results):
+                predictions[c][test] = y_pred
+                timing[c][0] += fit_time
+                timing[c][1] += predict_time
+    finally:
+        for array in arrays.values():
+            array.close()
+
+    results = []
+    for params, y_pred, (fit_time, predict_time) in zip(configs, predictions, timing):
+        rmse, r2 = scores(y, y_pred)
+        results.append({**params, 'rmse': rmse, 'r2': r2, 'fit_s': fit_time,
+                        'predict_us_per_pixel': predict_time / len(y) * 1e6})
+    return sorted(results, key=lambda result: result['rmse'])
+
+
+# Đánh giá chéo không gian cho một bộ tham số trong tiến trình hiện tại; trả về (RMSE, R²)
+def cross_validate(X, y, folds, params, seed=42, n_jobs=-1):
+    y_pred = np.empty(len(y))
+    for fold in range(int(folds.max()) + 1):
+        test = folds == fold
+        model = _forest(params, seed, n_jobs=n_jobs).fit(X[~test], y[~test])
+        y_pred[test] = model.predict(X[test])
+    return scores(y, y_pred)
+
+
+# Tăng dần số cây (warm_start) và dừng khi RMSE out-of-bag cải thiện ít hơn tol (tương đối)
+# sau mỗi bước step cây. Trả về (số cây đã chọn, [(số cây, RMSE OOB), ...])
+def grow_until_plateau(X, y, params=None, step=25, max_trees=500, tol=0.005, seed=42, n_jobs=-1):
+    params = {key: value for key, value in (params or {}).items() if key != 'n_estimators'}
+    model = _forest(params, seed, n_jobs=n_jobs, warm_start=True, oob_score=True,
+                    n_estimators=step)
+    curve = []
+    while True:
+        model.fit(X, y)
+        oob_rmse = float(np.sqrt(np.mean((y - model.oob_prediction_) ** 2)))
+        curve.append((model.n_estimators, oob_rmse))
+        if len(curve) > 1 and curve[-2][1] - oob_rmse < tol * curve[-2][1]:
+            return curve[-2][0], curve
+        if model.n_estimators >= max_trees:
+            return model.n_estimators, curve
+        model.n_estimators += step
+
+
+# Bộ tham số dự đoán nhanh nhất có RMSE không quá (1 + tolerance) lần RMSE tốt nhất
+def fastest_within(results, tolerance=0.02):
+    best = min(result['rmse'] for result in results)
+    eligible = [result for result in results if result['rmse'] <= best * (1 + tolerance)]
+    return min(eligible, key=lambda result: result['predict_us_per_pixel'])
+
+
+# Lấy mẫu huấn luyện từ khối đặc trưng: chọn ngẫu nhiên (có seed) các pixel có GEDI,
+# gom bằng một lần fancy-indexing rồi bỏ các hàng có NaN. Trả về X, y và vị trí (hàng, cột)
+def sample_training(cube, gedi_data, sample_size=100000, seed=42):
+    rng = np.random.default_rng(seed)
+    valid_indices = np.flatnonzero(~np.isnan(gedi_data))
+    if len(valid_indices) > sample_size:
+        # Sắp xếp chỉ số để truy cập bộ nhớ tuần tự khi gom mẫu
+        valid_indices = np.sort(rng.choice(valid_indices, sample_size, replace=False))
+    rows, cols = np.unravel_index(valid_indices, gedi_data.shape)
+
+    X = cube[rows, cols]
+    y = gedi_data[rows, cols]
+    complete = ~np.isnan(X).any(axis=1)
+    return X[complete], y[complete], rows[complete], cols[complete]
+
+
+# Lấy mẫu huấn luyện từ một mục cache đặc trưng
+def sample_entry(entry, sample_size=100000, seed=42):
+    cube = np.load(os.path.join(entry, 'cube.npy'), mmap_mode='r')
+    gedi = np.load(os.path.join(entry, 'gedi.npy'), mmap_mode='r')
+    return sample_training(cube, gedi, sample_size, seed)
+
+
+def main(argv=None):
+    import json
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Đánh giá chéo không gian và tìm tham số Random Forest")
+    parser.add_argument('entry', help="Thư mục một mục cache đặc trưng (<cache>/features/<key>)")
+    parser.add_argument('--sample-size', type=int, default=100000)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--block-size', type=float, default=DEFAULT_BLOCK_SIZE_M, help="Cạnh khối không gian (mét)")
+    parser.add_argument('--grid', default=None, help="Lưới tham số dạng JSON, ví dụ '{\"n_estimators\": [50, 100]}'")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--tolerance', type=float, default=0.02,
+                        help="Chọn mô hình nhanh nhất có RMSE trong phạm vi (1 + tolerance) của RMSE tốt nhất")
+    parser.add_argument('--grow', action='store_true', help="Xác định số cây bằng OOB + warm_start")
+    parser.add_argument('--output', default='cv_results.csv')
+    args = parser.parse_args(argv)
+
+    with open(os.path.join(args.entry, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    import rasterio
+
+    block_pixels = block_pixels_of(args.block_size, rasterio.Affine(*meta['transform']),
+                                   rasterio.crs.CRS.from_wkt(meta['crs']), meta['shape'][0])
+    X, y, rows, cols = sample_entry(args.entry, args.sample_size)
+    folds = spatial_folds(spatial_blocks(rows, cols, block_pixels), args.folds)
+    print(f"Số mẫu: {len(y):,}, {args.folds} fold, khối {args.block_size:g} m")
+
+    if args.grow:
+        n_trees, curve = grow_until_plateau(X, y)
+        for trees, oob_rmse in curve:
+            print(f"  {trees:>4} cây: RMSE OOB {oob_rmse:.4f}")
+        print(f"Số cây đề xuất: {n_trees}")
+
+    grid = json.loads(args.grid) if args.grid else DEFAULT_GRID
+    start = time.perf_counter()
+    results = grid_search(X, y, folds, grid, args.workers)
+    print(f"Hoàn tất trong {time.perf_counter() - start:.1f} giây")
+
+    table = pd.DataFrame(results)
+    table.to_csv(args.output, index=False)
+    print(table.to_string(index=False))
+    print(f"Mô hình nhanh nhất đạt yêu cầu: {fastest_within(results, args.tolerance)}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
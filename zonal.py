@@ -0,0 +1,194 @@
+import os
+
+import numpy as np
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from alignment import source_key
+
+# Các lớp WorldCover được giữ khi tính tổng sinh khối (giống landCoverMask trong skun.py):
+# 10 cây gỗ, 20 cây bụi, 30 đồng cỏ, 40 đất nông nghiệp, 95 rừng ngập mặn
+FOREST_CLASSES = (10, 20, 30, 40, 95)
+
+
+# Diện tích thật (m²) của pixel trên từng hàng [row_start, row_end) của lưới, tính trên
+# ellipsoid WGS84 như ee.Image.pixelArea(). Với EPSG:4326/3857 diện tích chỉ thay đổi theo
+# hàng; với CRS chiếu khác (UTM) lấy pixel ở cột giữa làm đại diện cho cả hàng
+def row_pixel_area(transform, crs, row_start, row_end, col=None):
+    from pyproj import Geod, Transformer
+
+    rows = np.arange(row_start, row_end, dtype=np.float64)
+    col = 0.0 if col is None else float(col)
+    # Bốn góc của pixel (col, row) trên mỗi hàng, theo thứ tự vòng quanh
+    corner_cols = np.array([col, col + 1, col + 1, col])
+    corner_rows = rows[:, None] + np.array([0, 0, 1, 1])
+    xs = transform.c + corner_cols[None, :] * transform.a + corner_rows * transform.b
+    ys = transform.f + corner_cols[None, :] * transform.d + corner_rows * transform.e
+
+    if crs.is_geographic:
+        lons, lats = xs, ys
+    else:
+        to_lonlat = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True)
+        lons, lats = to_lonlat.transform(xs, ys)
+
+    geod = Geod(ellps='WGS84')
+    return np.array([abs(geod.polygon_area_perimeter(lon, lat)[0]) for lon, lat in zip(lons, lats)])
+
+
+# Cộng dồn tổng sinh khối (Mg) trong một lượt duyệt các cửa sổ dự đoán, không giữ bản đồ
+# trong bộ nhớ: mỗi pixel được nhân với diện tích thật (ha) của hàng chứa nó và chỉ được
+# tính nếu lớp phủ (raster đã căn chỉnh lên cùng lưới) thuộc classes. Tổng cộng bằng float64
+class BiomassTotal:
+    def __init__(self, grid, landcover_path=None, classes=FOREST_CLASSES):
+        col = None if grid.crs.is_geographic else grid.width / 2
+        self.row_area_ha = row_pixel_area(grid.transform, grid.crs, 0, grid.height, col) / 10000
+        self.classes = np.asarray(classes, dtype=np.float32)
+        self.landcover = rasterio.open(landcover_path) if landcover_path else None
+        self.total = 0.0
+        self.area_ha = 0.0
+        self.n_pixels = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.landcover is not None:
+            self.landcover.close()
+
+    # Mặt nạ lớp phủ của một cửa sổ (row_start, row_end, col_start, col_end)
+    def mask(self, window):
+        row_start, row_end, col_start, col_end = window
+        if self.landcover is None:
+            return np.ones((row_end - row_start, col_end - col_start), dtype=bool)
+        classes = self.landcover.read(1, window=Window(col_start, row_start, col_end - col_start,
+                                                       row_end - row_start))
+        return np.isin(classes, self.classes)
+
+    # Cộng một cửa sổ dự đoán (Mg/ha, NaN ở pixel không hợp lệ)
+    def add(self, window, data):
+        self.accumulate(window, data, self.mask(window) & ~np.isnan(data))
+
+    def accumulate(self, window, data, valid):
+        row_start, row_end = window[:2]
+        area = self.row_area_ha[row_start:row_end, None]
+        self.total += float(np.sum(np.where(valid, data, 0) * area, dtype=np.float64))
+        self.area_ha += float(np.sum(valid * area, dtype=np.float64))
+        self.n_pixels += int(valid.sum())
+
+
+# Số khoảng và giá trị lớn nhất (Mg/ha) của histogram dùng để tính phân vị theo vùng;
+# phân vị có độ chính xác HIST_MAX / HIST_BINS = 0.5 Mg/ha, giá trị lớn hơn rơi vào khoảng cuối
+HIST_BINS = 2000
+HIST_MAX = 1000.0
+
+# Các phân vị ghi vào bảng thống kê theo vùng
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+# Raster nhãn vùng trên lưới dự đoán: pixel thuộc đa giác thứ i (theo thứ tự trong zones)
+# có nhãn i + 1, ngoài mọi đa giác là 0. Raster được rasterize theo dải hàng một lần và
+# lưu trong cache_dir; các lần chạy sau dùng lại nếu file vùng và lưới không đổi
+def rasterize_zones(zones, zones_path, grid, cache_dir, strip_rows=1024):
+    key = source_key(zones_path, crs=grid.crs.to_wkt(), transform=list(grid.transform)[:6],
+                     shape=[grid.height, grid.width], n_zones=len(zones))
+    out_path = os.path.join(cache_dir, f"zones_{key[:16]}.tif")
+    if os.path.exists(out_path):
+        return out_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    dtype = 'uint16' if len(zones) < 65535 else 'uint32'
+    shapes = [(geom, i + 1) for i, geom in enumerate(zones.geometry.to_crs(grid.crs))]
+    profile = {
+        'driver': 'GTiff', 'height': grid.height, 'width': grid.width, 'count': 1,
+        'dtype': dtype, 'nodata': 0, 'crs': grid.crs, 'transform': grid.transform,
+        'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate',
+    }
+    tmp_path = out_path + '.tmp'
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        for row_start in range(0, grid.height, strip_rows):
+            row_end = min(row_start + strip_rows, grid.height)
+            window = Window(0, row_start, grid.width, row_end - row_start)
+            labels = rasterize(shapes, out_shape=(row_end - row_start, grid.width), fill=0,
+                               transform=rasterio.windows.transform(window, grid.transform), dtype=dtype)
+            dst.write(labels, 1, window=window)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+# Thống kê sinh khối theo vùng trong cùng một lượt duyệt các cửa sổ dự đoán: mỗi cửa sổ
+# chỉ cần vài np.bincount theo nhãn vùng (không tạo mặt nạ riêng cho từng đa giác).
+# Cộng dồn số pixel, diện tích, tổng sinh khối (Mg), tổng và tổng bình phương mật độ
+# (Mg/ha) và histogram mật độ để tính phân vị. Dùng chung mặt nạ lớp phủ với BiomassTotal
+class ZonalStats(BiomassTotal):
+    def __init__(self, grid, labels_path, n_zones, landcover_path=None, classes=FOREST_CLASSES):
+        super().__init__(grid, landcover_path, classes)
+        self.labels = rasterio.open(labels_path)
+        self.n_zones = n_zones
+        size = n_zones + 1
+        self.count = np.zeros(size, dtype=np.int64)
+        self.zone_area = np.zeros(size)
+        self.biomass = np.zeros(size)
+        self.sum = np.zeros(size)
+        self.sum_sq = np.zeros(size)
+        self.hist = np.zeros(size * HIST_BINS, dtype=np.int64)
+
+    def close(self):
+        super().close()
+        self.labels.close()
+
+    def accumulate(self, window, data, valid):
+        super().accumulate(window, data, valid)
+        row_start, row_end, col_start, col_end = window
+        labels = self.labels.read(1, window=Window(col_start, row_start, col_end - col_start,
+                                                   row_end - row_start))
+        valid = valid & (labels > 0)
+
+        zone = labels[valid].astype(np.int64)
+        values = data[valid].astype(np.float64)
+        area = np.broadcast_to(self.row_area_ha[row_start:row_end, None], data.shape)[valid]
+        size = self.n_zones + 1
+
+        self.count += np.bincount(zone, minlength=size)
+        self.zone_area += np.bincount(zone, weights=area, minlength=size)
+        self.biomass += np.bincount(zone, weights=values * area, minlength=size)
+        self.sum += np.bincount(zone, weights=values, minlength=size)
+        self.sum_sq += np.bincount(zone, weights=values * values, minlength=size)
+
+        bins = np.clip((values * (HIST_BINS / HIST_MAX)).astype(np.int64), 0, HIST_BINS - 1)
+        self.hist += np.bincount(zone * HIST_BINS + bins, minlength=size * HIST_BINS)
+
+    # Phân vị q (%) của từng vùng từ histogram, nội suy tuyến tính trong khoảng chứa phân vị
+    def percentile(self, q):
+        hist = self.hist.reshape(-1, HIST_BINS)[1:]
+        cumulative = np.cumsum(hist, axis=1)
+        target = cumulative[:, -1] * q / 100
+        index = np.minimum(np.argmax(cumulative >= target[:, None], axis=1), HIST_BINS - 1)
+        rows = np.arange(len(hist))
+        below = np.where(index > 0, cumulative[rows, np.maximum(index - 1, 0)], 0)
+        inside = hist[rows, index]
+        fraction = np.divide(target - below, inside, out=np.zeros(len(hist)), where=inside > 0)
+        result = (index + fraction) * (HIST_MAX / HIST_BINS)
+        return np.where(cumulative[:, -1] > 0, result, np.nan)
+
+    # Bảng kết quả: một dòng cho mỗi vùng (bỏ nhãn 0 = ngoài mọi vùng)
+    def table(self, names=None):
+        import pandas as pd
+
+        count = self.count[1:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum[1:] / count
+            std = np.sqrt(np.maximum(self.sum_sq[1:] / count - mean ** 2, 0))
+        table = pd.DataFrame({
+            'Zone': names if names is not None else np.arange(1, self.n_zones + 1),
+            'Pixels': count,
+            'Area_ha': self.zone_area[1:],
+            'Total_Biomass_Mg': self.biomass[1:],
+            'Mean_Mg_ha': mean,
+            'Std_Mg_ha': std,
+        })
+        for q in PERCENTILES:
+            table[f'P{q:02d}_Mg_ha'] = self.percentile(q)
+        return table